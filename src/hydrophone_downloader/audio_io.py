@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+audio_io.py
+
+ small helpers to get audio files in and out of NumPy arrays.
+"""
+
+import os
+import re
+from datetime import datetime, timezone
+
+
+# ONC archive files are named <deviceCode>_<YYYYMMDDTHHMMSS.fff>Z[-suffix].<ext>
+ONC_TIMESTAMP = re.compile(r'_(\d{8}T\d{6}\.\d{3})Z')
+# OOI raw files are named <network>-<station>-<location>-<channel>-<YYYY-MM-DDTHH:MM:SS.ffffff>.mseed, saved without the colons
+OOI_TIMESTAMP_PATTERN = r'-(\d{4}-\d{2}-\d{2})T(\d{2}):?(\d{2}):?(\d{2})(\.\d+)?'
+OOI_TIMESTAMP = re.compile(OOI_TIMESTAMP_PATTERN + r'\.[A-Za-z0-9]+$')
+
+
+def segment_to_array(segment):
+    import numpy as np
+
+    return np.array(segment.get_array_of_samples()).reshape(-1, segment.channels), segment.frame_rate
+
+
+def read_audio(filename):
+    """
+    Decode an audio file (anything ffmpeg can read) and return (samples, sample_rate), samples has shape (n_frames, n_channels).
+    """
+    from pydub import AudioSegment
+
+    return segment_to_array(AudioSegment.from_file(filename, format=os.path.splitext(filename)[1][1:] or None))
+
+
+def decode_audio(data, format):
+    """
+    Like read_audio for a file held in memory (bytes), ffmpeg reads it from a pipe so nothing is written to disk.
+    """
+    import io
+    from pydub import AudioSegment
+
+    return segment_to_array(AudioSegment.from_file(io.BytesIO(data), format=format))
+
+
+def write_audio(filename, samples, sample_rate, sample_width=None):
+    """
+    Encode samples of shape (n_frames,) or (n_frames, n_channels) to filename, the format is taken from the extension.
+    The file is written next to the destination first, so an existing file is only replaced by a complete one.
+    """
+    import numpy as np
+    from pydub import AudioSegment
+
+    samples = np.asarray(samples)
+    if samples.ndim == 1:
+        samples = samples[:, None]
+    if sample_width is None:
+        sample_width = samples.dtype.itemsize
+    dtype = {1: np.int8, 2: np.int16, 4: np.int32}[sample_width]
+
+    segment = AudioSegment(
+        data=np.ascontiguousarray(samples.astype(dtype)).tobytes(),
+        sample_width=sample_width,
+        frame_rate=int(sample_rate),
+        channels=samples.shape[1],
+    )
+    extension = os.path.splitext(filename)[1][1:]
+    tmp_filename = filename + '.tmp'
+    segment.export(tmp_filename, format=extension)
+    os.replace(tmp_filename, filename)
+
+
+def onc_start_time(filename):
+    """
+    POSIX timestamp of the first sample of an ONC archive file, or None if the filename does not carry one.
+    """
+    match = ONC_TIMESTAMP.search(os.path.basename(filename))
+    if match is None:
+        return None
+    return datetime.strptime(match.group(1), '%Y%m%dT%H%M%S.%f').replace(tzinfo=timezone.utc).timestamp()
+
+
+def ooi_start_time(filename):
+    """
+    POSIX timestamp of the first sample of an OOI raw file (or the file converted from it), None if the filename does not carry one.
+    Both the archive names (HH:MM:SS) and the saved names (HHMMSS) are read.
+    """
+    match = OOI_TIMESTAMP.search(os.path.basename(filename))
+    if match is None:
+        return None
+    day, hours, minutes, seconds, fraction = match.groups()
+    start_time = datetime.strptime(f"{day}T{hours}{minutes}{seconds}", '%Y-%m-%dT%H%M%S').replace(tzinfo=timezone.utc)
+    return start_time.timestamp() + float(fraction or 0)
+
+
+# ffmpeg arguments per output extension, the bitrate of a format spec (mp3:320k) is added with -b:a
+ENCODER_ARGS = {
+    'wav': [],
+    'flac': ['-c:a', 'flac'],
+    'mp3': ['-c:a', 'libmp3lame'],
+    'ogg': ['-c:a', 'libvorbis'],
+    'opus': ['-c:a', 'libopus'],
+}
+DEFAULT_BITRATES = {'mp3': '320k'}
+PCM_FORMATS = {1: ('u8', 'pcm_u8'), 2: ('s16le', 'pcm_s16le'), 4: ('s32le', 'pcm_s32le')}
+
+
+def parse_formats(spec):
+    """
+    'flac,mp3:320k,mp3:128k' (or a list of such items) -> [('flac', None), ('mp3', '320k'), ('mp3', '128k')]
+    """
+    items = spec.split(',') if isinstance(spec, str) else list(spec)
+    formats = []
+    for item in items:
+        extension, _, bitrate = item.strip().lower().partition(':')
+        if not extension:
+            continue
+        if extension not in ENCODER_ARGS:
+            raise ValueError(f"Unsupported output format {extension}, choose from {list(ENCODER_ARGS)}")
+        formats.append((extension, bitrate or DEFAULT_BITRATES.get(extension)))
+    if len(formats) == 0:
+        raise ValueError(f"No output format in {spec!r}")
+    return formats
+
+
+def output_filenames(base, formats):
+    """
+    [(filename, extension, bitrate), ...] for base (a path without extension), a format listed at several bitrates gets the
+    bitrate in its name: base.flac, base_320k.mp3, base_128k.mp3
+    """
+    counts = {}
+    for extension, _ in formats:
+        counts[extension] = counts.get(extension, 0) + 1
+    return [(f"{base}_{bitrate}.{extension}" if counts[extension] > 1 and bitrate else f"{base}.{extension}", extension, bitrate)
+            for extension, bitrate in formats]
+
+
+def encode_pcm(data, sample_rate, channels, sample_width, outputs, chunk_size=1 << 20):
+    """
+    Encode one buffer of interleaved PCM (e.g. AudioSegment.raw_data) to each of outputs ([(filename, extension, bitrate), ...],
+    see output_filenames). Each output gets its own ffmpeg process and feeder thread, so the audio is decoded once and the
+    encoders run side by side. Every file is written next to its destination first, a failed encoder raises after the others finish.
+    """
+    import subprocess
+    import threading
+
+    input_format, pcm_codec = PCM_FORMATS[sample_width]
+    view = memoryview(data)
+    processes = []
+    for filename, extension, bitrate in outputs:
+        codec = ['-c:a', pcm_codec] if extension == 'wav' else ENCODER_ARGS[extension]
+        if bitrate and extension != 'wav' and extension != 'flac':
+            codec = codec + ['-b:a', bitrate]
+        tmp_filename = filename + '.tmp.' + extension
+        command = ['ffmpeg', '-v', 'error', '-y', '-f', input_format, '-ar', str(int(sample_rate)), '-ac', str(channels), '-i', '-'] + codec + [tmp_filename]
+        processes.append((filename, tmp_filename, subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)))
+
+    def feed(process):
+        try:
+            for i in range(0, len(view), chunk_size):
+                process.stdin.write(view[i:i + chunk_size])
+        except BrokenPipeError:
+            # the encoder died, its exit code reports it
+            pass
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    threads = [threading.Thread(target=feed, args=(process,), daemon=True) for _, _, process in processes]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    errors = []
+    for filename, tmp_filename, process in processes:
+        stderr = process.stderr.read().decode('utf-8', 'replace').strip()
+        if process.wait() != 0:
+            errors.append(f"{filename}: {stderr}")
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            continue
+        os.replace(tmp_filename, filename)
+    if errors:
+        raise RuntimeError("ffmpeg could not encode " + "; ".join(errors))
+    return [filename for filename, _, _ in outputs]
+
+
+def export_segment(segment, outputs):
+    """
+    encode_pcm for a pydub AudioSegment
+    """
+    return encode_pcm(segment.raw_data, segment.frame_rate, segment.channels, segment.sample_width, outputs)
+
+
+def probe_duration(filename):
+    """
+    Duration of an audio file in seconds according to ffprobe, None if ffprobe is not installed. Raises ValueError if it cannot read the file.
+    """
+    import shutil
+    import subprocess
+
+    if shutil.which('ffprobe') is None:
+        return None
+    result = subprocess.run(['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1',
+                             filename], capture_output=True, text=True)
+    try:
+        return float(result.stdout.strip())
+    except ValueError:
+        raise ValueError(result.stderr.strip() or "no duration") from None
+
+
+def check_output(filename, expected_seconds, tolerance=0.01):
+    """
+    Why filename is not a complete encoding of expected_seconds of audio, None if it is. The duration may be off by tolerance
+    (a fraction, at least a second, for the padding of lossy encoders). Without ffprobe only the size is checked.
+    """
+    if not os.path.exists(filename):
+        return "missing"
+    if os.path.getsize(filename) == 0:
+        return "empty"
+    try:
+        duration = probe_duration(filename)
+    except ValueError as e:
+        return f"unreadable ({e})"
+    if duration is not None and abs(duration - expected_seconds) > max(1.0, tolerance * expected_seconds):
+        return f"{duration:.1f} s long instead of {expected_seconds:.1f} s"
+    return None
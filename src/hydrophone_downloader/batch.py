@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+batch.py
+
+ many bbox/time queries (one per study site, say) in one run: each source is discovered once, the station-days of all the queries
+ are merged so a day two queries share is downloaded once into save_dir, and each query gets a view of its days.
+
+    hydrophone-downloader-batch save_dir=/data/sonifications queries_file=sites.yaml
+
+ queries_file is YAML (a list of queries, or {queries: [...]}) or CSV (one query per row), with the keys of the main command:
+
+    - name: axial
+      min_latitude: 45.8
+      max_latitude: 46
+      min_longitude: -130
+      max_longitude: -129.7
+      start_time: 2025-01-01
+      end_time: 2025-01-07
+
+ Missing bounds are open, min_lat/max_lat/... work too. The view of a query is <views_dir>/<name>/ (default
+ <save_dir>/.queries/<name>/), with the day folders it matched as symlinks at the same relative paths as in save_dir, and a
+ query.json listing its days and their status. The default views_dir is hidden so tools scanning save_dir do not see the days twice.
+"""
+
+import os
+import csv
+import re
+from datetime import datetime
+
+from .supported_classes.base_class import DEFAULT_QUERY, deployment_key, shard_deployments
+
+
+QUERY_KEYS = ('min_lat', 'max_lat', 'min_lon', 'max_lon', 'min_depth', 'max_depth', 'license', 'start_time', 'end_time')
+# the names used by the config (and the main command)
+ALIASES = {'min_latitude': 'min_lat', 'max_latitude': 'max_lat', 'min_longitude': 'min_lon', 'max_longitude': 'max_lon'}
+VIEWS_DIRNAME = '.queries'
+
+
+def normalize_query(query, index):
+    """
+    The query with the short key names, open bounds filled in and YYYY-MM-DD dates
+    """
+    query = {ALIASES.get(k, k): v for k, v in query.items()}
+    unknown = set(query) - set(QUERY_KEYS) - {'name'}
+    if unknown:
+        raise ValueError(f"Query {index} has unknown keys {sorted(unknown)}, use {list(QUERY_KEYS)}")
+    for key in ('start_time', 'end_time'):
+        if not query.get(key):
+            raise ValueError(f"Query {index} needs a {key}")
+
+    normalized = dict(DEFAULT_QUERY)
+    for key, value in query.items():
+        # CSV cells are strings and empty for an open bound
+        if value is None or value == '':
+            continue
+        if key in ('start_time', 'end_time'):
+            value = str(value)[:10]
+        elif key.startswith(('min_', 'max_')):
+            value = float(value)
+        normalized[key] = value
+    name = str(query.get('name') or f"query_{index}")
+    normalized['name'] = re.sub(r'[^A-Za-z0-9_.-]', '_', name)
+    assert normalized['min_lat'] <= normalized['max_lat'], f"{name}: min_lat must be less than or equal to max_lat"
+    assert normalized['min_lon'] <= normalized['max_lon'], f"{name}: min_lon must be less than or equal to max_lon"
+    assert normalized['min_depth'] <= normalized['max_depth'], f"{name}: min_depth must be less than or equal to max_depth"
+    return normalized
+
+
+def load_queries(filename):
+    """
+    The queries of a YAML or CSV file, normalized (see normalize_query)
+    """
+    if filename.lower().endswith('.csv'):
+        with open(filename, newline='') as f:
+            queries = [{k.strip(): v.strip() for k, v in row.items() if k} for row in csv.DictReader(f)]
+    else:
+        from omegaconf import OmegaConf
+
+        queries = OmegaConf.to_container(OmegaConf.load(filename))
+        if isinstance(queries, dict):
+            queries = queries['queries']
+    queries = [normalize_query(query, i) for i, query in enumerate(queries)]
+
+    names = [query['name'] for query in queries]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Query names must be unique, {duplicates} appear more than once")
+    return queries
+
+
+def link_view(view_dir, save_dir, directory):
+    """
+    Symlink save_dir/directory at view_dir/directory (relative, so the tree can be moved as a whole)
+    """
+    target = os.path.join(save_dir, directory)
+    link = os.path.join(view_dir, directory)
+    os.makedirs(os.path.dirname(link), exist_ok=True)
+    relative_target = os.path.relpath(target, os.path.dirname(link))
+    if os.path.islink(link):
+        if os.readlink(link) == relative_target:
+            return link
+        os.remove(link)
+    elif os.path.exists(link):
+        print(f"{link} exists and is not a link, leaving it")
+        return link
+    os.symlink(relative_target, link)
+    return link
+
+
+def run_batch(queries, save_dir, views_dir=None, options=None, profiler=None, shard_index=0, shard_count=1):
+    """
+    Download the union of the queries' station-days into save_dir, each once, and write a view per query.
+    queries: normalized queries (see load_queries), options: keyword arguments of the download classes (see cli.source_options).
+    Returns {query name: [result dict per day, see BaseDownloadClass.download_deployments]}.
+    """
+    from .downloader import source_classes
+    from .profiling import StageProfiler
+    from .reports import write_json
+
+    if profiler is None:
+        profiler = StageProfiler()
+    views_dir = views_dir or os.path.join(save_dir, VIEWS_DIRNAME)
+
+    query_keys = {query['name']: [] for query in queries}
+    results = {}
+    requested = 0
+    for source, download_class in source_classes().items():
+        with profiler.stage(f"discover_{source}"):
+            download_class = download_class(**(options or {}))
+            download_class.discover()
+
+        union = {}
+        for query in queries:
+            deployments = download_class.filter_deployments(query['min_lat'], query['max_lat'], query['min_lon'], query['max_lon'],
+                                                            query['min_depth'], query['max_depth'], query['license'],
+                                                            query['start_time'], query['end_time'])
+            for deployment in deployments:
+                key = deployment_key(deployment)
+                query_keys[query['name']].append(key)
+                union.setdefault(key, deployment)
+            requested += len(deployments)
+
+        deployments = shard_deployments(list(union.values()), shard_index, shard_count)
+        if len(deployments) == 0:
+            print(f"No data from {source} is available for the queries.")
+            continue
+        with profiler.stage(f"download_{source}"):
+            print(f"Downloading {len(deployments)} {source} station-days for {len(queries)} queries")
+            for result in download_class.download_deployments(deployments, save_dir):
+                results[(result['source'], result['station'], result['date'])] = result
+
+    print(f"{len(queries)} queries matched {requested} station-days, {len(set(k for keys in query_keys.values() for k in keys))} "
+          f"distinct, {len(results)} downloaded in this run (shard {shard_index} of {shard_count})")
+
+    # the views are built from the catalog, which knows the folder and status of every day in save_dir
+    from .catalog import Catalog
+
+    recorded = {(row['source'], row['station'], row['date']): row for row in Catalog(save_dir).days(status=None)}
+    per_query = {}
+    for query in queries:
+        name = query['name']
+        view_dir = os.path.join(views_dir, name)
+        days = []
+        for key in query_keys[name]:
+            # this run's result, or the status the day was last recorded with
+            result = results.get(key) or recorded.get(key)
+            directory = None if key not in recorded else recorded[key]['directory']
+            if directory is not None and os.path.isdir(os.path.join(save_dir, directory)):
+                link_view(view_dir, save_dir, directory)
+            days.append({'source': key[0], 'station': key[1], 'date': key[2], 'directory': directory,
+                         'status': 'not downloaded' if result is None else result['status'],
+                         'error': None if result is None else result['error']})
+        per_query[name] = days
+        os.makedirs(view_dir, exist_ok=True)
+        write_json(os.path.join(view_dir, 'query.json'), {'created': datetime.now().isoformat(timespec='seconds'),
+                                                          'save_dir': os.path.abspath(save_dir), 'query': query, 'days': days})
+        failed = sum(day['status'] != 'done' for day in days)
+        print(f"{name}: {len(days)} station-days in {view_dir}" + (f", {failed} not available" if failed else ""))
+    return per_query
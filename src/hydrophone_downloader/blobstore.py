@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+blobstore.py
+
+ a content-addressed store shared by every save_dir, so overlapping queries from different projects keep one copy of each file
+ and download it once. Files live in <blob_store>/objects/<sha256[:2]>/<sha256><ext>, the save_dir trees hold hard links
+ (reflinks or, across filesystems, copies) to them. The index maps each remote file (its URL, a validator such as the listed
+ size, and the variant of the processing, e.g. the target sample rate) to the object holding its final form.
+ Objects are read-only, since writing to a hard link would change the file in every project.
+ The LTSA rows of a file (see spectral.py) are kept in the index with it, since they are computed from the native rate samples
+ a resampled object no longer has.
+"""
+
+import os
+import stat
+import time
+import shutil
+import sqlite3
+from contextlib import closing
+
+
+INDEX_FILENAME = 'index.sqlite'
+# from linux/fs.h
+FICLONE = 0x40049409
+
+
+def blob_key(url, validator=None, variant=None):
+    """
+    Index key of a remote file: the URL (without credentials), something that changes when the remote file does (the listed
+    size), and how it was processed locally
+    """
+    return f"{url}|{validator}|{variant}"
+
+
+def reflink(source, destination):
+    """
+    Copy-on-write clone (btrfs, XFS), raises OSError where the filesystem does not support it
+    """
+    import fcntl
+
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def link_file(source, destination):
+    """
+    Make destination the same file as source: a hard link, else a reflink, else a copy. Returns how it was made.
+    """
+    tmp_filename = destination + '.tmp'
+    if os.path.exists(tmp_filename):
+        os.remove(tmp_filename)
+    method = None
+    for method, make in (('hardlink', os.link), ('reflink', reflink), ('copy', shutil.copy2)):
+        try:
+            make(source, tmp_filename)
+            break
+        except OSError:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            if method == 'copy':
+                raise
+    os.replace(tmp_filename, destination)
+    return method
+
+
+class BlobStore:
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+        self.path = os.path.join(root, INDEX_FILENAME)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS blobs (
+                key TEXT PRIMARY KEY,
+                sha256 TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                extension TEXT NOT NULL,
+                source TEXT,
+                recorded REAL
+            )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS blobs_sha256 ON blobs (sha256)")
+            conn.execute("""CREATE TABLE IF NOT EXISTS ltsa (
+                key TEXT PRIMARY KEY,
+                data BLOB NOT NULL,
+                recorded REAL
+            )""")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def object_path(self, sha256, extension):
+        return os.path.join(self.root, 'objects', sha256[:2], sha256 + extension)
+
+    def lookup(self, key):
+        """
+        {'sha256', 'size', 'extension', 'path', ...} of the object stored for key, None if no project has it yet
+        """
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT * FROM blobs WHERE key=?", (key,)).fetchone()
+        if row is None:
+            return None
+        blob = dict(row, path=self.object_path(row['sha256'], row['extension']))
+        if not os.path.exists(blob['path']):
+            # pruned or removed by hand
+            with closing(self._connect()) as conn, conn:
+                conn.execute("DELETE FROM blobs WHERE key=?", (key,))
+            return None
+        return blob
+
+    def link(self, blob, destination):
+        """
+        Link the object into a save_dir tree, destination is the local path without its extension. Returns the linked path.
+        """
+        path = destination + blob['extension']
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        link_file(blob['path'], path)
+        return path
+
+    def add(self, key, path, sha256=None, source=None):
+        """
+        Store the final form of a remote file. path becomes a link to the object, replaced by a link to the existing object
+        if another key already stored the same content. Returns the sha256.
+        """
+        from .manifest import hash_file
+
+        if sha256 is None:
+            sha256 = hash_file(path)
+        extension = os.path.splitext(path)[1]
+        object_path = self.object_path(sha256, extension)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        if os.path.exists(object_path):
+            link_file(object_path, path)
+        else:
+            link_file(path, object_path + '.part')
+            os.chmod(object_path + '.part', stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.replace(object_path + '.part', object_path)
+            if not os.path.samefile(path, object_path):
+                # reflinked or copied, point path at the object so its permissions and later pruning apply to it
+                link_file(object_path, path)
+
+        with closing(self._connect()) as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO blobs (key, sha256, size, extension, source, recorded) VALUES (?, ?, ?, ?, ?, ?)",
+                         (key, sha256, os.path.getsize(object_path), extension, source, time.time()))
+        return sha256
+
+    def add_ltsa(self, key, result):
+        """
+        Keep the LTSA arrays (see spectral.LTSAAccumulator.finalize) of the file stored for key
+        """
+        import io
+        import numpy as np
+
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **result)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO ltsa (key, data, recorded) VALUES (?, ?, ?)", (key, buffer.getvalue(), time.time()))
+
+    def lookup_ltsa(self, key):
+        """
+        The LTSA arrays kept for key, None if the file was stored without them
+        """
+        import io
+        import numpy as np
+
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT data FROM ltsa WHERE key=?", (key,)).fetchone()
+        if row is None:
+            return None
+        with np.load(io.BytesIO(row['data'])) as f:
+            return {k: f[k] for k in f.files}
+
+    def prune(self):
+        """
+        Delete the objects no save_dir links to anymore (a link count of 1). Objects that were copied or reflinked into a tree
+        are not hard links, so they are kept. Returns the bytes freed.
+        """
+        freed = 0
+        removed = []
+        for directory, _, filenames in os.walk(os.path.join(self.root, 'objects')):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                if filename.endswith('.part'):
+                    continue
+                st = os.stat(path)
+                if st.st_nlink == 1:
+                    os.remove(path)
+                    freed += st.st_size
+                    removed.append(os.path.splitext(filename)[0])
+
+        with closing(self._connect()) as conn, conn:
+            for sha256 in removed:
+                conn.execute("DELETE FROM blobs WHERE sha256=?", (sha256,))
+            conn.execute("DELETE FROM ltsa WHERE key NOT IN (SELECT key FROM blobs)")
+        print(f"Pruned {len(removed)} objects no save_dir links to, freed {freed/1e9:.2f} GB")
+        return freed
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+cache.py
+
+ a size cap on the raw tier of save_dir: the mseed and per-file (5 minute) FLAC/WAV downloads recorded in the manifest. When they
+ add up to more than the cap, the least recently used are deleted first. The access times come from the manifest (downloads,
+ merges, envelopes, sonifications and datasets update them), not from the filesystem atime.
+
+ Merged outputs (anything under a merged/ folder) and derived products (LTSA, envelopes, metadata and anything else that is not
+ a raw download in the manifest) are pinned and never evicted. Evicted files stay in the manifest with their URL, marked evicted,
+ and are downloaded again by a later query that needs them.
+"""
+
+import os
+
+from .manifest import Manifest, MANIFEST_FILENAME
+
+
+RAW_EXTENSIONS = ('.mseed', '.flac', '.wav')
+PINNED_DIRECTORIES = ('merged',)
+
+
+def is_pinned(relative_path):
+    parts = relative_path.replace(os.sep, '/').split('/')
+    return not relative_path.endswith(RAW_EXTENSIONS) or any(part in PINNED_DIRECTORIES for part in parts[:-1])
+
+
+def find_manifest(path):
+    """
+    The save_dir holding the manifest that covers path (the nearest parent with one), None if there is none
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    while True:
+        if os.path.exists(os.path.join(directory, MANIFEST_FILENAME)):
+            return directory
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+
+
+def record_access(paths):
+    """
+    Mark the files as used now in their manifests, files outside any save_dir are ignored
+    """
+    by_save_dir = {}
+    directories = {}
+    for path in paths:
+        directory = os.path.dirname(os.path.abspath(path))
+        if directory not in directories:
+            directories[directory] = find_manifest(path)
+        if directories[directory] is not None:
+            by_save_dir.setdefault(directories[directory], []).append(path)
+    for save_dir, save_dir_paths in by_save_dir.items():
+        try:
+            Manifest(save_dir).touch(save_dir_paths)
+        except Exception as e:
+            # access tracking must never stop a merge or a render
+            print(f"Could not record the access to {len(save_dir_paths)} files in {save_dir}: {e}")
+
+
+def evict_lru(save_dir, cap_bytes, manifest=None, dry_run=False):
+    """
+    Delete least recently used raw files of save_dir until the raw tier fits in cap_bytes.
+    Returns {'raw_bytes', 'evicted': [relative paths], 'freed_bytes'}.
+    """
+    if manifest is None:
+        if not os.path.exists(os.path.join(save_dir, MANIFEST_FILENAME)):
+            return {'raw_bytes': 0, 'evicted': [], 'freed_bytes': 0}
+        manifest = Manifest(save_dir)
+
+    candidates = []
+    for row in manifest.files():
+        if is_pinned(row['path']):
+            continue
+        path = os.path.join(save_dir, row['path'])
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            # deleted by hand, verify reports it
+            continue
+        candidates.append((row['accessed'] or row['recorded'] or 0, path, row['path'], size))
+
+    raw_bytes = sum(size for _, _, _, size in candidates)
+    result = {'raw_bytes': raw_bytes, 'evicted': [], 'freed_bytes': 0}
+    excess = raw_bytes - cap_bytes
+    if excess <= 0:
+        return result
+
+    for _, path, relative, size in sorted(candidates):
+        if result['freed_bytes'] >= excess:
+            break
+        if not dry_run:
+            try:
+                os.remove(path)
+            except OSError as e:
+                print(f"Could not evict {path}: {e}")
+                continue
+            manifest.mark_evicted(path)
+        result['evicted'].append(relative)
+        result['freed_bytes'] += size
+
+    print(f"{'Would evict' if dry_run else 'Evicted'} {len(result['evicted'])} raw files ({result['freed_bytes']/1e9:.2f} GB) "
+          f"least recently used, the raw tier of {save_dir} was {raw_bytes/1e9:.2f} GB for a cap of {cap_bytes/1e9:.2f} GB")
+    return result
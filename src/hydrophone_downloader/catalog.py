@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+catalog.py
+
+ one append-only record per downloaded station-day, in <save_dir>/.catalog.sqlite: provenance (when, which code version), the
+ citation, the ONC filters or the OOI URL the day came from, and the files of its folder. It replaces the metadata.json,
+ bibtex.txt, filters.json and reference.bib files each day folder used to get, so listing what save_dir holds is one query
+ instead of globbing thousands of small files, and citations are exported on demand:
+
+    hydrophone-downloader-catalog save_dir=...      # per-station inventory (imports the sidecar files of older downloads)
+    hydrophone-downloader-citations save_dir=...    # <save_dir>/references.bib
+
+ A day downloaded again gets a new row, the latest row of each (source, station, date) describes what is on disk. A day whose
+ fetch failed or left files missing is recorded with status 'failed' (and the error), the listings and citations only count
+ days whose latest row is 'done'.
+"""
+
+import os
+import re
+import json
+import glob
+import sqlite3
+from contextlib import closing
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+from .work_queue import json_default
+
+
+CATALOG_FILENAME = '.catalog.sqlite'
+# sidecar files written per day folder before the catalog
+SIDECAR_FILES = ('metadata.json', 'bibtex.txt', 'filters.json', 'reference.bib')
+
+
+@lru_cache(maxsize=None)
+def git_version():
+    """
+    The commit of the checkout this package runs from, resolved once per process. None for an installed copy without .git
+    """
+    try:
+        import git
+
+        return git.Repo(os.path.abspath(__file__), search_parent_directories=True).head.object.hexsha
+    except Exception:
+        return None
+
+
+class Catalog:
+    def __init__(self, save_dir):
+        self.save_dir = save_dir
+        os.makedirs(save_dir, exist_ok=True)
+        self.path = os.path.join(save_dir, CATALOG_FILENAME)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS days (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                source TEXT NOT NULL,
+                station TEXT NOT NULL,
+                date TEXT NOT NULL,
+                directory TEXT NOT NULL,
+                recorded TEXT NOT NULL,
+                git_version TEXT,
+                url TEXT,
+                citation TEXT,
+                filters TEXT,
+                deployment TEXT,
+                files TEXT,
+                n_files INTEGER,
+                bytes INTEGER,
+                status TEXT NOT NULL DEFAULT 'done',
+                error TEXT
+            )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS days_key ON days (source, station, date)")
+            # catalogs written before failed days were recorded
+            columns = {row['name'] for row in conn.execute("PRAGMA table_info(days)")}
+            if 'status' not in columns:
+                conn.execute("ALTER TABLE days ADD COLUMN status TEXT NOT NULL DEFAULT 'done'")
+            if 'error' not in columns:
+                conn.execute("ALTER TABLE days ADD COLUMN error TEXT")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def relative(self, path):
+        return os.path.relpath(os.path.abspath(path), os.path.abspath(self.save_dir))
+
+    def record(self, source, station, date, directory, url=None, citation=None, filters=None, deployment=None, recorded=None,
+               version=None, status='done', error=None):
+        """
+        Append the row of a downloaded day, its file inventory is the folder listing (hidden and sidecar files left out).
+        version: the git commit of the code that downloaded it, default this run's, '' for unknown
+        status: 'done', or 'failed' with the error for a day that did not fully arrive
+        """
+        files = []
+        if os.path.isdir(directory):
+            with os.scandir(directory) as entries:
+                files = sorted((entry.name, entry.stat().st_size) for entry in entries if entry.is_file() and not entry.name.startswith('.')
+                               and entry.name not in SIDECAR_FILES)
+        if deployment is not None:
+            deployment = {k: v for k, v in deployment.items() if k != 'planned_files'}
+        with closing(self._connect()) as conn, conn:
+            conn.execute("INSERT INTO days (source, station, date, directory, recorded, git_version, url, citation, filters, deployment, "
+                         "files, n_files, bytes, status, error) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (source, station, str(date)[:10], self.relative(directory), recorded or datetime.now().isoformat(timespec='seconds'),
+                          git_version() if version is None else (version or None), url, citation,
+                          None if filters is None else json.dumps(filters, default=json_default),
+                          None if deployment is None else json.dumps(deployment, default=json_default),
+                          json.dumps([name for name, _ in files]), len(files), sum(size for _, size in files), status, error))
+
+    def days(self, source=None, station=None, status='done'):
+        """
+        The latest row of each (source, station, date), oldest day first, with the JSON columns decoded.
+        status: only the days whose latest row has this status, None for all
+        """
+        query = "SELECT * FROM days WHERE id IN (SELECT max(id) FROM days GROUP BY source, station, date)"
+        parameters = []
+        for column, value in (('source', source), ('station', station), ('status', status)):
+            if value is not None:
+                query += f" AND {column}=?"
+                parameters.append(value)
+        with closing(self._connect()) as conn:
+            rows = [dict(row) for row in conn.execute(query + " ORDER BY source, station, date", parameters)]
+        for row in rows:
+            for column in ('filters', 'deployment', 'files'):
+                if row[column] is not None:
+                    row[column] = json.loads(row[column])
+        return rows
+
+    def inventory(self):
+        """
+        Per (source, station): the number of days, first and last day, files and bytes, from the latest row of each day that is done
+        """
+        with closing(self._connect()) as conn:
+            return [dict(row) for row in conn.execute(
+                "SELECT source, station, count(*) AS days, min(date) AS first, max(date) AS last, sum(n_files) AS files, "
+                "sum(bytes) AS bytes FROM days WHERE id IN (SELECT max(id) FROM days GROUP BY source, station, date) "
+                "AND status='done' GROUP BY source, station ORDER BY source, station")]
+
+    def import_sidecars(self, remove=False):
+        """
+        Record the day folders of older downloads from their metadata.json (OOI) or filters.json/reference.bib (ONC) files.
+        Days the catalog already has are skipped. remove: delete the sidecar files once recorded. Returns the days added.
+        """
+        known = {(row['source'], row['station'], row['date']) for row in self.days(status=None)}
+        added = 0
+        for metadata_file in glob.glob(os.path.join(self.save_dir, '**', 'metadata.json'), recursive=True):
+            with open(metadata_file) as f:
+                deployment = json.load(f)
+            key = ('OOI', deployment.get('reference_designator'), str(deployment.get('date'))[:10])
+            directory = os.path.dirname(metadata_file)
+            if key not in known and None not in key:
+                self.record(*key, directory, url=deployment.get('link'), deployment=deployment,
+                            recorded=deployment.get('download_date'), version=deployment.get('git_version') or '')
+                known.add(key)
+                added += 1
+            if remove:
+                self._remove_sidecars(directory)
+
+        # ONC day folders are named YYYY_MM_DD-<locationCode>lat<lat>lon<lon>
+        onc_folder = re.compile(r'^(\d{4})_(\d{2})_(\d{2})-(.+?)lat-?[\d.]+lon-?[\d.]+$')
+        for directory in sorted({os.path.dirname(f) for pattern in ('filters.json', 'reference.bib')
+                                 for f in glob.glob(os.path.join(self.save_dir, '**', pattern), recursive=True)}):
+            match = onc_folder.match(os.path.basename(directory))
+            if match is None:
+                continue
+            key = ('ONC', match.group(4), f"{match.group(1)}-{match.group(2)}-{match.group(3)}")
+            if key not in known:
+                filters, citation = None, None
+                if os.path.exists(os.path.join(directory, 'filters.json')):
+                    with open(os.path.join(directory, 'filters.json')) as f:
+                        filters = json.load(f)
+                if os.path.exists(os.path.join(directory, 'reference.bib')):
+                    with open(os.path.join(directory, 'reference.bib')) as f:
+                        citation = onc_citation_from_bibtex(f.read())
+                recorded = datetime.fromtimestamp(os.path.getmtime(directory)).isoformat(timespec='seconds')
+                self.record(*key, directory, citation=citation, filters=filters, recorded=recorded, version='')
+                known.add(key)
+                added += 1
+            if remove:
+                self._remove_sidecars(directory)
+        print(f"Imported {added} days from sidecar files into {self.path}")
+        return added
+
+    def _remove_sidecars(self, directory):
+        for name in SIDECAR_FILES:
+            path = os.path.join(directory, name)
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def onc_citation_from_bibtex(text):
+    """
+    The ONC citation string ('author. year. title. journal. doi') a reference.bib was made from
+    """
+    fields = dict(re.findall(r'(\w+)=\{(.*?)\}', text))
+    if not all(k in fields for k in ('author', 'year', 'title', 'journal', 'doi')):
+        return None
+    return '. '.join(fields[k] for k in ('author', 'year', 'title', 'journal', 'doi'))
+
+
+def bibtex_escape(text):
+    return str(text).replace('{', '').replace('}', '')
+
+
+def citation_entries(rows):
+    """
+    One BibTeX entry per ONC citation (a DOI covers a deployment) and per OOI instrument, with the date range downloaded
+    """
+    groups = {}
+    for row in rows:
+        if row['source'] == 'ONC':
+            if not row['citation']:
+                continue
+            key = ('ONC', row['station'], row['citation'])
+        else:
+            key = (row['source'], row['station'], None)
+        groups.setdefault(key, []).append(row)
+
+    entries = []
+    for (source, station, citation), group in sorted(groups.items(), key=lambda item: (item[0][0], item[0][1], item[1][0]['date'])):
+        first, last = group[0]['date'], group[-1]['date']
+        name = re.sub(r'[^A-Za-z0-9_.-]', '_', f"{station}_{first}")
+        accessed = max(row['recorded'] for row in group)[:10]
+        if source == 'ONC':
+            parts = citation.split('. ')
+            if len(parts) == 5:
+                author, year, title, journal, doi = (bibtex_escape(p) for p in parts)
+                entries.append(f"@misc{{{name},\n  author={{{author}}},\n  year={{{year}}},\n  title={{{title}}},\n  "
+                               f"journal={{{journal}}},\n  doi={{{doi}}},\n  note={{Data from {first} to {last}, accessed {accessed}}}\n}}")
+            else:
+                entries.append(f"@misc{{{name},\n  author={{Ocean Networks Canada}},\n  note={{{bibtex_escape(citation)}. "
+                               f"Data from {first} to {last}, accessed {accessed}}}\n}}")
+        else:
+            # NSF Ocean Observatories Initiative. (year). Instrument (reference designator) data from (start) to (end). (Repository). (URL). Accessed on (date).
+            # the day folder .../<instrument>/YYYY/MM/DD/ -> the instrument folder
+            url = re.sub(r'\d{4}/\d{2}/\d{2}/?$', '', group[0]['url'] or '')
+            end = (datetime.strptime(last, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+            entries.append(f"@misc{{{name},\n  author={{NSF Ocean Observatories Initiative}},\n  year={{{accessed[:4]}}},\n  "
+                           f"title={{Instrument and/or data product(s) {station} data from {first} to {end}}},\n  "
+                           f"publisher={{Raw Data Archive}},\n  url={{{url}}},\n  note={{Accessed on {accessed}}}\n}}")
+    return entries
+
+
+def export_citations(save_dir, output=None, source=None, station=None):
+    """
+    Write the BibTeX of everything in the catalog of save_dir to output (default <save_dir>/references.bib), returns the filename
+    """
+    entries = citation_entries(Catalog(save_dir).days(source=source, station=station))
+    output = output or os.path.join(save_dir, 'references.bib')
+    with open(output + '.tmp', 'w') as f:
+        f.write('\n\n'.join(entries) + '\n')
+    os.replace(output + '.tmp', output)
+    print(f"Wrote {len(entries)} citations to {output}")
+    return output
@@ -9,11 +9,12 @@ To run as a module:
 
 
 import hydra
+from hydra.core.hydra_config import HydraConfig
 from omegaconf import DictConfig
-from dotenv import load_dotenv, set_key
 import os
 
-from .downloader import download_data
+# heavy modules (obspy, polars, onc, ...) are imported inside the entry points,
+# see "Startup time" in the README before adding module level imports here
 
 
 
@@ -22,11 +23,36 @@ LOCAL_PATH = os.path.abspath(__file__)
 CONFIG_PATH = os.path.join(os.path.dirname(LOCAL_PATH), 'configs')
 
 
+def source_options(cfg: DictConfig):
+    """
+    The options of the download classes, shared by the CLI and the workers.
+    """
+    return {
+        'ltsa': cfg.ltsa,
+        'target_sample_rate': cfg.target_sample_rate,
+        'disk_budget_gb': cfg.disk_budget_gb,
+        'min_free_gb': cfg.min_free_gb,
+        'disk_wait_timeout': cfg.disk_wait_timeout,
+        'http_pool_size': cfg.http_pool_size,
+        'recompress_wav': cfg.recompress_wav,
+        'recompress_workers': cfg.recompress_workers,
+        'in_memory_ingest': cfg.in_memory_ingest,
+        'spool_max_mb': cfg.spool_max_mb,
+        'blob_store': cfg.blob_store,
+        'cache_cap_gb': cfg.cache_cap_gb,
+    }
+
+
 @hydra.main(config_path=CONFIG_PATH, config_name="config", version_base="1.3")
 def main(cfg: DictConfig):
     """
     Main entry point for data download.
     """
+    from .downloader import download_data
+    from .profiling import StageProfiler
+
+    # profiles are written next to the hydra logs, e.g. outputs/<date>/<time>/profile
+    profiler = StageProfiler(cfg.profile, output_dir=os.path.join(HydraConfig.get().runtime.output_dir, 'profile'))
     download_data(
         min_lat=cfg.min_latitude, 
         max_lat=cfg.max_latitude,
@@ -38,13 +64,238 @@ def main(cfg: DictConfig):
         start_time=cfg.start_time,
         end_time=cfg.end_time,
         save_dir=cfg.save_dir,
+        profiler=profiler,
+        shard_index=cfg.shard_index,
+        shard_count=cfg.shard_count,
+        enqueue_only=cfg.enqueue_only,
+        queue_path=cfg.queue_path,
+        plan_only=cfg.plan_only,
+        plan_file=cfg.plan_file,
+        **source_options(cfg),
+    )
+
+@hydra.main(config_path=CONFIG_PATH, config_name="config", version_base="1.3")
+def batch(cfg: DictConfig):
+    """
+    Run every query of queries_file with one discovery, downloading each station-day they share once, see batch.py.
+    """
+    from .batch import load_queries, run_batch
+    from .profiling import StageProfiler
+
+    assert cfg.queries_file is not None, "set queries_file=<queries.yaml or .csv>"
+    profiler = StageProfiler(cfg.profile, output_dir=os.path.join(HydraConfig.get().runtime.output_dir, 'profile'))
+    per_query = run_batch(
+        load_queries(cfg.queries_file),
+        cfg.save_dir,
+        views_dir=cfg.views_dir,
+        options=source_options(cfg),
+        profiler=profiler,
+        shard_index=cfg.shard_index,
+        shard_count=cfg.shard_count,
+    )
+    if any(day['status'] == 'failed' for days in per_query.values() for day in days):
+        raise SystemExit(1)
+
+@hydra.main(config_path=CONFIG_PATH, config_name="config", version_base="1.3")
+def worker(cfg: DictConfig):
+    """
+    Download the tasks queued with enqueue_only=true, with cfg.workers processes. Safe to start several times on the host that owns
+    save_dir, and to restart after a crash: unfinished tasks are handed out again when their lease expires. The queue and the other
+    SQLite files in save_dir use WAL, which needs a local disk, so save_dir must not be shared between machines.
+    """
+    from .work_queue import run_workers, default_queue_path
+
+    run_workers(
+        cfg.queue_path or default_queue_path(cfg.save_dir),
+        workers=cfg.workers,
+        options=source_options(cfg),
+        lease_seconds=cfg.lease_seconds,
+        max_attempts=cfg.max_attempts,
+    )
+
+@hydra.main(config_path=CONFIG_PATH, config_name="config", version_base="1.3")
+def sync(cfg: DictConfig):
+    """
+    Download only what is new since the last sync of save_dir at each station matching the bounds (start_time/end_time are ignored).
+    """
+    from .sync import sync as run_sync
+    from .profiling import StageProfiler
+
+    profiler = StageProfiler(cfg.profile, output_dir=os.path.join(HydraConfig.get().runtime.output_dir, 'profile'))
+    results = run_sync(
+        cfg.save_dir,
+        min_lat=cfg.min_latitude,
+        max_lat=cfg.max_latitude,
+        min_lon=cfg.min_longitude,
+        max_lon=cfg.max_longitude,
+        min_depth=cfg.min_depth,
+        max_depth=cfg.max_depth,
+        license=cfg.license,
+        lookback_days=cfg.sync_lookback_days,
+        since=cfg.sync_since,
+        options=source_options(cfg),
+        profiler=profiler,
     )
+    if any(r['status'] != 'done' for r in results):
+        raise SystemExit(1)
+
+@hydra.main(config_path=CONFIG_PATH, config_name="config", version_base="1.3")
+def merge_reports(cfg: DictConfig):
+    """
+    Combine the per-shard reports in <save_dir>/reports into merged_report.json, run it with the same save_dir as the shards.
+    """
+    from .reports import merge_shard_reports
+
+    merge_shard_reports(cfg.save_dir)
+
+@hydra.main(config_path=CONFIG_PATH, config_name="config", version_base="1.3")
+def verify(cfg: DictConfig):
+    """
+    Check the files in save_dir against the SHA-256 digests recorded while downloading. Only files whose size or mtime changed are
+    read again, unless verify_all=true.
+    """
+    from .manifest import verify_manifest
+
+    result = verify_manifest(cfg.save_dir, full=cfg.verify_all)
+    if result is not None and (result['missing'] or result['corrupt']):
+        raise SystemExit(1)
+
+@hydra.main(config_path=CONFIG_PATH, config_name="config", version_base="1.3")
+def catalog(cfg: DictConfig):
+    """
+    Print what save_dir holds per station from its catalog, catalog_import_sidecars=true first records the day folders of
+    downloads made before the catalog (catalog_remove_sidecars=true then deletes their metadata.json, reference.bib, ... files).
+    """
+    from .catalog import Catalog
+
+    day_catalog = Catalog(cfg.save_dir)
+    if cfg.catalog_import_sidecars:
+        day_catalog.import_sidecars(remove=cfg.catalog_remove_sidecars)
+    for row in day_catalog.inventory():
+        print(f"{row['source']} {row['station']}: {row['days']} days from {row['first']} to {row['last']}, "
+              f"{row['files']} files, {(row['bytes'] or 0)/1e9:.2f} GB")
+    failed = day_catalog.days(status='failed')
+    if failed:
+        print(f"{len(failed)} days failed on their last download, the next run retries them")
+
+@hydra.main(config_path=CONFIG_PATH, config_name="config", version_base="1.3")
+def citations(cfg: DictConfig):
+    """
+    Export the BibTeX citations of everything in the catalog of save_dir to citations_file (default <save_dir>/references.bib).
+    """
+    from .catalog import export_citations
+
+    export_citations(cfg.save_dir, cfg.citations_file)
+
+@hydra.main(config_path=CONFIG_PATH, config_name="config", version_base="1.3")
+def recompress(cfg: DictConfig):
+    """
+    Losslessly recompress every WAV file under save_dir to FLAC, e.g. ONC data downloaded before recompress_wav existed.
+    """
+    from .recompress import recompress_directory
+
+    recompress_directory(cfg.save_dir, workers=cfg.recompress_workers)
+
+@hydra.main(config_path=CONFIG_PATH, config_name="config", version_base="1.3")
+def evict(cfg: DictConfig):
+    """
+    Delete the least recently used raw files of save_dir until they fit in cache_cap_gb, evict_dry_run=true only lists them.
+    """
+    from .cache import evict_lru
+    from .storage import GB
+
+    if cfg.cache_cap_gb is None:
+        print("Set cache_cap_gb=<GB> to evict")
+        raise SystemExit(1)
+    result = evict_lru(cfg.save_dir, cfg.cache_cap_gb * GB, dry_run=cfg.evict_dry_run)
+    for path in result['evicted']:
+        print(f" - {path}")
+
+@hydra.main(config_path=CONFIG_PATH, config_name="config", version_base="1.3")
+def envelopes(cfg: DictConfig):
+    """
+    Build the min/max/RMS envelope pyramid of every station-day under save_dir (the day folders and merged/), next to the audio.
+    """
+    from .envelope import build_envelopes
+
+    build_envelopes(cfg.save_dir, force=cfg.envelopes_force)
+
+@hydra.main(config_path=CONFIG_PATH, config_name="config", version_base="1.3")
+def sonify(cfg: DictConfig):
+    """
+    Render sonify.station between start_time and end_time as time-compressed audio, from the files under save_dir.
+    """
+    from .sonify import sonify as render
+
+    options = cfg.sonify
+    assert options.station is not None, "set sonify.station"
+    output = options.output
+    if output is None:
+        day = cfg.start_time[:10].replace('-', '')
+        compression = f"x{options.speed}" if options.duration_seconds is None else f"{options.duration_seconds}s"
+        output = os.path.join(cfg.save_dir, 'merged', f"{options.station}_{day}_{compression}.{options.format}")
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    render(cfg.save_dir, output, options.station, start_time=cfg.start_time, end_time=cfg.end_time,
+           speed=options.speed if options.duration_seconds is None else None, duration_seconds=options.duration_seconds,
+           band=None if options.band is None else tuple(options.band), shift=options.shift, output_rate=options.sample_rate,
+           workers=options.workers)
+
+@hydra.main(config_path=CONFIG_PATH, config_name="config", version_base="1.3")
+def prune_blobs(cfg: DictConfig):
+    """
+    Delete the objects of blob_store that no save_dir links to anymore, e.g. after a project folder was removed.
+    """
+    from .blobstore import BlobStore
+
+    if cfg.blob_store is None:
+        print("Set blob_store=<directory> to prune it")
+        raise SystemExit(1)
+    BlobStore(cfg.blob_store).prune()
+
+@hydra.main(config_path=CONFIG_PATH, config_name="config", version_base="1.3")
+def serve(cfg: DictConfig):
+    """
+    Run the warm download daemon on serve_socket, jobs are sent to it with hydrophone-downloader-submit.
+    """
+    from .server import serve as run_server
+
+    run_server(cfg.serve_socket, options=source_options(cfg), workers=cfg.serve_workers, catalog_max_age_hours=cfg.catalog_max_age_hours)
+
+@hydra.main(config_path=CONFIG_PATH, config_name="config", version_base="1.3")
+def submit(cfg: DictConfig):
+    """
+    Send the query to the daemon on serve_socket and print its progress events as JSON lines, exits with 1 if anything failed.
+    """
+    import json
+    from .server import submit as submit_job
+
+    query = {
+        'min_lat': cfg.min_latitude,
+        'max_lat': cfg.max_latitude,
+        'min_lon': cfg.min_longitude,
+        'max_lon': cfg.max_longitude,
+        'min_depth': cfg.min_depth,
+        'max_depth': cfg.max_depth,
+        'license': cfg.license,
+        'start_time': cfg.start_time,
+        'end_time': cfg.end_time,
+        'save_dir': os.path.abspath(cfg.save_dir),
+        'plan_file': None if cfg.plan_file is None else os.path.abspath(cfg.plan_file),
+    }
+    ok = False
+    for event in submit_job(query, cfg.serve_socket):
+        print(json.dumps(event, default=str), flush=True)
+        ok = event['event'] == 'done' and event['failed'] == 0
+    if not ok:
+        raise SystemExit(1)
 
 @hydra.main(config_path=CONFIG_PATH, config_name="token_config", version_base="1.3")  # <-- added version_base here to solve warning
 def set_token(cfg: DictConfig):
     """
     Command to set the API token and store it in .env file.
     """
+    from dotenv import set_key
+
     dotenv_file = os.path.join(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)), '.env')
     set_key(dotenv_file, "ONC_TOKEN", cfg.ONC_token)
     print(f"ONC API token set successfully.")
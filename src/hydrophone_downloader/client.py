@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+client.py
+
+ a library API that streams hydrophone audio into memory instead of save_dir, for consumers such as real-time detectors that
+ only need each chunk once:
+
+    from hydrophone_downloader.client import HydrophoneClient
+
+    client = HydrophoneClient(sources=['OOI'], target_sample_rate=16000)
+    for station, start_time, sample_rate, samples in client.stream(min_lat=44, max_lat=46, min_lon=-130, max_lon=-124,
+                                                                   start_time='2024-01-01', end_time='2024-01-01'):
+        detect(samples[:, 0], sample_rate)
+
+    async for chunk in client.astream(...):
+        ...
+
+ Each chunk is one remote file (an OOI mseed file or an ONC archive file), decoded from the HTTP response.
+"""
+
+import queue
+import asyncio
+import threading
+from collections import namedtuple
+
+
+AudioChunk = namedtuple('AudioChunk', ['station', 'start_time', 'sample_rate', 'samples'])
+
+_DONE = object()
+
+
+def prefetch(iterable, size=2):
+    """
+    Iterate over iterable in a background thread, keeping up to `size` items ready. The next files are downloaded and decoded
+    while the consumer works on the current one. Exceptions are raised in the consumer.
+    """
+    items = queue.Queue(maxsize=max(1, size))
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                while not stop.is_set():
+                    try:
+                        items.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+            items.put(_DONE)
+        except BaseException as e:
+            items.put(e)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _DONE:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        # the consumer stopped early, let the producer finish its current item and exit
+        stop.set()
+
+
+class HydrophoneClient:
+    def __init__(self, sources=None, target_sample_rate=None, prefetch=2, http_pool_size=10):
+        """
+        sources: e.g. ['OOI'], default every supported source (ONC needs a token, see hydrophone-downloader-set-token)
+        target_sample_rate: resample chunks above this rate (Hz)
+        prefetch: chunks downloaded and decoded ahead of the consumer
+        """
+        from .downloader import source_classes
+
+        classes = source_classes()
+        self.sources = list(classes) if sources is None else list(sources)
+        self.target_sample_rate = target_sample_rate
+        self.prefetch = prefetch
+        # created on first use, so the ONC token is only needed when ONC is streamed
+        self._classes = classes
+        self._download_classes = {}
+        self.http_pool_size = http_pool_size
+
+    def download_class(self, source):
+        if source not in self._download_classes:
+            self._download_classes[source] = self._classes[source](target_sample_rate=self.target_sample_rate, http_pool_size=self.http_pool_size)
+        return self._download_classes[source]
+
+    def deployments(self, min_lat=-90, max_lat=90, min_lon=-180, max_lon=180, min_depth=0, max_depth=12000, license=None, start_time=None, end_time=None):
+        """
+        [(source, deployment), ...] matching the query, ordered by date. start_time and end_time are 'YYYY-MM-DD' days (inclusive).
+        Discovery runs once per source and client.
+        """
+        assert start_time is not None and end_time is not None, "start_time and end_time are required"
+        deployments = []
+        for source in self.sources:
+            for deployment in self.download_class(source).filter_deployments(min_lat, max_lat, min_lon, max_lon, min_depth, max_depth, license, start_time, end_time):
+                deployments.append((source, deployment))
+        return sorted(deployments, key=lambda item: item[1]['date'])
+
+    def _chunks(self, deployments):
+        from .resample import resample_channels
+
+        for source, deployment in deployments:
+            for station, start_time, sample_rate, samples in self.download_class(source).stream_deployment(deployment):
+                if self.target_sample_rate is not None and self.target_sample_rate < sample_rate:
+                    samples = resample_channels(samples, sample_rate, self.target_sample_rate)
+                    sample_rate = self.target_sample_rate
+                yield AudioChunk(station, start_time, sample_rate, samples)
+
+    def stream(self, **query):
+        """
+        Generator of AudioChunk(station, start_time, sample_rate, samples) for the query (the keywords of deployments()),
+        samples has shape (n_frames, n_channels). Nothing is written to disk.
+        """
+        chunks = self._chunks(self.deployments(**query))
+        if self.prefetch > 0:
+            chunks = prefetch(chunks, self.prefetch)
+        return chunks
+
+    async def astream(self, **query):
+        """
+        Async variant of stream(), the downloads and decoding run in worker threads so the event loop is never blocked.
+        """
+        chunks = await asyncio.to_thread(self.stream, **query)
+        while True:
+            chunk = await asyncio.to_thread(next, chunks, _DONE)
+            if chunk is _DONE:
+                return
+            yield chunk
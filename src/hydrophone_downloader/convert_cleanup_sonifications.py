@@ -11,6 +11,16 @@ import shutil
 from collections import defaultdict
 from datetime import datetime
 
+try:
+    from .profiling import StageProfiler
+    from .cache import record_access
+    from .audio_io import parse_formats, output_filenames, export_segment, check_output
+except ImportError:
+    # run as a script rather than with python -m
+    from hydrophone_downloader.profiling import StageProfiler
+    from hydrophone_downloader.cache import record_access
+    from hydrophone_downloader.audio_io import parse_formats, output_filenames, export_segment, check_output
+
 # Dynamically determine the default sonifications directory
 DEFAULT_SONIFICATIONS_DIR = os.path.abspath(
     os.path.join(os.path.dirname(__file__), "..", "..", "sonifications")
@@ -50,8 +60,10 @@ def group_files_by_hydrophone(flac_files):
         hydrophone_groups[hydrophone_name].append(audio_file)
     return hydrophone_groups
 
-def convert_and_merge_batches(hydrophone_groups, target_format, merged_dir, summary, station_folder):
-    """Convert and merge .flac files in batches per hydrophone."""
+def convert_and_merge_batches(hydrophone_groups, target_formats, merged_dir, summary, station_folder):
+    """Convert and merge .flac files in batches per hydrophone.
+    target_formats: e.g. 'flac,mp3:320k', each batch is decoded once and encoded to every format at the same time."""
+    formats = parse_formats(target_formats)
     os.makedirs(merged_dir, exist_ok=True)
     for hydrophone_name, files in hydrophone_groups.items():
         files = sorted(files)
@@ -75,11 +87,11 @@ def convert_and_merge_batches(hydrophone_groups, target_format, merged_dir, summ
                 summary["errors"].append(f"Timestamp error in {hydrophone_name} batch: {e}")
                 continue
 
-            merged_filename = f"{hydrophone_name}_{start_date}T{start_time}_to_{end_time}.{target_format}"
-            merged_filepath = os.path.join(merged_dir, merged_filename)
+            merged_base = os.path.join(merged_dir, f"{hydrophone_name}_{start_date}T{start_time}_to_{end_time}")
+            outputs = [output for output in output_filenames(merged_base, formats) if not os.path.exists(output[0])]
 
-            if os.path.exists(merged_filepath):
-                print(f"{Fore.LIGHTYELLOW_EX}Merged file already exists: {merged_filepath}. Skipping this batch.")
+            if not outputs:
+                print(f"{Fore.LIGHTYELLOW_EX}Merged files already exist: {merged_base}.*. Skipping this batch.")
                 continue
 
             merged_audio = AudioSegment.empty()
@@ -114,15 +126,20 @@ def convert_and_merge_batches(hydrophone_groups, target_format, merged_dir, summ
                 break
 
             try:
-                if target_format == "wav":
-                    merged_audio.export(merged_filepath, format="wav")
-                else:
-                    merged_audio.export(merged_filepath, format="mp3", bitrate="320k")
-                print(f"{Fore.GREEN}Merged batch saved as: {merged_filepath}")
+                merged_filepaths = export_segment(merged_audio, outputs)
+                print(f"{Fore.GREEN}Merged batch saved as: {', '.join(merged_filepaths)}")
                 summary["converted"] += 1
+                record_access(valid_files)
 
-                # Only delete originals if merged file exists and is not empty
-                if os.path.exists(merged_filepath) and os.path.getsize(merged_filepath) > 0:
+                # Only delete originals if every merged file is complete, a failed one is removed on its own
+                problems = {f: check_output(f, len(merged_audio) / 1000) for f in merged_filepaths}
+                for merged_filepath, problem in problems.items():
+                    if problem is not None:
+                        print(f"{Fore.RED}Validation failed: {merged_filepath} is {problem}")
+                        summary["errors"].append(f"{merged_filepath}: {problem}")
+                        if os.path.exists(merged_filepath):
+                            os.remove(merged_filepath)
+                if all(problem is None for problem in problems.values()):
                     for flac_file in valid_files:
                         try:
                             os.remove(flac_file)
@@ -132,15 +149,24 @@ def convert_and_merge_batches(hydrophone_groups, target_format, merged_dir, summ
                             print(f"{Fore.RED}Error deleting file: {flac_file}: {e}")
                             summary["errors"].append(f"{flac_file}: {e}")
                 else:
-                    print(f"{Fore.RED}Merged file missing or empty, originals NOT deleted for batch: {merged_filepath}")
+                    print(f"{Fore.RED}Merged file failed validation, originals NOT deleted for batch: {merged_base}")
             except Exception as e:
                 print(f"{Fore.RED}Error exporting merged batch for hydrophone {hydrophone_name}: {e}")
-                summary["errors"].append(f"Export error for {merged_filepath}: {e}")
+                summary["errors"].append(f"Export error for {merged_base}: {e}")
 
-def main():
+def main(profile=None, profile_dir=None, envelopes=False, formats=None):
+    """
+    formats: output formats for every folder, e.g. 'flac,mp3:320k' (format[:bitrate], comma separated). None asks per folder
+    envelopes: build the min/max/RMS envelope pyramid of each station-day next to the merged files at the end
+    profile: null, cprofile or sampling. Each folder is profiled as a convert_<folder> stage into profile_dir (default <sonifications_dir>/merged/profile)
+    """
     check_ffmpeg()
+    if formats is not None:
+        # fail before the first folder rather than asking again forever
+        parse_formats(formats)
     merged_dir = os.path.join(sonifications_dir, "merged")
     os.makedirs(merged_dir, exist_ok=True)
+    profiler = StageProfiler(profile, output_dir=profile_dir or os.path.join(merged_dir, "profile"))
 
     print(f"Scanning sonifications_dir: {sonifications_dir}")
 
@@ -153,7 +179,8 @@ def main():
 
     for folder_name in os.listdir(sonifications_dir):
         folder_path = os.path.join(sonifications_dir, folder_name)
-        if not os.path.isdir(folder_path) or folder_name == "merged":
+        # hidden folders hold links (e.g. the .queries views of a batch), merging through them would delete the originals
+        if not os.path.isdir(folder_path) or folder_name == "merged" or folder_name.startswith("."):
             continue
 
         flac_files_full = sorted(glob.glob(os.path.join(folder_path, "**", "*.flac"), recursive=True))
@@ -171,20 +198,25 @@ def main():
         }
 
         while True:
-            choice = input(f"Convert and merge files in '{folder_path}' to (wav/mp3/skip)? ").strip().lower()
-            if choice in ("wav", "mp3"):
+            choice = formats or input(f"Convert and merge files in '{folder_path}' to (wav/mp3/flac, several like flac,mp3:320k, or skip)? ").strip().lower()
+            try:
+                valid = choice != "skip" and bool(parse_formats(choice))
+            except ValueError:
+                valid = False
+            if valid:
                 if check_disk_space(merged_dir) < 1:
                     print(f"{Fore.RED}Insufficient disk space. Stopping conversion.")
                     break
-                hydrophone_groups = group_files_by_hydrophone(flac_files_full)
-                convert_and_merge_batches(hydrophone_groups, choice, merged_dir, summary, folder_name)
+                with profiler.stage(f"convert_{folder_name}"):
+                    hydrophone_groups = group_files_by_hydrophone(flac_files_full)
+                    convert_and_merge_batches(hydrophone_groups, choice, merged_dir, summary, folder_name)
                 print(f"{Fore.GREEN}All .flac files in {folder_path} converted, merged to {choice} in {merged_dir} and originals deleted.")
                 break
             elif choice == "skip":
                 print(f"{Fore.YELLOW}Skipping folder {folder_path}.")
                 break
             else:
-                print("Invalid choice. Please enter 'wav', 'mp3', or 'skip'.")
+                print("Invalid choice. Please enter formats such as 'wav', 'mp3', 'flac,mp3:320k', or 'skip'.")
 
         # Remove temp folder if empty and it's a tmp_* folder
         if folder_name.startswith("tmp_") and not os.listdir(folder_path):
@@ -199,6 +231,15 @@ def main():
         total_summary["skipped"] += summary["skipped"]
         total_summary["errors"].extend(summary["errors"])
 
+    if envelopes:
+        try:
+            from .envelope import build_envelopes
+        except ImportError:
+            from hydrophone_downloader.envelope import build_envelopes
+
+        with profiler.stage("envelopes"):
+            build_envelopes(merged_dir)
+
     print("\nSummary of operations:")
     print(f"Total merged batches: {total_summary['converted']}")
     print(f"Total deleted: {total_summary['deleted']}")
@@ -210,4 +251,14 @@ def main():
     print(f"{Fore.YELLOW}NOTE: Temporary folders (tmp_*) are managed by the script. Do not manually add files here.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Convert, merge and clean up sonification folders.")
+    parser.add_argument("--profile", choices=["cprofile", "sampling"], default=None, help="Profile each folder conversion")
+    parser.add_argument("--profile-dir", type=str, default=None, help="Where to write profiles (default: <sonifications>/merged/profile)")
+    parser.add_argument("--envelopes", action="store_true", help="Build waveform preview envelopes of the merged files")
+    parser.add_argument("--formats", type=str, default=None,
+                        help="Output formats for every folder, e.g. flac,mp3:320k,mp3:128k (default: ask per folder)")
+    args = parser.parse_args()
+
+    main(profile=args.profile, profile_dir=args.profile_dir, envelopes=args.envelopes, formats=args.formats)
\ No newline at end of file
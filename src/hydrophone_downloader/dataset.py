@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+dataset.py
+
+ fixed-length (optionally overlapping) windows over downloaded audio, for training models:
+
+    from hydrophone_downloader.dataset import WindowDataset
+
+    dataset = WindowDataset(['sonifications/merged', 'data/'], window_seconds=5, hop_seconds=2.5, sample_rate=64000)
+    for batch in dataset.iterate(shuffle=True, seed=0, batch_size=32, prefetch=64, workers=8):
+        ...  # (32, frames, channels) float32
+
+ Only the file headers are read to build the index (WAV fmt/data chunks, FLAC STREAMINFO). A window reads just its own bytes
+ from a WAV, or has ffmpeg seek and decode just those seconds of a FLAC, instead of decoding the whole file.
+ WindowDataset has __len__ and __getitem__, so it can also be wrapped by a torch DataLoader.
+"""
+
+import os
+import re
+import glob
+import struct
+import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+
+
+AUDIO_EXTENSIONS = ('.wav', '.flac')
+# merged files are named <hydrophone>_<YYYYMMDD>T<HHMMSS>_to_<HHMMSS>.<ext>
+MERGED_TIMESTAMP = re.compile(r'_(\d{8}T\d{6})_to_')
+
+
+def wav_info(path):
+    """
+    Parse the RIFF header: {'format', 'sample_rate', 'channels', 'sample_width', 'data_offset', 'n_frames'}
+    """
+    with open(path, 'rb') as f:
+        riff, _, wave_id = struct.unpack('<4sI4s', f.read(12))
+        if riff != b'RIFF' or wave_id != b'WAVE':
+            raise ValueError(f"{path} is not a RIFF/WAVE file")
+        info = {}
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError(f"{path} has no data chunk")
+            chunk_id, size = struct.unpack('<4sI', header)
+            if chunk_id == b'fmt ':
+                fmt = f.read(size)
+                format_tag, channels, sample_rate, _, _, bits = struct.unpack('<HHIIHH', fmt[:16])
+                if format_tag == 0xFFFE and len(fmt) >= 26:
+                    # WAVE_FORMAT_EXTENSIBLE, the actual format is the first two bytes of the subformat GUID
+                    format_tag = struct.unpack('<H', fmt[24:26])[0]
+                info.update(format=format_tag, sample_rate=sample_rate, channels=channels, sample_width=bits // 8)
+            elif chunk_id == b'data':
+                if 'sample_rate' not in info:
+                    raise ValueError(f"{path} has no fmt chunk before its data")
+                data_size = min(size, os.path.getsize(path) - f.tell())
+                info.update(data_offset=f.tell(), n_frames=data_size // (info['channels'] * info['sample_width']))
+                return info
+            else:
+                f.seek(size + (size & 1), 1)
+                continue
+            if size & 1:
+                f.seek(1, 1)
+
+
+def flac_info(path):
+    """
+    Parse the STREAMINFO block: {'sample_rate', 'channels', 'bits', 'n_frames'}
+    """
+    with open(path, 'rb') as f:
+        data = f.read(42)
+    if data[:4] != b'fLaC' or data[4] & 0x7F != 0:
+        raise ValueError(f"{path} does not start with a FLAC STREAMINFO block")
+    fields = int.from_bytes(data[18:26], 'big')
+    return {
+        'sample_rate': fields >> 44,
+        'channels': ((fields >> 41) & 0x7) + 1,
+        'bits': ((fields >> 36) & 0x1F) + 1,
+        'n_frames': fields & ((1 << 36) - 1),
+    }
+
+
+def pcm_to_array(raw, sample_width, channels, format_tag=1):
+    """
+    Little endian PCM bytes to an (n_frames, channels) array, 24 bit samples are widened to int32
+    """
+    if format_tag == 3:
+        samples = np.frombuffer(raw, dtype={4: '<f4', 8: '<f8'}[sample_width])
+    elif sample_width == 1:
+        samples = np.frombuffer(raw, dtype=np.uint8).astype(np.int16) - 128
+    elif sample_width == 3:
+        padded = np.zeros((len(raw) // 3, 4), dtype=np.uint8)
+        padded[:, 1:] = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 3)
+        samples = padded.view('<i4').ravel() >> 8
+    else:
+        samples = np.frombuffer(raw, dtype={2: '<i2', 4: '<i4'}[sample_width])
+    return samples.reshape(-1, channels)
+
+
+def file_start_time(path):
+    """
+    UTC datetime of the first sample, from the ONC, OOI or merged file name, None if the name does not carry it
+    """
+    from .audio_io import onc_start_time, ooi_start_time
+
+    timestamp = onc_start_time(path)
+    if timestamp is not None:
+        return datetime.fromtimestamp(timestamp, timezone.utc)
+    match = MERGED_TIMESTAMP.search(os.path.basename(path))
+    if match is not None:
+        return datetime.strptime(match.group(1), '%Y%m%dT%H%M%S').replace(tzinfo=timezone.utc)
+    timestamp = ooi_start_time(path)
+    if timestamp is not None:
+        return datetime.fromtimestamp(timestamp, timezone.utc)
+    return None
+
+
+def probe(path):
+    """
+    Header information of a WAV or FLAC file: {'path', 'kind', 'sample_rate', 'channels', 'n_frames', 'scale', ...}
+    scale converts the integer samples to [-1, 1).
+    """
+    if path.endswith('.wav'):
+        info = dict(wav_info(path), kind='wav')
+        info['scale'] = 1.0 if info['format'] == 3 else 2.0 ** (8 * info['sample_width'] - 1)
+    elif path.endswith('.flac'):
+        info = dict(flac_info(path), kind='flac')
+        info['scale'] = 2.0 ** (info['bits'] - 1)
+    else:
+        raise ValueError(f"Unsupported audio file {path}")
+    info['path'] = path
+    return info
+
+
+def find_audio_files(roots):
+    """
+    The WAV and FLAC files under each root (a directory, searched recursively, or a file)
+    """
+    if isinstance(roots, str):
+        roots = [roots]
+    filenames = []
+    for root in roots:
+        if os.path.isfile(root):
+            filenames.append(root)
+            continue
+        for extension in AUDIO_EXTENSIONS:
+            filenames += glob.glob(os.path.join(root, '**', f'*{extension}'), recursive=True)
+    return sorted(set(filenames))
+
+
+def read_frames(info, start_frame, n_frames):
+    """
+    n_frames integer frames of a probed file from start_frame, as (n_frames, channels). A WAV is read with one seek, ffmpeg seeks
+    with the FLAC seek table and trims to the exact sample. Frames past the end of the file are zeros.
+    """
+    if info['kind'] == 'wav':
+        frame_bytes = info['channels'] * info['sample_width']
+        with open(info['path'], 'rb') as f:
+            f.seek(info['data_offset'] + start_frame * frame_bytes)
+            raw = f.read(n_frames * frame_bytes)
+        samples = pcm_to_array(raw[:len(raw) // frame_bytes * frame_bytes], info['sample_width'], info['channels'], info['format'])
+    else:
+        codec, dtype = ('s16le', '<i2') if info['bits'] <= 16 else ('s32le', '<i4')
+        output = subprocess.run(
+            ['ffmpeg', '-v', 'error', '-ss', f"{start_frame / info['sample_rate']:.9f}", '-i', info['path'],
+             '-t', f"{n_frames / info['sample_rate']:.9f}", '-map', '0:a', '-f', codec, '-c:a', f'pcm_{codec}', '-'],
+            check=True, capture_output=True,
+        ).stdout
+        samples = np.frombuffer(output, dtype=dtype).reshape(-1, info['channels'])
+        if info['bits'] > 16:
+            # ffmpeg returns 17-24 bit audio in the upper bits of int32
+            samples = samples >> (32 - info['bits'])
+
+    if len(samples) < n_frames:
+        # the header promised more frames than the file holds (e.g. a truncated file)
+        samples = np.concatenate([samples, np.zeros((n_frames - len(samples), info['channels']), dtype=samples.dtype)])
+    return samples[:n_frames]
+
+
+class WindowDataset:
+    def __init__(self, roots, window_seconds, hop_seconds=None, sample_rate=None, channels=None, normalize=True):
+        """
+        roots: directories (e.g. merged/ and save_dir with its per-day folders) or files
+        window_seconds, hop_seconds: window length and the step between window starts, hop_seconds < window_seconds overlaps windows
+            (default: hop_seconds = window_seconds). The last partial window of a file is dropped.
+        sample_rate, channels: only use files with this rate and channel count, batches need every window to have the same shape
+        normalize: float32 in [-1, 1) instead of the integer samples
+        """
+        from .cache import record_access
+
+        self.window_seconds = window_seconds
+        self.hop_seconds = hop_seconds or window_seconds
+        self.normalize = normalize
+
+        self.files = []
+        skipped = 0
+        for filename in find_audio_files(roots):
+            try:
+                info = probe(filename)
+            except Exception as e:
+                print(f"Skipping {filename}: {e}")
+                continue
+            if (sample_rate is not None and info['sample_rate'] != sample_rate) or (channels is not None and info['channels'] != channels):
+                skipped += 1
+                continue
+            self.files.append(info)
+        if skipped > 0:
+            print(f"Skipped {skipped} files that are not at sample_rate={sample_rate}, channels={channels}")
+
+        # the index: file and first frame of every window, as flat arrays so shuffling millions of windows stays cheap
+        file_ids, starts = [], []
+        for file_id, info in enumerate(self.files):
+            window, hop = self.frames(info)
+            n_windows = max(0, (info['n_frames'] - window) // hop + 1)
+            file_ids.append(np.full(n_windows, file_id, dtype=np.int32))
+            starts.append(np.arange(n_windows, dtype=np.int64) * hop)
+        self.file_ids = np.concatenate(file_ids) if file_ids else np.zeros(0, dtype=np.int32)
+        self.starts = np.concatenate(starts) if starts else np.zeros(0, dtype=np.int64)
+        print(f"{len(self)} windows of {window_seconds}s in {len(self.files)} files")
+        # files a dataset uses are kept longest by the LRU eviction of the raw tier
+        record_access([info['path'] for info in self.files])
+
+    def frames(self, info):
+        return int(round(self.window_seconds * info['sample_rate'])), max(1, int(round(self.hop_seconds * info['sample_rate'])))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def info(self, index):
+        """
+        {'path', 'start_frame', 'sample_rate', 'start_time'} of window index, start_time is None if the file name has no timestamp
+        """
+        info = self.files[self.file_ids[index]]
+        start_frame = int(self.starts[index])
+        start_time = file_start_time(info['path'])
+        if start_time is not None:
+            start_time = start_time.timestamp() + start_frame / info['sample_rate']
+            start_time = datetime.fromtimestamp(start_time, timezone.utc)
+        return {'path': info['path'], 'start_frame': start_frame, 'sample_rate': info['sample_rate'], 'start_time': start_time}
+
+    def __getitem__(self, index):
+        info = self.files[self.file_ids[index]]
+        window, _ = self.frames(info)
+        samples = self.read(info, int(self.starts[index]), window)
+        if self.normalize:
+            return (samples / info['scale']).astype(np.float32)
+        return samples
+
+    def read(self, info, start_frame, n_frames):
+        return read_frames(info, start_frame, n_frames)
+
+    def iterate(self, shuffle=False, seed=None, batch_size=None, prefetch=16, workers=4):
+        """
+        Yield windows (or stacked batches of batch_size windows) in index order or shuffled across all files. Windows are decoded by
+        `workers` threads, at most `prefetch` ahead of the consumer.
+        """
+        order = np.random.default_rng(seed).permutation(len(self)) if shuffle else np.arange(len(self))
+        batch = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for index in order:
+                pending.append(executor.submit(self.__getitem__, int(index)))
+                if len(pending) < max(1, prefetch):
+                    continue
+                batch.append(pending.popleft().result())
+                if batch_size is None or len(batch) == batch_size:
+                    yield batch[0] if batch_size is None else np.stack(batch)
+                    batch = []
+            while pending:
+                batch.append(pending.popleft().result())
+                if batch_size is None or len(batch) == batch_size:
+                    yield batch[0] if batch_size is None else np.stack(batch)
+                    batch = []
+        if batch:
+            yield np.stack(batch)
+
+    def __iter__(self):
+        return self.iterate()
@@ -4,25 +4,20 @@
 onc_download.py
 """
 import os
+from datetime import datetime
 
-import requests
-from bs4 import BeautifulSoup
-from urllib.parse import urljoin
+from .profiling import StageProfiler
+from .supported_classes.base_class import shard_deployments
 
-import json
-from contextlib import closing
-import errno
-from copy import deepcopy
-
-
-import shutil
-import glob
-import random
-import time
 
+def source_classes():
+    """
+    {source: download class}, the source modules pull in obspy, polars and the onc client, so they are only imported once we download
+    """
+    from .supported_classes.ooi_class import OOIDownloadClass
+    from .supported_classes.onc_class import ONCDownloadClass
 
-from .supported_classes.ooi_class import OOIDownloadClass
-from .supported_classes.onc_class import ONCDownloadClass
+    return {'ONC': ONCDownloadClass, 'OOI': OOIDownloadClass}
 
 
 def download_data(
@@ -36,13 +31,55 @@ def download_data(
         start_time=None,
         end_time=None,
         save_dir="",
+        profiler=None,
+        ltsa=False,
+        target_sample_rate=None,
+        shard_index=0,
+        shard_count=1,
+        enqueue_only=False,
+        queue_path=None,
+        disk_budget_gb=None,
+        min_free_gb=1.0,
+        disk_wait_timeout=3600,
+        http_pool_size=10,
+        recompress_wav=True,
+        recompress_workers=None,
+        in_memory_ingest=False,
+        spool_max_mb=512,
+        blob_store=None,
+        cache_cap_gb=None,
+        plan_only=False,
+        plan_file=None,
     ):
     """
+    profiler: a StageProfiler, each source is profiled as a discover_<source> and a download_<source> stage
+    ltsa: write per-minute spectral summaries (ltsa.npz) for each station-day while ingesting
+    target_sample_rate: store audio at (at most) this rate in Hz. ONC data products are downsampled on the server where possible,
+        everything else is resampled during conversion
+    shard_index, shard_count: only download the deployments of this shard, see base_class.shard_deployments. Sharded runs write a
+        report to <save_dir>/reports, combine them with hydrophone-downloader-merge-reports
+    enqueue_only: only plan the deployments into the work queue at queue_path (default <save_dir>/.queue.sqlite), they are downloaded
+        by hydrophone-downloader-worker
+    disk_budget_gb, min_free_gb, disk_wait_timeout: downloads reserve their expected size first and wait (up to disk_wait_timeout
+        seconds) while save_dir would grow beyond disk_budget_gb or the volume would drop below min_free_gb free
+    http_pool_size: connections kept alive per host by the HTTP session shared by all sources, also the number of deployments
+        listed at once by plan_only
+    recompress_wav, recompress_workers: recompress downloaded WAV files (ONC before 2021-04-09) to FLAC, recompress_workers ffmpeg
+        processes at a time, keeping any WAV whose FLAC does not decode to the same samples
+    in_memory_ingest, spool_max_mb: convert OOI mseed from memory (temp files only above spool_max_mb) straight to FLAC
+    blob_store: content-addressed store shared between save_dirs, files any of them already has are hard-linked instead of downloaded
+    cache_cap_gb: keep the raw downloads of save_dir under this size, evicting the least recently used (merged files are kept)
+    plan_only: only list the remote files of the query, print their size and the estimated duration and save the plan to plan_file
+        (default <save_dir>/plan.json)
+    plan_file: without plan_only, download the deployments of this saved plan instead of discovering them again
+
+    returns a result dict per deployment
     """
 
     assert min_lat <= max_lat, "min_lat must be less than or equal to max_lat"
     assert min_lon <= max_lon, "min_lon must be less than or equal to max_lon"
     assert min_depth <= max_depth, "min_depth must be less than or equal to max_depth"
+    assert 0 <= shard_index < shard_count, "shard_index must be in [0, shard_count)"
 
     print("min_lat:", min_lat)
     print("max_lat:", max_lat)
@@ -54,26 +91,91 @@ def download_data(
     print("start_time:", start_time)
     print("end_time:", end_time)
     print("save_dir:", save_dir)
-
-
-
-
-    all_classes = [ONCDownloadClass(), OOIDownloadClass(),]
-
-    for download_class in all_classes:
-        download_class.download_data(
-            min_lat, 
-            max_lat,
-            min_lon, 
-            max_lon, 
-            min_depth,
-            max_depth,
-            license,
-            start_time,
-            end_time,
-            save_dir,
-        )
-
-    return
+    print("target_sample_rate:", target_sample_rate)
+    print("shard:", shard_index, "of", shard_count)
+    print("disk_budget_gb:", disk_budget_gb)
+    started = datetime.now().isoformat(timespec='seconds')
+    query = {'min_lat': min_lat, 'max_lat': max_lat, 'min_lon': min_lon, 'max_lon': max_lon, 'min_depth': min_depth, 'max_depth': max_depth,
+             'license': license, 'start_time': start_time, 'end_time': end_time}
+
+
+
+
+    if profiler is None:
+        profiler = StageProfiler()
+
+    planned = None
+    if plan_file is not None and not plan_only:
+        from .planner import load_plan
+        planned = load_plan(plan_file)
+    if plan_only:
+        from .planner import plan_deployments
+        plan_entries, bytes_per_second = [], {}
+
+    if enqueue_only:
+        from .work_queue import WorkQueue, default_queue_path
+        queue = WorkQueue(queue_path or default_queue_path(save_dir))
+
+    all_classes = list(source_classes().items())
+    results = []
+
+    for source, download_class in all_classes:
+        with profiler.stage(f"discover_{source}"):
+            download_class = download_class(
+                ltsa=ltsa,
+                target_sample_rate=target_sample_rate,
+                disk_budget_gb=disk_budget_gb,
+                min_free_gb=min_free_gb,
+                disk_wait_timeout=disk_wait_timeout,
+                http_pool_size=http_pool_size,
+                recompress_wav=recompress_wav,
+                recompress_workers=recompress_workers,
+                in_memory_ingest=in_memory_ingest,
+                spool_max_mb=spool_max_mb,
+                blob_store=blob_store,
+                cache_cap_gb=cache_cap_gb,
+            )
+            if planned is None:
+                download_class.discover()
+        if planned is not None:
+            # the plan was made for the whole query, shards split it the same way they split a discovery
+            deployments = shard_deployments(planned.get(source, []), shard_index, shard_count)
+            print(f"{len(deployments)} {source} deployments in the plan")
+        else:
+            deployments = download_class.select_deployments(min_lat, max_lat, min_lon, max_lon, min_depth, max_depth, license, start_time, end_time, shard_index, shard_count)
+        if plan_only:
+            with profiler.stage(f"plan_{source}"):
+                plan_entries += plan_deployments(download_class, deployments, save_dir, threads=http_pool_size)
+            bytes_per_second[source] = download_class.storage(save_dir).estimate(f"{source}_bytes_per_second", None)
+            continue
+        if enqueue_only:
+            n_new = queue.enqueue(source, deployments, save_dir)
+            print(f"Queued {n_new} new {source} deployments ({len(deployments)-n_new} already queued) in {queue.path}")
+            continue
+        if len(deployments)==0:
+            print(f"No data from {source} is available for the specified parameters.")
+            continue
+        with profiler.stage(f"download_{source}"):
+            print(f"Downloading {len(deployments)} deployments from {source}")
+            results += download_class.download_deployments(deployments, save_dir)
+
+    if plan_only:
+        from .planner import summarize_plan, print_plan, write_plan, default_plan_path
+
+        summary = summarize_plan(plan_entries, bytes_per_second)
+        print_plan(summary, save_dir)
+        write_plan(plan_file or default_plan_path(save_dir, shard_index, shard_count), query, save_dir, plan_entries, summary)
+        return results
+
+    if enqueue_only:
+        print(f"Queue: {queue.counts()}, run hydrophone-downloader-worker save_dir={save_dir} to download")
+        return results
+
+    if shard_count > 1:
+        from .reports import write_shard_report
+
+        write_shard_report(save_dir, shard_index, shard_count, query, results, started)
+
+    return results
 
 
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+envelope.py
+
+ min/max/RMS envelopes of each station-day at a few zoom levels, for drawing waveforms without decoding the audio:
+
+    from hydrophone_downloader.envelope import build_envelopes, fetch_envelope
+
+    build_envelopes('sonifications/merged')
+    env = fetch_envelope('sonifications/merged', 'ICLISTENHF1234', '2025-01-01', '2025-01-02', max_points=2000)
+    plot(env['time'], env['min'], env['max'])
+
+ Each station-day gets <station>_<YYYYMMDD>_envelope.npz next to its audio, holding for every level L (seconds):
+    min_L, max_L, rms_L   (86400 // L,)   float16, samples scaled to [-1, 1), NaN where there is no audio
+    count_L               (86400 // L,)   int32, samples in each bin
+ and day_start (POSIX), levels, sample_rate. A day-long waveform at the 60 s level reads about 10 KB.
+ The bins are computed from the audio once, at the finest level, the coarser levels are reduced from it.
+"""
+
+import os
+import re
+import subprocess
+from collections import defaultdict
+from datetime import datetime, timezone
+
+import numpy as np
+
+from .audio_io import OOI_TIMESTAMP_PATTERN
+
+
+LEVELS = (1, 10, 60)
+DAY_SECONDS = 86400
+ENVELOPE_SUFFIX = '_envelope.npz'
+# about 10 s of audio at 64 kHz per decoded block
+BLOCK_FRAMES = 1 << 19
+# the station is the file name up to the ONC/merged timestamp or the OOI ISO timestamp (saved without its colons)
+STATION = re.compile(r'^(.*?)(_\d{8}T\d{6}|' + OOI_TIMESTAMP_PATTERN + ')')
+
+
+def file_station(path):
+    match = STATION.match(os.path.basename(path))
+    return match.group(1) if match is not None else os.path.basename(path).split('_')[0]
+
+
+def envelope_path(directory, station, day):
+    """
+    day: a date, datetime or 'YYYY-MM-DD'
+    """
+    if isinstance(day, str):
+        day = datetime.strptime(day[:10], '%Y-%m-%d')
+    return os.path.join(directory, f"{station}_{day.strftime('%Y%m%d')}{ENVELOPE_SUFFIX}")
+
+
+def iter_blocks(info, block_frames=BLOCK_FRAMES):
+    """
+    Yield the first channel of a probed WAV or FLAC file as float32 blocks in [-1, 1). WAV blocks are read directly, FLAC is
+    decoded by an ffmpeg pipe, so memory stays at one block whatever the file length.
+    """
+    from .dataset import pcm_to_array
+
+    if info['kind'] == 'wav':
+        frame_bytes = info['channels'] * info['sample_width']
+        with open(info['path'], 'rb') as f:
+            f.seek(info['data_offset'])
+            remaining = info['n_frames']
+            while remaining > 0:
+                raw = f.read(min(block_frames, remaining) * frame_bytes)
+                if len(raw) < frame_bytes:
+                    break
+                samples = pcm_to_array(raw[:len(raw) // frame_bytes * frame_bytes], info['sample_width'], info['channels'], info['format'])
+                remaining -= len(samples)
+                yield (samples[:, 0] / info['scale']).astype(np.float32)
+        return
+
+    codec, dtype = ('s16le', '<i2') if info['bits'] <= 16 else ('s32le', '<i4')
+    frame_bytes = info['channels'] * np.dtype(dtype).itemsize
+    process = subprocess.Popen(['ffmpeg', '-v', 'error', '-i', info['path'], '-map', '0:a', '-f', codec, '-c:a', f'pcm_{codec}', '-'],
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            raw = process.stdout.read(block_frames * frame_bytes)
+            if len(raw) < frame_bytes:
+                break
+            samples = np.frombuffer(raw[:len(raw) // frame_bytes * frame_bytes], dtype=dtype).reshape(-1, info['channels'])[:, 0]
+            if info['bits'] > 16:
+                # ffmpeg returns 17-24 bit audio in the upper bits of int32
+                samples = samples >> (32 - info['bits'])
+            yield (samples / info['scale']).astype(np.float32)
+    finally:
+        process.kill()
+        process.wait()
+
+
+class EnvelopeAccumulator:
+    """
+    Per-second min, max, sum of squares and count, indexed by POSIX second. Blocks are reduced with np.*.reduceat over the
+    runs of samples falling in the same second.
+    """
+    def __init__(self, base_level=LEVELS[0]):
+        self.base_level = base_level
+        # POSIX day -> arrays over the bins of the day
+        self.days = {}
+
+    def _day(self, day):
+        if day not in self.days:
+            n = DAY_SECONDS // self.base_level
+            self.days[day] = {'min': np.full(n, np.inf), 'max': np.full(n, -np.inf), 'sumsq': np.zeros(n), 'count': np.zeros(n, dtype=np.int64)}
+        return self.days[day]
+
+    def update(self, samples, start_time, sample_rate, position=0):
+        """
+        samples: 1-D float block, the position-th sample of a file starting at start_time (POSIX seconds)
+        """
+        if len(samples) == 0:
+            return
+        # bin of each sample, counted in samples from the file start so block boundaries do not round into the wrong bin
+        first_bin = int(np.floor((start_time + position / sample_rate) / self.base_level))
+        offset = (start_time - first_bin * self.base_level) * sample_rate + position
+        samples_per_bin = self.base_level * sample_rate
+        bins = first_bin + ((offset + np.arange(len(samples))) // samples_per_bin).astype(np.int64)
+
+        starts = np.concatenate([[0], np.flatnonzero(np.diff(bins)) + 1])
+        block_bins = bins[starts]
+        x = samples.astype(np.float64)
+        mins = np.minimum.reduceat(x, starts)
+        maxs = np.maximum.reduceat(x, starts)
+        sumsq = np.add.reduceat(x * x, starts)
+        counts = np.diff(np.concatenate([starts, [len(x)]]))
+
+        bins_per_day = DAY_SECONDS // self.base_level
+        for day in np.unique(block_bins // bins_per_day):
+            keep = block_bins // bins_per_day == day
+            index = block_bins[keep] % bins_per_day
+            arrays = self._day(int(day))
+            # bins are unique within a block, so fancy indexing does not lose updates
+            arrays['min'][index] = np.minimum(arrays['min'][index], mins[keep])
+            arrays['max'][index] = np.maximum(arrays['max'][index], maxs[keep])
+            arrays['sumsq'][index] += sumsq[keep]
+            arrays['count'][index] += counts[keep]
+
+    def pyramid(self, day, levels=LEVELS):
+        """
+        The npz arrays of a day (POSIX day number), each level reduced from the base bins
+        """
+        arrays = self.days[day]
+        result = {'day_start': np.float64(day * DAY_SECONDS), 'levels': np.array(levels, dtype=np.int32)}
+        for level in levels:
+            factor = level // self.base_level
+            assert factor * self.base_level == level, f"level {level} is not a multiple of {self.base_level}"
+            mins = arrays['min'].reshape(-1, factor).min(axis=1)
+            maxs = arrays['max'].reshape(-1, factor).max(axis=1)
+            count = arrays['count'].reshape(-1, factor).sum(axis=1)
+            sumsq = arrays['sumsq'].reshape(-1, factor).sum(axis=1)
+            empty = count == 0
+            with np.errstate(invalid='ignore', divide='ignore'):
+                rms = np.sqrt(sumsq / count)
+            for name, values in (('min', mins), ('max', maxs), ('rms', rms)):
+                values = values.astype(np.float16)
+                values[empty] = np.nan
+                result[f'{name}_{level}'] = values
+            result[f'count_{level}'] = count.astype(np.int32)
+        return result
+
+
+def build_envelopes(roots, output_dir=None, levels=LEVELS, force=False):
+    """
+    Write the envelope pyramid of every station-day of the WAV and FLAC files under roots, next to the files (or in output_dir).
+    A station-day is only rebuilt when its envelope is missing or older than one of its files, unless force=True.
+    Files whose name carries no start time are skipped. Returns the envelope files written.
+    """
+    from .dataset import find_audio_files, probe, file_start_time
+    from .cache import record_access
+
+    # (envelope directory, station, POSIX day) -> [probed file, ...], a file that runs past midnight belongs to both days.
+    # The directory is part of the key, so the station-day folders and merged/ do not count the same audio twice
+    station_days = defaultdict(list)
+    for filename in find_audio_files(roots):
+        start_time = file_start_time(filename)
+        if start_time is None:
+            print(f"No start time in the name of {filename}, skipping it")
+            continue
+        try:
+            info = probe(filename)
+        except Exception as e:
+            print(f"Skipping {filename}: {e}")
+            continue
+        info['start_time'] = start_time.timestamp()
+        info['directory'] = output_dir or os.path.dirname(filename)
+        end_time = info['start_time'] + info['n_frames'] / info['sample_rate']
+        for day in range(int(info['start_time'] // DAY_SECONDS), int(max(info['start_time'], end_time - 1e-9) // DAY_SECONDS) + 1):
+            station_days[(info['directory'], file_station(filename), day)].append(info)
+
+    written = []
+    for directory, station in sorted({(directory, station) for directory, station, _ in station_days}):
+        stale = []
+        for (d, s, day), files in station_days.items():
+            if (d, s) != (directory, station):
+                continue
+            filename = envelope_path(directory, station, datetime.fromtimestamp(day * DAY_SECONDS, timezone.utc))
+            if force or not os.path.exists(filename) or os.path.getmtime(filename) < max(os.path.getmtime(f['path']) for f in files):
+                stale.append((day, filename))
+        if len(stale) == 0:
+            continue
+
+        accumulator = EnvelopeAccumulator(base_level=levels[0])
+        decoded = set()
+        for day, _ in stale:
+            for info in station_days[(directory, station, day)]:
+                if info['path'] in decoded:
+                    continue
+                decoded.add(info['path'])
+                position = 0
+                for block in iter_blocks(info):
+                    accumulator.update(block, info['start_time'], info['sample_rate'], position)
+                    position += len(block)
+
+        record_access(decoded)
+
+        for day, filename in stale:
+            if day not in accumulator.days:
+                continue
+            result = accumulator.pyramid(day, levels)
+            result['sample_rate'] = np.float64(station_days[(directory, station, day)][0]['sample_rate'])
+            os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+            tmp_filename = filename + '.tmp.npz'
+            np.savez_compressed(tmp_filename, **result)
+            os.replace(tmp_filename, filename)
+            written.append(filename)
+        print(f"Wrote the envelopes of {len(stale)} days of {station} in {directory}")
+    return written
+
+
+def _timestamp(value):
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.timestamp()
+    return float(value)
+
+
+def fetch_envelope(directory, station, start_time, end_time, level=None, max_points=2000):
+    """
+    The envelope of station between start_time and end_time (datetimes, ISO strings or POSIX seconds, naive times are UTC):
+    {'level', 'time' (POSIX start of each bin), 'min', 'max', 'rms'} as float arrays, NaN where there is no audio.
+    level: bin size in seconds, default the finest level with at most max_points bins over the range.
+    Only the arrays of that level are read from each day's file.
+    """
+    start, end = _timestamp(start_time), _timestamp(end_time)
+    days = range(int(start // DAY_SECONDS), int(max(start, end - 1e-9) // DAY_SECONDS) + 1)
+    filenames = [envelope_path(directory, station, datetime.fromtimestamp(day * DAY_SECONDS, timezone.utc)) for day in days]
+
+    available = None
+    for filename in filenames:
+        if os.path.exists(filename):
+            with np.load(filename) as f:
+                available = [int(l) for l in f['levels']]
+            break
+    if available is None:
+        raise FileNotFoundError(f"No envelopes of {station} between {start_time} and {end_time} in {directory}")
+    if level is None:
+        fitting = [l for l in available if (end - start) / l <= max_points]
+        level = min(fitting) if fitting else max(available)
+    elif level not in available:
+        raise ValueError(f"level must be one of {available}")
+
+    n = DAY_SECONDS // level
+    parts = defaultdict(list)
+    for day, filename in zip(days, filenames):
+        if os.path.exists(filename):
+            with np.load(filename) as f:
+                for name in ('min', 'max', 'rms'):
+                    parts[name].append(f[f'{name}_{level}'].astype(np.float32))
+        else:
+            for name in ('min', 'max', 'rms'):
+                parts[name].append(np.full(n, np.nan, dtype=np.float32))
+        parts['time'].append(day * DAY_SECONDS + np.arange(n, dtype=np.float64) * level)
+
+    result = {name: np.concatenate(values) for name, values in parts.items()}
+    keep = (result['time'] + level > start) & (result['time'] < end)
+    return dict({name: values[keep] for name, values in result.items()}, level=level)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+http_session.py
+
+ one pooled requests.Session per process, so the discovery calls, listings and file downloads of a run reuse kept-alive
+ connections instead of paying a TCP and TLS handshake per request.
+"""
+
+import os
+import hashlib
+import threading
+
+
+DEFAULT_POOL_SIZE = 10
+CHUNK_SIZE = 1 << 20
+
+_session = None
+_lock = threading.Lock()
+
+
+def get_session(pool_size=None):
+    """
+    The process-wide session. pool_size (connections kept per host) is taken from the first call, it should match the number of
+    requests the process makes at the same time.
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+
+            pool_size = pool_size or DEFAULT_POOL_SIZE
+            retries = Retry(total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+        return _session
+
+
+def download_to(url, f, session=None, chunk_size=CHUNK_SIZE, timeout=60, expected_bytes=None):
+    """
+    Stream url into the binary file object f, returns (bytes written, SHA-256 hex digest). The digest is computed from the chunks
+    as they are written, so the data is never read back.
+    expected_bytes: the Content-Length from the listing, a download of another size raises IOError.
+    """
+    session = session or get_session()
+    sha256 = hashlib.sha256()
+    size = 0
+    with session.get(url, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            f.write(chunk)
+            sha256.update(chunk)
+            size += len(chunk)
+        # Content-Length counts the encoded bytes, iter_content yields decoded ones
+        encoded = response.headers.get('Content-Encoding') not in (None, 'identity')
+    if expected_bytes is not None and not encoded and size != expected_bytes:
+        raise IOError(f"{url}: received {size} bytes, expected {expected_bytes}")
+    return size, sha256.hexdigest()
+
+
+def download_file(url, local_path, session=None, chunk_size=CHUNK_SIZE, timeout=60, expected_bytes=None):
+    """
+    download_to a file, returns (bytes written, SHA-256 hex digest).
+    The file is written to local_path.part and renamed when complete, so an interrupted download never looks like a finished file,
+    a download of the wrong size leaves nothing behind.
+    """
+    tmp_path = local_path + '.part'
+    try:
+        with open(tmp_path, 'wb') as f:
+            result = download_to(url, f, session=session, chunk_size=chunk_size, timeout=timeout, expected_bytes=expected_bytes)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, local_path)
+    return result
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+manifest.py
+
+ SHA-256 digests of the files in save_dir, kept in <save_dir>/.manifest.sqlite. Downloads are hashed while they stream to disk,
+ converted files as they are written (FLAC once ffmpeg is done, see mseed_stream). hydrophone-downloader-verify then only re-reads the files whose size or mtime
+ no longer match what was recorded, so checking a large archive does not read it all again.
+ Each file also has its last access (recorded, merged, rendered, ...) for the LRU eviction in cache.py, filesystem atime is
+ often disabled (noatime) or updated by backups.
+"""
+
+import os
+import time
+import hashlib
+import sqlite3
+from contextlib import closing
+
+
+MANIFEST_FILENAME = '.manifest.sqlite'
+CHUNK_SIZE = 1 << 20
+
+
+def hash_file(path, chunk_size=CHUNK_SIZE):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class Manifest:
+    """
+    Paths are stored relative to save_dir, so the archive can be moved or mounted elsewhere.
+    """
+    def __init__(self, save_dir):
+        self.save_dir = save_dir
+        os.makedirs(save_dir, exist_ok=True)
+        self.path = os.path.join(save_dir, MANIFEST_FILENAME)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                sha256 TEXT NOT NULL,
+                source TEXT,
+                url TEXT,
+                recorded REAL,
+                verified REAL,
+                accessed REAL,
+                evicted REAL
+            )""")
+            # manifests written before access tracking
+            columns = {row['name'] for row in conn.execute("PRAGMA table_info(files)")}
+            for column in ('accessed', 'evicted'):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE files ADD COLUMN {column} REAL")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def relative(self, path):
+        return os.path.relpath(os.path.abspath(path), os.path.abspath(self.save_dir))
+
+    def record(self, path, sha256=None, source=None, url=None):
+        """
+        Record the digest of path, hashing it if sha256 (computed while downloading) is not given.
+        """
+        if sha256 is None:
+            sha256 = hash_file(path)
+        stat = os.stat(path)
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO files (path, size, mtime, sha256, source, url, recorded, verified, accessed, evicted) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, NULL)",
+                         (self.relative(path), stat.st_size, stat.st_mtime, sha256, source, url, now, now, now))
+        return sha256
+
+    def touch(self, paths):
+        """
+        Mark the files as used now, for the LRU eviction
+        """
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.executemany("UPDATE files SET accessed=? WHERE path=?", [(now, self.relative(path)) for path in paths])
+
+    def mark_evicted(self, path):
+        """
+        Keep the entry (and its URL) of a file deleted by the eviction, verify does not count it as missing
+        """
+        with closing(self._connect()) as conn, conn:
+            conn.execute("UPDATE files SET evicted=? WHERE path=?", (time.time(), self.relative(path)))
+
+    def files(self):
+        """
+        Every file that is not evicted, as dicts
+        """
+        with closing(self._connect()) as conn:
+            return [dict(row) for row in conn.execute("SELECT * FROM files WHERE evicted IS NULL ORDER BY path")]
+
+    def forget(self, path):
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM files WHERE path=?", (self.relative(path),))
+
+    def get(self, path):
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT * FROM files WHERE path=?", (self.relative(path),)).fetchone()
+        return None if row is None else dict(row)
+
+    def verify(self, full=False):
+        """
+        Check the recorded files. Unchanged size and mtime are trusted unless full=True, changed files are hashed again.
+        Returns {'ok': n, 'rehashed': n, 'missing': [paths], 'corrupt': [paths]}, a file that still hashes to its digest after
+        its mtime changed (copied, touched) is updated and counted as rehashed.
+        """
+        with closing(self._connect()) as conn:
+            rows = [dict(row) for row in conn.execute("SELECT path, size, mtime, sha256 FROM files WHERE evicted IS NULL ORDER BY path")]
+
+        result = {'ok': 0, 'rehashed': 0, 'missing': [], 'corrupt': []}
+        for row in rows:
+            path = os.path.join(self.save_dir, row['path'])
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                result['missing'].append(row['path'])
+                continue
+
+            if not full and stat.st_size == row['size'] and stat.st_mtime == row['mtime']:
+                result['ok'] += 1
+                continue
+
+            sha256 = hash_file(path)
+            if sha256 != row['sha256']:
+                print(f"Checksum mismatch: {row['path']}")
+                result['corrupt'].append(row['path'])
+                continue
+
+            with closing(self._connect()) as conn, conn:
+                conn.execute("UPDATE files SET size=?, mtime=?, verified=? WHERE path=?", (stat.st_size, stat.st_mtime, time.time(), row['path']))
+            if stat.st_size == row['size'] and stat.st_mtime == row['mtime']:
+                result['ok'] += 1
+            else:
+                result['rehashed'] += 1
+        return result
+
+
+def verify_manifest(save_dir, full=False):
+    """
+    Verify save_dir against its manifest and write reports/verify_report.json
+    """
+    from datetime import datetime
+    from .reports import write_json, REPORTS_DIR
+
+    if not os.path.exists(os.path.join(save_dir, MANIFEST_FILENAME)):
+        print(f"No manifest in {save_dir}, nothing to verify")
+        return None
+
+    started = datetime.now().isoformat(timespec='seconds')
+    result = Manifest(save_dir).verify(full=full)
+    filename = os.path.join(save_dir, REPORTS_DIR, 'verify_report.json')
+    write_json(filename, dict(result, started=started, finished=datetime.now().isoformat(timespec='seconds'), full=full))
+
+    print(f"Verified {save_dir}: {result['ok']} unchanged, {result['rehashed']} changed but intact, "
+          f"{len(result['missing'])} missing, {len(result['corrupt'])} corrupt. Report: {filename}")
+    return result
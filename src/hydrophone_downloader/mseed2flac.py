@@ -5,10 +5,11 @@ use obspy to convert mseed to wav, then ffmpeg to conver wav to flac
 """
 
 import os
-import obspy
 import glob
 
-def mseed2wav(filenames):
+def mseed2wav(filenames, target_sample_rate=None):
+    from .mseed_stream import convert_mseed
+
     # resolve wildcard characters
     print(filenames)
     if type(filenames) == str:
@@ -27,10 +28,10 @@ def mseed2wav(filenames):
             continue
         print(filename)
         try:
-            st = obspy.read(filename)
             wav_filename = filename.replace('mseed', 'wav')
-            st.write(wav_filename, format='WAV')
-            print(f"Converted {filename} to {wav_filename}")
+            # decoded a group of records at a time, gaps are zero filled as they come
+            sample_rate, _, _ = convert_mseed(filename, wav_filename, target_sample_rate=target_sample_rate)
+            print(f"Converted {filename} to {wav_filename} at {sample_rate} Hz")
             # Do NOT convert to flac or delete files
         except Exception as e:
             print(f'Failed to convert {filename}: {e}')
@@ -44,7 +45,11 @@ if __name__ == "__main__":
         "--filenames", nargs='+', type=str,
         help="Directory where mseed files are stored",
     )
+    parser.add_argument(
+        "--target-sample-rate", type=int, default=None,
+        help="Resample to this rate in Hz (default: keep the native rate)",
+    )
 
     args = parser.parse_args()
 
-    mseed2wav(args.filenames)
+    mseed2wav(args.filenames, target_sample_rate=args.target_sample_rate)
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+mseed_stream.py
+
+ bounded-memory mseed conversion. Instead of obspy.read on the whole file followed by st.merge(fill_value=0), the file is decoded
+ a group of records at a time. Gaps are filled with zeros as they are found, and the samples go straight to the output (and to the
+ resampler and LTSA accumulator), so memory depends on the group size, not on the file length or the number of traces.
+"""
+
+import io
+import os
+import hashlib
+import wave
+import struct
+
+import numpy as np
+
+
+# 256 records of 4096 bytes, about a megabyte of mseed per decode
+RECORDS_PER_CHUNK = 256
+# gaps are zero-filled in blocks of this many samples
+FILL_BLOCK = 1 << 20
+
+
+def _open(source):
+    if isinstance(source, (str, os.PathLike)):
+        return open(source, 'rb'), True
+    return source, False
+
+
+def record_length(header):
+    """
+    Length of the mseed record starting with header (its first 256 bytes), from blockette 1000, None if it has none
+    """
+    # the year of the start time tells the byte order
+    endian = '>' if 1900 <= struct.unpack('>H', header[20:22])[0] <= 2500 else '<'
+    offset = struct.unpack(endian + 'H', header[46:48])[0]
+    while 48 <= offset and offset + 8 <= len(header):
+        blockette_type, next_offset = struct.unpack(endian + 'HH', header[offset:offset + 4])
+        if blockette_type == 1000:
+            return 2 ** header[offset + 6]
+        if next_offset <= offset:
+            break
+        offset = next_offset
+    return None
+
+
+def record_groups(source, records_per_chunk=RECORDS_PER_CHUNK):
+    """
+    Yield the raw bytes of consecutive groups of mseed records. source: a filename or a seekable binary file object.
+    Only the record headers are read to find where each group ends, the record length can change within a file.
+    """
+    from obspy.io.mseed.util import get_record_information
+
+    f, close = _open(source)
+    try:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+
+        offset = 0
+        while offset < size:
+            length = 0
+            for _ in range(records_per_chunk):
+                if offset + length >= size:
+                    break
+                f.seek(offset + length)
+                reclen = record_length(f.read(256))
+                if reclen is None:
+                    # its offset argument is relative to the current position
+                    f.seek(offset + length)
+                    reclen = get_record_information(f)['record_length']
+                length += reclen
+            f.seek(offset)
+            yield f.read(length)
+            offset += length
+    finally:
+        if close:
+            f.close()
+
+
+def iter_traces(source, records_per_chunk=RECORDS_PER_CHUNK):
+    """
+    Yield the traces decoded from each group of records, in file order
+    """
+    import obspy
+
+    for chunk in record_groups(source, records_per_chunk):
+        for trace in sorted(obspy.read(io.BytesIO(chunk), format='MSEED'), key=lambda tr: tr.stats.starttime):
+            yield trace
+
+
+def iter_samples(source, records_per_chunk=RECORDS_PER_CHUNK):
+    """
+    Yield (stats, start_time, sample_rate) once and then contiguous blocks of samples, like Stream.merge(fill_value=0) on the first
+    channel: gaps between records become zeros, samples overlapping what was already emitted are dropped (the first data wins).
+    Other channels in the file are ignored.
+    """
+    first = None
+    written = 0
+    for trace in iter_traces(source, records_per_chunk):
+        if first is None:
+            first, first_id = trace.stats, trace.id
+            yield first, first.starttime.timestamp, first.sampling_rate
+        elif trace.id != first_id:
+            continue
+
+        offset = int(round((trace.stats.starttime - first.starttime) * first.sampling_rate))
+        data = trace.data
+        if offset > written:
+            gap = offset - written
+            for start in range(0, gap, FILL_BLOCK):
+                yield np.zeros(min(FILL_BLOCK, gap - start), dtype=data.dtype)
+            written = offset
+        elif offset < written:
+            data = data[written - offset:]
+        if len(data) > 0:
+            yield data
+            written += len(data)
+
+
+def expected_frames(source, target_sample_rate=None):
+    """
+    Number of samples iter_samples yields for source (from the start of its first record to the end of its last one), after
+    resampling to target_sample_rate like resample_poly, read from the first and last record headers. None if it cannot tell
+    (the record length changes within the file).
+    """
+    from math import gcd
+    from obspy.io.mseed.util import get_record_information
+
+    f, close = _open(source)
+    try:
+        f.seek(0)
+        info = get_record_information(f)
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size % info['record_length'] != 0:
+            return None
+        f.seek(size - info['record_length'])
+        last = get_record_information(f)
+        if last['samp_rate'] != info['samp_rate']:
+            return None
+        n = int(round((last['endtime'] - info['starttime']) * info['samp_rate'])) + 1
+    except Exception:
+        return None
+    finally:
+        if close:
+            f.close()
+        else:
+            f.seek(0)
+    if target_sample_rate is not None and target_sample_rate < info['samp_rate']:
+        # the integer rates of StreamingResampler
+        orig_rate, target_rate = int(round(info['samp_rate'])), int(round(target_sample_rate))
+        divisor = gcd(orig_rate, target_rate)
+        n = -(-n * (target_rate // divisor) // (orig_rate // divisor))
+    return n
+
+
+class HashingFile:
+    """
+    Binary file that hashes the bytes written to it in order. Seeking back to rewrite something (a header patched on close)
+    leaves the digest unknown.
+    """
+    def __init__(self, f):
+        self._f = f
+        self._sha256 = hashlib.sha256()
+        self._hashed = 0
+
+    def write(self, data):
+        if self._hashed is not None and self._f.tell() == self._hashed:
+            self._sha256.update(data)
+            self._hashed += len(data)
+        else:
+            self._hashed = None
+        return self._f.write(data)
+
+    def tell(self):
+        return self._f.tell()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self._f.seek(offset, whence)
+
+    def flush(self):
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+    def hexdigest(self):
+        """
+        sha256 of the file if it was written front to back, else None
+        """
+        if self._hashed is None or self._hashed != self._f.tell():
+            return None
+        return self._sha256.hexdigest()
+
+
+class WavWriter:
+    """
+    Write mono int32 PCM progressively. Writes to filename.tmp and renames on success.
+    n_frames: the number of samples that will be written, if known. The header is then written once and the file is hashed as
+    it is written (sha256 after close), otherwise the header is completed on close and sha256 is None.
+    """
+    def __init__(self, filename, sample_rate, n_frames=None):
+        self.filename = filename
+        self.tmp_filename = filename + '.tmp'
+        self.sha256 = None
+        self._file = HashingFile(open(self.tmp_filename, 'wb'))
+        self._wave = wave.open(self._file, 'wb')
+        self._wave.setnchannels(1)
+        self._wave.setsampwidth(4)
+        self._wave.setframerate(int(round(sample_rate)))
+        # the RIFF sizes are 32 bits, a larger count can only be a bad header
+        if n_frames is not None and 36 + 4 * n_frames < 1 << 32:
+            self._wave.setnframes(n_frames)
+
+    def write(self, samples):
+        self._wave.writeframesraw(np.ascontiguousarray(samples, dtype='<i4').tobytes())
+
+    def close(self):
+        self._wave.close()
+        self.sha256 = self._file.hexdigest()
+        self._file.close()
+        os.replace(self.tmp_filename, self.filename)
+
+    def abort(self):
+        self._wave.close()
+        self._file.close()
+        if os.path.exists(self.tmp_filename):
+            os.remove(self.tmp_filename)
+
+
+class FlacWriter:
+    """
+    Encode mono PCM to a 24 bit FLAC progressively through an ffmpeg pipe, nothing but the FLAC is written.
+    Hydrophone samples fit in 24 bits, write() raises ValueError on a sample that does not (the FLAC would not be lossless), the
+    caller then falls back to WavWriter.
+    ffmpeg fills in the STREAMINFO block (length, MD5 of the audio) at the start of the file once it is done, so the FLAC cannot
+    be hashed as it is written. It is hashed on close instead, right after ffmpeg exits while it is still in the page cache.
+    """
+    def __init__(self, filename, sample_rate, n_frames=None):
+        import subprocess
+
+        self.filename = filename
+        self.tmp_filename = filename + '.tmp'
+        self.sha256 = None
+        self._process = subprocess.Popen(
+            ['ffmpeg', '-v', 'error', '-y', '-f', 's24le', '-ar', str(int(round(sample_rate))), '-ac', '1', '-i', '-',
+             '-c:a', 'flac', '-f', 'flac', self.tmp_filename],
+            stdin=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+
+    def write(self, samples):
+        samples = np.ascontiguousarray(samples, dtype='<i4')
+        if len(samples) > 0 and (samples.max() >= 1 << 23 or samples.min() < -(1 << 23)):
+            raise ValueError("samples do not fit in 24 bits")
+        # the low three bytes of each little endian int32
+        self._process.stdin.write(samples.view(np.uint8).reshape(-1, 4)[:, :3].tobytes())
+
+    def close(self):
+        self._process.stdin.close()
+        error = self._process.stderr.read().decode(errors='replace')
+        if self._process.wait() != 0:
+            self.abort()
+            raise RuntimeError(f"ffmpeg failed to encode {self.filename}: {error.strip()}")
+        from .manifest import hash_file
+
+        self.sha256 = hash_file(self.tmp_filename)
+        os.replace(self.tmp_filename, self.filename)
+
+    def abort(self):
+        self._process.kill()
+        self._process.wait()
+        if os.path.exists(self.tmp_filename):
+            os.remove(self.tmp_filename)
+
+
+def convert_mseed(source, output_filename, target_sample_rate=None, ltsa_directory=None, records_per_chunk=RECORDS_PER_CHUNK, writer=None):
+    """
+    Convert an mseed file (filename or seekable file object) to output_filename without holding it in memory.
+    target_sample_rate: resample on the fly if it is below the native rate
+    ltsa_directory: add the LTSA of the native rate samples to ltsa.npz there
+    writer: a callable (filename, sample_rate, n_frames) -> object with write/close/abort and sha256 after close, default WavWriter
+    Returns (sample_rate written, number of samples written, sha256 of the output or None if the writer could not tell).
+    """
+    from .resample import StreamingResampler, to_pcm
+    from .spectral import LTSAAccumulator, write_ltsa
+
+    blocks = iter_samples(source, records_per_chunk)
+    header = next(blocks, None)
+    if header is None:
+        raise ValueError("no mseed records")
+    _, start_time, sample_rate = header
+
+    resampler = None
+    output_rate = sample_rate
+    if target_sample_rate is not None and target_sample_rate < sample_rate:
+        resampler = StreamingResampler(sample_rate, target_sample_rate)
+        output_rate = target_sample_rate
+    accumulator = LTSAAccumulator(sample_rate, start_time) if ltsa_directory is not None else None
+
+    out = (writer or WavWriter)(output_filename, output_rate, n_frames=expected_frames(source, target_sample_rate))
+    n_written = 0
+    try:
+        for block in blocks:
+            if accumulator is not None:
+                accumulator.update(block)
+            if resampler is not None:
+                block = to_pcm(resampler.process(block))
+            elif block.dtype.kind != 'i':
+                block = to_pcm(block)
+            out.write(block)
+            n_written += len(block)
+        if resampler is not None:
+            block = to_pcm(resampler.flush())
+            out.write(block)
+            n_written += len(block)
+        out.close()
+    except BaseException:
+        out.abort()
+        raise
+
+    if accumulator is not None:
+        result = accumulator.finalize()
+        if result is not None:
+            write_ltsa(ltsa_directory, result)
+    return output_rate, n_written, getattr(out, 'sha256', None)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+planner.py
+
+ dry runs. hydrophone-downloader plan_only=true ... resolves the query into the remote files it would download (OOI listings with
+ Content-Length, ONC getListByDevice with file sizes), prints the bytes and files per station with an estimated duration, and saves
+ the plan. hydrophone-downloader plan_file=<plan> ... then downloads exactly those deployments without repeating the discovery.
+"""
+
+import os
+import json
+import shutil
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from .reports import write_json
+from .storage import GB
+from .work_queue import json_default, json_object_hook
+
+
+PLAN_FILENAME = 'plan.json'
+# used for the duration until a download of the source has been measured in save_dir
+DEFAULT_BYTES_PER_SECOND = 5e6
+
+
+def default_plan_path(save_dir, shard_index=0, shard_count=1):
+    if shard_count > 1:
+        return os.path.join(save_dir, f"plan_shard_{shard_index:03d}_of_{shard_count:03d}.json")
+    return os.path.join(save_dir, PLAN_FILENAME)
+
+
+def plan_deployments(download_class, deployments, save_dir, threads=10):
+    """
+    Resolve the files of each deployment, `threads` at a time over the pooled session. Days without any data are dropped,
+    a deployment that could not be listed is kept without files and listed again when it is downloaded.
+    """
+    from .supported_classes.base_class import deployment_key
+
+    def plan(deployment):
+        source, station, date = deployment_key(deployment)
+        try:
+            entry = download_class.plan_deployment(deployment, save_dir)
+        except Exception as e:
+            print(f"Failed to list {source} {station} {date}: {e}")
+            entry = {'files': None, 'bytes': 0, 'disk_bytes': 0, 'error': str(e)}
+        entry.update({'source': source, 'station': station, 'date': date, 'deployment': deployment})
+        return entry
+
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        entries = list(executor.map(plan, deployments))
+    return [entry for entry in entries if entry['files'] is None or entry['bytes'] > 0]
+
+
+def summarize_plan(entries, bytes_per_second):
+    """
+    Totals per station and overall. bytes_per_second: {source: measured download rate or None}
+    """
+    stations = defaultdict(lambda: {'deployments': 0, 'files': 0, 'bytes': 0, 'disk_bytes': 0, 'unlisted': 0})
+    for entry in entries:
+        station = stations[f"{entry['source']} {entry['station']}"]
+        station['deployments'] += 1
+        station['files'] += len(entry['files'] or [])
+        station['bytes'] += entry['bytes']
+        station['disk_bytes'] += entry['disk_bytes']
+        station['unlisted'] += entry['files'] is None
+
+    seconds = sum(entry['bytes'] / (bytes_per_second.get(entry['source']) or DEFAULT_BYTES_PER_SECOND) for entry in entries)
+    return {
+        'deployments': len(entries),
+        'files': sum(s['files'] for s in stations.values()),
+        'bytes': sum(s['bytes'] for s in stations.values()),
+        'disk_bytes': sum(s['disk_bytes'] for s in stations.values()),
+        'estimated_seconds': round(seconds),
+        'bytes_per_second': bytes_per_second,
+        'stations': dict(sorted(stations.items())),
+    }
+
+
+def print_plan(summary, save_dir):
+    print(f"Plan: {summary['deployments']} deployments, {summary['files']} files")
+    for name, station in summary['stations'].items():
+        unlisted = f", {station['unlisted']} could not be listed" if station['unlisted'] else ""
+        print(f"  {name}: {station['deployments']} days, {station['files']} files, {station['bytes']/GB:.2f} GB download, "
+              f"{station['disk_bytes']/GB:.2f} GB on disk{unlisted}")
+    print(f"Total: {summary['bytes']/GB:.2f} GB download, {summary['disk_bytes']/GB:.2f} GB on disk")
+
+    for source, rate in summary['bytes_per_second'].items():
+        if rate is None:
+            print(f"  no {source} downloads measured in {save_dir} yet, assuming {DEFAULT_BYTES_PER_SECOND/1e6:.0f} MB/s")
+        else:
+            print(f"  {source} downloads measured at {rate/1e6:.1f} MB/s")
+    print(f"Estimated duration: {summary['estimated_seconds']/3600:.1f} hours for one process")
+
+    free = shutil.disk_usage(save_dir).free
+    if summary['disk_bytes'] > free:
+        print(f"WARNING: the plan needs {summary['disk_bytes']/GB:.2f} GB but only {free/GB:.2f} GB are free in {save_dir}")
+
+
+def write_plan(filename, query, save_dir, entries, summary):
+    filename = os.path.abspath(filename)
+    write_json(filename, {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'query': query,
+        'save_dir': save_dir,
+        'summary': summary,
+        'deployments': entries,
+    }, default=json_default)
+    print(f"Plan written to {filename}, download it with plan_file={filename}")
+    return filename
+
+
+def load_plan(filename):
+    """
+    The saved plan as {source: [deployment, ...]}, each deployment carries its listed files as deployment['planned_files'].
+    """
+    with open(filename) as f:
+        plan = json.load(f, object_hook=json_object_hook)
+
+    deployments = defaultdict(list)
+    for entry in plan['deployments']:
+        deployment = entry['deployment']
+        if entry['files'] is not None:
+            deployment['planned_files'] = entry['files']
+        deployments[entry['source']].append(deployment)
+
+    print(f"Loaded the plan {filename} ({plan['created']}): {plan['summary']['deployments']} deployments, "
+          f"{plan['summary']['bytes']/GB:.2f} GB")
+    return dict(deployments)
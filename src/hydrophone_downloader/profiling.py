@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+profiling.py
+
+ per-stage profiling for the CLI and the merge/convert scripts.
+
+ Each stage writes into the output directory:
+    <stage>.prof        cProfile stats (open with snakeviz or pstats)
+    <stage>.txt         the top functions by cumulative time
+    <stage>.collapsed   sampled call stacks in collapsed format (flamegraph.pl, speedscope, inferno)
+ and all stages are appended to all.collapsed with the stage name as the root frame.
+"""
+
+import os
+import sys
+import time
+import cProfile
+import pstats
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+
+PROFILE_MODES = ('cprofile', 'sampling')
+
+
+class StackSampler:
+    """
+    Sample the call stack of one thread at a fixed interval from a background thread.
+    """
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            # collapsed format is root first, separated by ';'
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def write_collapsed(self, filename, root=None, mode='w'):
+        with open(filename, mode) as f:
+            for stack, count in self.stacks.items():
+                if root is not None:
+                    stack = root + ';' + stack
+                f.write(f"{stack} {count}\n")
+
+
+class StageProfiler:
+    """
+    Profile named stages of a run. With mode=None every stage is a no-op, so callers can always wrap their stages.
+
+    mode='cprofile' runs cProfile and the stack sampler, mode='sampling' only runs the (cheaper) stack sampler.
+    """
+    def __init__(self, mode=None, output_dir='profile', interval=0.005):
+        if mode is True:
+            mode = 'cprofile'
+        if mode in (False, '', 'none', 'null'):
+            mode = None
+        if mode is not None and mode not in PROFILE_MODES:
+            raise ValueError(f"profile must be one of {PROFILE_MODES} or null, got {mode}")
+        self.mode = mode
+        self.output_dir = output_dir
+        self.interval = interval
+        self.timings = {}
+
+    @contextmanager
+    def stage(self, name):
+        if self.mode is None:
+            yield
+            return
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        sampler = StackSampler(threading.get_ident(), interval=self.interval)
+        profile = cProfile.Profile() if self.mode == 'cprofile' else None
+
+        start = time.perf_counter()
+        sampler.start()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            sampler.stop()
+            elapsed = time.perf_counter() - start
+            self.timings[name] = self.timings.get(name, 0.0) + elapsed
+            self._write(name, profile, sampler)
+            print(f"[profile] stage {name} took {elapsed:.2f}s, written to {self.output_dir}")
+
+    def _write(self, name, profile, sampler):
+        base = os.path.join(self.output_dir, name.replace(os.sep, '_'))
+        if profile is not None:
+            profile.dump_stats(base + '.prof')
+            with open(base + '.txt', 'w') as f:
+                stats = pstats.Stats(profile, stream=f)
+                stats.sort_stats('cumulative').print_stats(50)
+        sampler.write_collapsed(base + '.collapsed')
+        sampler.write_collapsed(os.path.join(self.output_dir, 'all.collapsed'), root=name, mode='a')
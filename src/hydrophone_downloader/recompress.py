@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+recompress.py
+
+ lossless WAV -> FLAC recompression, for the ONC days before 2021-04-09 that are only archived as WAV. Each file is encoded with
+ ffmpeg, both files are decoded and their PCM hashed, and the WAV is only replaced when the samples are identical.
+ The files are encoded in parallel, each by its own ffmpeg process.
+"""
+
+import os
+import glob
+import subprocess
+from shutil import which
+from concurrent.futures import ThreadPoolExecutor
+
+
+def ffmpeg_available():
+    return which('ffmpeg') is not None
+
+
+def pcm_digest(filename):
+    """
+    SHA-256 of the decoded samples (as 32 bit PCM, which holds 16 and 24 bit audio exactly), independent of the container.
+    """
+    output = subprocess.run(
+        ['ffmpeg', '-v', 'error', '-i', filename, '-map', '0:a', '-c:a', 'pcm_s32le', '-f', 'hash', '-hash', 'sha256', '-'],
+        check=True, capture_output=True, text=True,
+    ).stdout
+    return output.strip().split('=', 1)[1]
+
+
+def recompress_file(wav_filename, compression_level=5):
+    """
+    Encode wav_filename to FLAC next to it and delete the WAV if the round trip is sample-exact.
+    Returns {'wav', 'flac', 'status': 'done' | 'mismatch' | 'failed', 'wav_bytes', 'flac_bytes', 'sha256', 'error'}
+    """
+    from .manifest import hash_file
+
+    flac_filename = os.path.splitext(wav_filename)[0] + '.flac'
+    tmp_filename = flac_filename + '.tmp'
+    result = {'wav': wav_filename, 'flac': flac_filename, 'status': 'failed', 'wav_bytes': os.path.getsize(wav_filename),
+              'flac_bytes': None, 'sha256': None, 'error': None}
+    try:
+        subprocess.run(['ffmpeg', '-v', 'error', '-y', '-i', wav_filename, '-map', '0:a', '-c:a', 'flac',
+                        '-compression_level', str(compression_level), '-f', 'flac', tmp_filename],
+                       check=True, capture_output=True, text=True)
+        if pcm_digest(wav_filename) != pcm_digest(tmp_filename):
+            result['status'] = 'mismatch'
+            result['error'] = 'the FLAC does not decode to the same samples, keeping the WAV'
+            return result
+
+        os.replace(tmp_filename, flac_filename)
+        os.remove(wav_filename)
+        result.update(status='done', flac_bytes=os.path.getsize(flac_filename), sha256=hash_file(flac_filename))
+    except subprocess.CalledProcessError as e:
+        result['error'] = (e.stderr or str(e)).strip()
+    except Exception as e:
+        result['error'] = str(e)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+    return result
+
+
+def recompress_files(filenames, workers=None, manifest=None):
+    """
+    Recompress the WAV files with `workers` ffmpeg processes at a time (default: one per CPU). The manifest, if given,
+    gets the FLAC files in place of the WAV files. Returns the result of each file.
+    """
+    filenames = [f for f in filenames if f.endswith('.wav')]
+    if len(filenames) == 0:
+        return []
+    if not ffmpeg_available():
+        print("ffmpeg is not installed, keeping the WAV files")
+        return []
+
+    # the work happens in the ffmpeg processes, threads are enough to keep `workers` of them busy
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        results = list(executor.map(recompress_file, filenames))
+
+    for result in results:
+        if result['status'] == 'done':
+            if manifest is not None:
+                entry = manifest.get(result['wav']) or {}
+                manifest.forget(result['wav'])
+                manifest.record(result['flac'], result['sha256'], source=entry.get('source'), url=entry.get('url'))
+        else:
+            print(f"Could not recompress {result['wav']}: {result['error']}")
+
+    done = [r for r in results if r['status'] == 'done']
+    wav_bytes = sum(r['wav_bytes'] for r in done)
+    flac_bytes = sum(r['flac_bytes'] for r in done)
+    if len(done) > 0:
+        print(f"Recompressed {len(done)}/{len(results)} WAV files to FLAC: {wav_bytes/1e6:.1f} MB -> {flac_bytes/1e6:.1f} MB "
+              f"({wav_bytes/max(flac_bytes, 1):.2f}x)")
+    return results
+
+
+def recompress_directory(directory, workers=None):
+    """
+    Recompress every WAV under directory (e.g. the ONC holdings downloaded before the recompression stage existed)
+    """
+    from .manifest import Manifest, MANIFEST_FILENAME
+
+    filenames = sorted(glob.glob(os.path.join(directory, '**', '*.wav'), recursive=True))
+    print(f"Found {len(filenames)} WAV files in {directory}")
+    manifest = Manifest(directory) if os.path.exists(os.path.join(directory, MANIFEST_FILENAME)) else None
+    return recompress_files(filenames, workers=workers, manifest=manifest)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+reports.py
+
+ per-shard run reports, written to <save_dir>/reports/. Each machine runs its shard into its own local save_dir, the reports are
+ copied into one reports/ folder and merged into one report there.
+"""
+
+import os
+import re
+import json
+import glob
+import socket
+from collections import defaultdict
+from datetime import datetime
+
+
+REPORTS_DIR = 'reports'
+SHARD_REPORT = re.compile(r'shard_(\d+)_of_(\d+)\.json$')
+
+
+def shard_report_path(save_dir, shard_index, shard_count):
+    return os.path.join(save_dir, REPORTS_DIR, f"shard_{shard_index:03d}_of_{shard_count:03d}.json")
+
+
+def summarize(results):
+    """
+    {source: {status: count}} for a list of deployment results
+    """
+    summary = defaultdict(lambda: defaultdict(int))
+    for result in results:
+        summary[result['source']][result['status']] += 1
+    return {source: dict(counts) for source, counts in summary.items()}
+
+
+def write_json(filename, obj, default=str):
+    """
+    Write to a temp file and rename, so a reader on a shared save_dir never sees half a file.
+    """
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmp_filename = f"{filename}.{socket.gethostname()}.{os.getpid()}.tmp"
+    with open(tmp_filename, 'w') as f:
+        json.dump(obj, f, indent=2, default=default)
+    os.replace(tmp_filename, filename)
+
+
+def write_shard_report(save_dir, shard_index, shard_count, query, results, started):
+    filename = shard_report_path(save_dir, shard_index, shard_count)
+    write_json(filename, {
+        'shard_index': shard_index,
+        'shard_count': shard_count,
+        'hostname': socket.gethostname(),
+        'started': started,
+        'finished': datetime.now().isoformat(timespec='seconds'),
+        'query': query,
+        'summary': summarize(results),
+        'deployments': results,
+    })
+    print(f"Report for shard {shard_index}/{shard_count} written to {filename}")
+    return filename
+
+
+def merge_shard_reports(save_dir):
+    """
+    Combine the shard reports in <save_dir>/reports into merged_report.json. If reports of several shard counts exist (e.g. a rerun
+    with more machines), the most recently written set is merged.
+    """
+    by_count = defaultdict(dict)
+    for filename in glob.glob(os.path.join(save_dir, REPORTS_DIR, 'shard_*_of_*.json')):
+        match = SHARD_REPORT.search(filename)
+        with open(filename) as f:
+            by_count[int(match.group(2))][int(match.group(1))] = (os.path.getmtime(filename), json.load(f))
+
+    if len(by_count) == 0:
+        print(f"No shard reports found in {os.path.join(save_dir, REPORTS_DIR)}")
+        return None
+
+    shard_count = max(by_count, key=lambda count: max(mtime for mtime, _ in by_count[count].values()))
+    if len(by_count) > 1:
+        print(f"Found reports for shard counts {sorted(by_count)}, merging the latest ({shard_count})")
+    reports = {index: report for index, (_, report) in by_count[shard_count].items()}
+
+    queries = {json.dumps(report['query'], sort_keys=True, default=str) for report in reports.values()}
+    if len(queries) > 1:
+        print("WARNING: the shard reports were produced by different queries")
+
+    deployments = sorted((d for report in reports.values() for d in report['deployments']), key=lambda d: (d['source'], d['station'], d['date']))
+    merged = {
+        'shard_count': shard_count,
+        'shards_found': sorted(reports),
+        'missing_shards': sorted(set(range(shard_count)) - set(reports)),
+        'hosts': sorted({report['hostname'] for report in reports.values()}),
+        'started': min(report['started'] for report in reports.values()),
+        'finished': max(report['finished'] for report in reports.values()),
+        'query': next(iter(reports.values()))['query'],
+        'summary': summarize(deployments),
+        'failed': [d for d in deployments if d['status'] != 'done'],
+        'deployments': deployments,
+    }
+
+    filename = os.path.join(save_dir, REPORTS_DIR, 'merged_report.json')
+    write_json(filename, merged)
+
+    print(f"Merged {len(reports)}/{shard_count} shard reports into {filename}")
+    for source, counts in merged['summary'].items():
+        print(f"  {source}: " + ", ".join(f"{count} {status}" for status, count in sorted(counts.items())))
+    if merged['missing_shards']:
+        print(f"  missing shards: {merged['missing_shards']}")
+    return merged
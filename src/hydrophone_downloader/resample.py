@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+resample.py
+
+ streaming polyphase resampling, so audio can be brought down to a target sample rate block by block during conversion.
+"""
+
+from math import gcd
+
+import numpy as np
+
+
+class StreamingResampler:
+    """
+    Polyphase resampler that can be fed blocks of any size. It uses the same anti-aliasing filter as scipy.signal.resample_poly
+    and the concatenated output of process() + flush() matches resample_poly on the whole signal (up to the usual edge effects).
+
+    resampler = StreamingResampler(64000, 16000)
+    for block in blocks:
+        write(resampler.process(block))
+    write(resampler.flush())
+    """
+    def __init__(self, orig_rate, target_rate, window=('kaiser', 5.0)):
+        from scipy.signal import firwin
+
+        orig_rate, target_rate = int(round(orig_rate)), int(round(target_rate))
+        divisor = gcd(orig_rate, target_rate)
+        self.up = target_rate // divisor
+        self.down = orig_rate // divisor
+        self.orig_rate = orig_rate
+        self.target_rate = target_rate
+
+        max_rate = max(self.up, self.down)
+        # equal rates pass the samples through, firwin cannot design a filter with the cutoff at Nyquist
+        half_len = 10 * max_rate if max_rate > 1 else 0
+        self._h = firwin(2 * half_len + 1, 1.0 / max_rate, window=window) * self.up if max_rate > 1 else np.ones(1)
+        # output n sits at upsampled index n * down + delay, which removes the group delay of the filter
+        self._delay = half_len
+        # input sample s starts a batch whose first output lands on the output grid when s * up = delay (mod down)
+        self._phase = (self._delay * pow(self.up, -1, self.down)) % self.down if self.down > 1 else 0
+
+        self._history = np.zeros(0)
+        self._history_start = 0
+        self._consumed = 0
+        self._next = 0
+
+    @property
+    def filter_length(self):
+        """
+        Taps of the anti-aliasing filter, a block needs about filter_length / up input samples before its outputs settle
+        """
+        return len(self._h)
+
+    @property
+    def passthrough(self):
+        return self.up == self.down
+
+    def _batch_start(self, n):
+        """
+        The input index to start a batch at so that output n is computed from a full filter window.
+        """
+        first = (n * self.down + self._delay - (len(self._h) - 1)) // self.up
+        return first - ((first - self._phase) % self.down)
+
+    def _emit(self, last):
+        from scipy.signal import upfirdn
+
+        if last < self._next:
+            return np.zeros(0)
+
+        start = self._batch_start(self._next)
+        if start < self._history_start:
+            # before the first sample (or a gap in what we kept) counts as silence
+            self._history = np.concatenate([np.zeros(self._history_start - start), self._history])
+            self._history_start = start
+        x = self._history[start - self._history_start:]
+
+        first = (self._next * self.down + self._delay - start * self.up) // self.down
+        count = last - self._next + 1
+        out = upfirdn(self._h, x, self.up, self.down)[first:first + count]
+        self._next = last + 1
+
+        # drop the input that no later output needs
+        keep_from = max(self._batch_start(self._next), self._history_start)
+        self._history = self._history[keep_from - self._history_start:]
+        self._history_start = keep_from
+        return out
+
+    def process(self, block):
+        block = np.asarray(block, dtype=np.float64)
+        if self.passthrough:
+            return block
+        self._history = np.concatenate([self._history, block])
+        self._consumed += len(block)
+        # output n needs input up to upsampled index n * down + delay
+        last = (self._consumed * self.up - 1 - self._delay) // self.down
+        return self._emit(last)
+
+    def flush(self):
+        """
+        Return the outputs still held back by the filter delay, the total output length is ceil(n_in * up / down).
+        """
+        if self.passthrough:
+            return np.zeros(0)
+        total = -(-self._consumed * self.up // self.down)
+        self._history = np.concatenate([self._history, np.zeros(len(self._h) // self.up + self.down + 1)])
+        return self._emit(total - 1)
+
+
+def resample_blocks(blocks, orig_rate, target_rate):
+    """
+    Resample an iterable of blocks, yielding resampled blocks.
+    """
+    resampler = StreamingResampler(orig_rate, target_rate)
+    for block in blocks:
+        out = resampler.process(block)
+        if len(out):
+            yield out
+    out = resampler.flush()
+    if len(out):
+        yield out
+
+
+def resample(samples, orig_rate, target_rate, block_size=1 << 20):
+    """
+    Resample a 1-D array in blocks of block_size samples, so the temporary arrays stay bounded for long files.
+    """
+    samples = np.asarray(samples)
+    blocks = (samples[i:i + block_size] for i in range(0, len(samples), block_size))
+    out = list(resample_blocks(blocks, orig_rate, target_rate))
+    return np.concatenate(out) if out else np.zeros(0)
+
+
+def resample_channels(samples, orig_rate, target_rate):
+    """
+    Resample each channel of a (n_frames, n_channels) array and return integer PCM of the same dtype.
+    """
+    samples = np.asarray(samples)
+    if samples.ndim == 1:
+        return to_pcm(resample(samples, orig_rate, target_rate), samples.dtype)
+    return np.stack([to_pcm(resample(samples[:, c], orig_rate, target_rate), samples.dtype) for c in range(samples.shape[1])], axis=1)
+
+
+def to_pcm(samples, dtype=np.int32):
+    """
+    Round and clip resampled float samples back to integer PCM.
+    """
+    info = np.iinfo(dtype)
+    return np.clip(np.rint(samples), info.min, info.max).astype(dtype)
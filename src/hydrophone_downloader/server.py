@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+server.py
+
+ a long-running daemon for workflow engines that launch many small (per-station, per-day) jobs. A CLI run pays for the config
+ composition, the heavy imports, the catalog discovery and new connections every time; the daemon pays once and keeps the
+ download classes (with their catalogs), the pooled HTTP session and a pool of job threads warm.
+
+    hydrophone-downloader-serve serve_workers=4
+    hydrophone-downloader-submit save_dir=/data/sonifications start_time=2025-01-01 end_time=2025-01-01 min_latitude=47 ...
+
+ The protocol is JSON lines over a Unix socket (readable by the user only). The client sends one request line and reads event
+ lines back until the server closes the connection:
+
+    {"command": "download", "query": {"save_dir": ..., "start_time": "2025-01-01", "end_time": "2025-01-01", "min_lat": 47, ...}}
+        -> {"event": "accepted", "job": 3}, {"event": "started", "job": 3, "total": 2},
+           {"event": "progress", "job": 3, "done": 1, "total": 2, "source": ..., "station": ..., "date": ..., "status": "done", ...},
+           ..., {"event": "done", "job": 3, "deployments": 2, "failed": 0}
+    {"command": "ping"}      -> {"event": "pong", "sources": [...], "jobs": {...}}
+    {"command": "status"}    -> {"event": "status", "jobs": [...]}
+    {"command": "refresh"}   -> rediscover the catalogs, {"event": "refreshed", ...}
+    {"command": "shutdown"}  -> {"event": "bye"}
+
+ A job keeps running if its client disconnects. Only the standard library is imported here, so a client does not pay for the
+ heavy imports either.
+"""
+
+import os
+import copy
+import json
+import time
+import socket
+import tempfile
+import threading
+import socketserver
+from concurrent.futures import ThreadPoolExecutor
+
+
+# finished jobs kept for the status command
+MAX_FINISHED_JOBS = 1000
+
+
+def default_socket_path():
+    return os.path.join(tempfile.gettempdir(), f"hydrophone-downloader-{os.getuid()}.sock")
+
+
+class DownloadServer:
+    def __init__(self, options=None, workers=4, catalog_max_age_hours=24):
+        """
+        options: keyword arguments for the download classes (see cli.source_options)
+        workers: jobs run at the same time
+        catalog_max_age_hours: rediscover a source's catalog before a job once it is older than this
+        """
+        self.options = options or {}
+        self.catalog_max_age = catalog_max_age_hours * 3600
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.classes = {}
+        self.discovered = {}
+        self.source_locks = {}
+        self.jobs = {}
+        self._next_job = 1
+        self._lock = threading.Lock()
+
+    def warm(self):
+        """
+        Import the sources, create the download classes and discover their catalogs
+        """
+        from .downloader import source_classes
+
+        for source, download_class in source_classes().items():
+            start = time.time()
+            try:
+                self.classes[source] = download_class(**self.options)
+                self.classes[source].discover()
+            except Exception as e:
+                print(f"{source} is not available: {e}")
+                self.classes.pop(source, None)
+                continue
+            self.discovered[source] = time.time()
+            self.source_locks[source] = threading.Lock()
+            print(f"{source}: {len(self.classes[source].deployments)} deployments discovered in {time.time()-start:.1f}s")
+
+    def refresh(self, source=None, max_age=None):
+        """
+        Discover the catalogs again. max_age: skip a source discovered less than max_age seconds ago (by another job meanwhile)
+        Raises ValueError for a source the server does not have.
+        """
+        if source and source not in self.classes:
+            raise ValueError(f"Unknown or unavailable source {source}, the server has {list(self.classes)}")
+        for name in ([source] if source else list(self.classes)):
+            with self.source_locks[name]:
+                if max_age is not None and time.time() - self.discovered[name] <= max_age:
+                    continue
+                # built aside and swapped in with one assignment, jobs running meanwhile keep using the old catalog instead of
+                # finding none and discovering it a second time
+                deployments = self.classes[name].get_deployments()
+                self.classes[name].deployments = deployments
+                self.discovered[name] = time.time()
+        return {name: len(self.classes[name].deployments) for name in self.classes}
+
+    def download_class(self, source):
+        if source not in self.classes:
+            raise ValueError(f"Unknown or unavailable source {source}, the server has {list(self.classes)}")
+        if time.time() - self.discovered[source] > self.catalog_max_age:
+            print(f"The {source} catalog is older than {self.catalog_max_age/3600:g} h, discovering it again")
+            self.refresh(source, max_age=self.catalog_max_age)
+        return self.classes[source]
+
+    def submit(self, query, emit):
+        with self._lock:
+            job_id = self._next_job
+            self._next_job += 1
+            self.jobs[job_id] = {'job': job_id, 'status': 'queued', 'query': query, 'done': 0, 'total': None, 'submitted': time.time()}
+            finished = [j for j, job in self.jobs.items() if job['status'] in ('done', 'failed')]
+            for j in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+                del self.jobs[j]
+        self.executor.submit(self.run_job, job_id, query, emit)
+        return job_id
+
+    def run_job(self, job_id, query, emit):
+        from .supported_classes.base_class import DEFAULT_QUERY
+
+        job = self.jobs[job_id]
+        job['status'] = 'running'
+        try:
+            save_dir = query['save_dir']
+            planned = None
+            if query.get('plan_file'):
+                from .planner import load_plan
+                planned = load_plan(query['plan_file'])
+
+            work = []
+            for source in query.get('sources') or list(self.classes):
+                download_class = self.download_class(source)
+                if planned is not None:
+                    deployments = planned.get(source, [])
+                else:
+                    q = dict(DEFAULT_QUERY, **{k: v for k, v in query.items() if k in DEFAULT_QUERY})
+                    deployments = download_class.filter_deployments(q['min_lat'], q['max_lat'], q['min_lon'], q['max_lon'], q['min_depth'],
+                                                                    q['max_depth'], q['license'], query['start_time'], query['end_time'])
+                work += [(source, deployment) for deployment in deployments]
+
+            job['total'] = len(work)
+            emit({'event': 'started', 'job': job_id, 'total': len(work)})
+            failed = 0
+            for source, deployment in work:
+                download_class = self.classes[source]
+                # the download classes add fields to the deployment dict, the catalog must stay as discovered
+                deployment = copy.deepcopy(deployment)
+                if download_class.concurrent_downloads:
+                    result = download_class.download_deployments([deployment], save_dir)[0]
+                else:
+                    with self.source_locks[source]:
+                        result = download_class.download_deployments([deployment], save_dir)[0]
+                job['done'] += 1
+                failed += result['status'] != 'done'
+                emit(dict(result, event='progress', job=job_id, done=job['done'], total=len(work)))
+
+            job.update(status='done' if failed == 0 else 'failed', failed=failed, finished=time.time())
+            emit({'event': 'done', 'job': job_id, 'deployments': len(work), 'failed': failed})
+        except Exception as e:
+            job.update(status='failed', error=str(e), finished=time.time())
+            emit({'event': 'failed', 'job': job_id, 'error': str(e)})
+
+    def job_counts(self):
+        counts = {}
+        for job in list(self.jobs.values()):
+            counts[job['status']] = counts.get(job['status'], 0) + 1
+        return counts
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def send(self, event):
+        self.wfile.write((json.dumps(event, default=str) + '\n').encode('utf-8'))
+        self.wfile.flush()
+
+    def handle(self):
+        app = self.server.app
+        try:
+            message = json.loads(self.rfile.readline().decode('utf-8'))
+            command = message.get('command')
+        except ValueError as e:
+            self.send({'event': 'error', 'error': f"not a JSON request: {e}"})
+            return
+
+        if command == 'ping':
+            self.send({'event': 'pong', 'sources': list(app.classes), 'jobs': app.job_counts()})
+        elif command == 'status':
+            self.send({'event': 'status', 'jobs': list(app.jobs.values())})
+        elif command == 'refresh':
+            try:
+                deployments = app.refresh(message.get('source'))
+            except Exception as e:
+                # an unknown source or a failed discovery, the client gets the error instead of a closed connection
+                self.send({'event': 'error', 'error': str(e)})
+                return
+            self.send({'event': 'refreshed', 'deployments': deployments})
+        elif command == 'shutdown':
+            self.send({'event': 'bye'})
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+        elif command == 'download':
+            query = message.get('query') or {}
+            needed = ('save_dir',) if query.get('plan_file') else ('save_dir', 'start_time', 'end_time')
+            missing = [k for k in needed if query.get(k) is None]
+            if missing:
+                self.send({'event': 'error', 'error': f"the query needs {missing}"})
+                return
+            import queue
+
+            events = queue.Queue()
+            job_id = app.submit(query, events.put)
+            self.send({'event': 'accepted', 'job': job_id})
+            while True:
+                event = events.get()
+                try:
+                    self.send(event)
+                except OSError:
+                    # the client went away, the job carries on
+                    return
+                if event['event'] in ('done', 'failed'):
+                    return
+        else:
+            self.send({'event': 'error', 'error': f"unknown command {command}"})
+
+
+def serve(socket_path=None, options=None, workers=4, catalog_max_age_hours=24):
+    """
+    Warm up and serve requests on socket_path until a shutdown request (or Ctrl-C)
+    """
+    socket_path = socket_path or default_socket_path()
+    if os.path.exists(socket_path):
+        try:
+            next(request({'command': 'ping'}, socket_path))
+            raise RuntimeError(f"A server is already listening on {socket_path}")
+        except OSError:
+            # left behind by a server that died
+            os.remove(socket_path)
+
+    app = DownloadServer(options, workers=workers, catalog_max_age_hours=catalog_max_age_hours)
+    app.warm()
+    server = socketserver.ThreadingUnixStreamServer(socket_path, RequestHandler)
+    server.daemon_threads = True
+    server.app = app
+    os.chmod(socket_path, 0o600)
+    print(f"Serving on {socket_path} with {workers} job threads")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        app.executor.shutdown(wait=False)
+    print("Server stopped")
+
+
+def request(message, socket_path=None, timeout=None):
+    """
+    Send one request and yield the events the server sends back
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path or default_socket_path())
+        sock.sendall((json.dumps(message, default=str) + '\n').encode('utf-8'))
+        with sock.makefile('r', encoding='utf-8') as f:
+            for line in f:
+                yield json.loads(line)
+
+
+def submit(query, socket_path=None):
+    """
+    Run a download job on the server, yielding its progress events
+    """
+    return request({'command': 'download', 'query': query}, socket_path)
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+sonify.py
+
+ time-compressed sonifications (audification) of a station recording, e.g. a day rendered as 24 minutes:
+
+    from hydrophone_downloader.sonify import sonify
+
+    sonify('sonifications/', 'ICLISTENHF1234_20250101_x60.flac', station='ICLISTENHF1234',
+           start_time='2025-01-01', end_time='2025-01-02', speed=60, band=(10, 400))
+
+ station is the ONC device code, or for OOI the hydrophone in the file names (OO-HYEA2--YDH) or the reference designator.
+
+ Playing the samples `speed` times faster multiplies their frequencies by `speed`: at 60x, 5-400 Hz becomes 300 Hz-24 kHz. The
+ recording is treated as sampled at sample_rate * speed and resampled to the output rate, which also low-passes it to what stays
+ audible. band=(low, high) band-passes the recording first and, with shift=True, mixes the band down to start at 0 Hz so a band
+ that would end up above hearing is rendered too.
+
+ The timeline is cut into segments rendered by a process pool. Each worker reads its segment (plus padding for the filters to
+ settle) in blocks from the WAV/FLAC files and streams it through the band-pass filter and a StreamingResampler. Without a band
+ the segments join exactly as a single pass would. The band-pass filter is IIR and starts each segment from rest, so with a band
+ the joins match a single pass only to within what is left of its start-up transient after the padding (far below 16 bit PCM).
+ Gaps between files are silent.
+
+ The resampling ratio is rounded to a fraction with small terms (see rate_ratio), so the speed, and the duration, can differ
+ very slightly from what was asked for; the actual duration is printed.
+"""
+
+import os
+import wave
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+
+
+OUTPUT_SAMPLE_RATE = 48000
+# input samples per block inside a worker
+BLOCK_FRAMES = 1 << 20
+# timeline seconds per worker task
+SEGMENT_SECONDS = 3600
+# largest term of the playback/output rate ratio, the resampler filter has ~20 taps per unit of it
+MAX_RATIO_TERM = 2000
+
+
+def _timestamp(value):
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.timestamp()
+    return float(value)
+
+
+def file_of_station(filename, station):
+    """
+    Whether filename is audio of station: the station in its name (ONC device, OOI OO-HY...), or for the OOI day folders
+    (<site>/<node>/<port>-<instrument>/YYYY/MM/DD/) the reference designator of the deployments, matched on its site and node
+    """
+    from .envelope import file_station
+
+    if file_station(filename) == station:
+        return True
+    folders = os.path.dirname(os.path.abspath(filename)).split(os.sep)
+    designator = station.split('-')
+    return len(designator) >= 2 and len(folders) >= 6 and folders[-6:-4] == designator[:2]
+
+
+def station_files(roots, station):
+    """
+    The probed WAV/FLAC files of station under roots, sorted by start time, at the sample rate most of them have
+    """
+    from .dataset import find_audio_files, probe, file_start_time
+
+    files = []
+    for filename in find_audio_files(roots):
+        if not file_of_station(filename, station):
+            continue
+        start_time = file_start_time(filename)
+        if start_time is None:
+            continue
+        try:
+            info = probe(filename)
+        except Exception as e:
+            print(f"Skipping {filename}: {e}")
+            continue
+        info['start_time'] = start_time.timestamp()
+        files.append(info)
+    if len(files) == 0:
+        raise FileNotFoundError(f"No audio of {station} under {roots}")
+
+    sample_rate = Counter(f['sample_rate'] for f in files).most_common(1)[0][0]
+    skipped = [f['path'] for f in files if f['sample_rate'] != sample_rate]
+    if skipped:
+        print(f"Skipping {len(skipped)} files that are not at {sample_rate} Hz: {skipped[:3]}...")
+    return sorted([f for f in files if f['sample_rate'] == sample_rate], key=lambda f: f['start_time']), sample_rate
+
+
+def read_range(files, start, n_frames):
+    """
+    Frames [start, start + n_frames) of the timeline (first channel, scaled to [-1, 1)), files carry their 'offset' on it.
+    Gaps, and anything before the first or after the last file, are zeros.
+    """
+    from .dataset import read_frames
+
+    out = np.zeros(n_frames)
+    for info in files:
+        first = max(start, info['offset'])
+        last = min(start + n_frames, info['offset'] + info['n_frames'])
+        if first >= last:
+            continue
+        samples = read_frames(info, first - info['offset'], last - first)[:, 0]
+        out[first - start:last - start] = samples / info['scale']
+    return out
+
+
+def rate_ratio(playback_rate, output_rate, max_term=MAX_RATIO_TERM):
+    """
+    playback_rate / output_rate as a Fraction whose terms stay around max_term. An arbitrary speed (from duration_seconds) would
+    otherwise share almost no factor with the output rate, e.g. 1493679/16000, and need a filter of tens of millions of taps.
+    """
+    from fractions import Fraction
+
+    ratio = Fraction(playback_rate) / output_rate
+    return ratio.limit_denominator(max(1, int(max_term / max(float(ratio), 1.0))))
+
+
+def render_segment(job):
+    """
+    Render timeline frames [start, stop) to output samples. Runs in a worker process, job is a dict (see sonify).
+    The resampler and band-pass filter are started `pad` frames early and fed `pad` frames past the end, and the outputs for
+    the padding are dropped, so consecutive segments line up with a single pass over the whole timeline (exactly without a band,
+    see the module docstring).
+    """
+    from .resample import StreamingResampler
+
+    # the ratio as (input, output) rates, see rate_ratio
+    resampler = StreamingResampler(*job['ratio'])
+    up, down = resampler.up, resampler.down
+    sos = job['sos']
+    zi = None
+    if sos is not None:
+        from scipy.signal import sosfilt
+
+        zi = np.zeros((sos.shape[0], 2))
+
+    start, stop, pad = job['start'], job['stop'], job['pad']
+    last = job['stop'] >= job['end']
+    read_stop = stop if last else stop + pad
+    outputs = []
+    position = start - pad
+    while position < read_stop:
+        n = min(BLOCK_FRAMES, read_stop - position)
+        block = read_range(job['files'], position, n)
+        if sos is not None:
+            block, zi = sosfilt(sos, block, zi=zi)
+        if job['shift'] is not None:
+            # mix the band down, the difference frequencies start at 0 Hz and the resampler removes the sums
+            t = np.arange(position, position + n) / job['sample_rate']
+            block = block * (2 * np.cos(2 * np.pi * job['shift'] * t))
+        outputs.append(resampler.process(block))
+        position += n
+    if last:
+        outputs.append(resampler.flush())
+
+    out = np.concatenate(outputs)
+    skip = pad * up // down
+    count = -(-(stop - start) * up // down) if last else (stop - start) * up // down
+    return out[skip:skip + count].astype(np.float32)
+
+
+def sonify(roots, output, station, start_time=None, end_time=None, speed=None, duration_seconds=None, band=None, shift=True,
+           output_rate=OUTPUT_SAMPLE_RATE, workers=None, segment_seconds=SEGMENT_SECONDS, normalize=True, gain=1.0):
+    """
+    Render the recording of station between start_time and end_time (datetimes, ISO strings or POSIX seconds, default all of it)
+    to output (.wav, .flac or .mp3), speed times faster than real time or lasting duration_seconds.
+    band: (low, high) Hz of the recording to keep, shift: mix that band down to 0 Hz before compressing it.
+    normalize: scale the loudest sample to 0.9 full scale (gain multiplies it either way). Returns the output filename.
+    """
+    from scipy.signal import butter
+    from .cache import record_access
+
+    files, sample_rate = station_files(roots, station)
+    start = _timestamp(start_time) if start_time is not None else files[0]['start_time']
+    end = _timestamp(end_time) if end_time is not None else max(f['start_time'] + f['n_frames'] / f['sample_rate'] for f in files)
+    assert end > start, "end_time must be after start_time"
+    assert (speed is None) != (duration_seconds is None), "give either speed or duration_seconds"
+    if speed is None:
+        speed = (end - start) / duration_seconds
+
+    for info in files:
+        info['offset'] = int(round((info['start_time'] - start) * sample_rate))
+    total = int(round((end - start) * sample_rate))
+    files = [f for f in files if f['offset'] < total and f['offset'] + f['n_frames'] > 0]
+    record_access([f['path'] for f in files])
+
+    ratio = rate_ratio(sample_rate * speed, output_rate)
+    actual_speed = float(ratio) * output_rate / sample_rate
+    if abs(actual_speed - speed) > 1e-9 * speed:
+        print(f"Rendering at {actual_speed:.6g}x instead of {speed:.6g}x ({(end - start)/actual_speed:.1f} s instead of "
+              f"{(end - start)/speed:.1f} s), so the resampling filter stays small")
+    speed = actual_speed
+    audible = output_rate / 2 / speed
+    sos, mix = None, None
+    if band is not None:
+        low, high = band
+        sos = butter(4, [max(low, 1e-3), min(high, 0.99 * sample_rate / 2)], btype='bandpass', fs=sample_rate, output='sos')
+        if shift and low > 0:
+            mix = low
+            if 2 * low < audible:
+                print(f"The band starts below {audible/2:.1f} Hz, part of the image left by mixing it down (at frequency + {low} Hz) stays audible")
+        if (high - (mix or 0)) > audible:
+            print(f"At {speed:g}x only up to {audible + (mix or 0):.1f} Hz of the recording stays below {output_rate/2:.0f} Hz")
+
+    from .resample import StreamingResampler
+
+    resampler = StreamingResampler(ratio.numerator, ratio.denominator)
+    up, down = resampler.up, resampler.down
+    # segments start on multiples of down, so each one begins exactly on an output sample
+    segment = max(down, int(segment_seconds * sample_rate) // down * down)
+    pad = resampler.filter_length // up + 2 * down
+    if band is not None:
+        # let the band-pass filter settle, ~20 periods of the lowest frequency
+        pad += int(20 * sample_rate / max(band[0], 1.0))
+    pad = -(-pad // down) * down
+
+    jobs = [{'files': [f for f in files if f['offset'] < min(s + segment, total) + pad and f['offset'] + f['n_frames'] > s - pad],
+             'start': s, 'stop': min(s + segment, total), 'end': total, 'pad': pad, 'sample_rate': sample_rate,
+             'ratio': (ratio.numerator, ratio.denominator), 'sos': sos, 'shift': mix}
+            for s in range(0, total, segment)]
+    print(f"Rendering {(end - start)/3600:.2f} h of {station} from {len(files)} files at {speed:g}x "
+          f"({(end - start)/speed/60:.1f} min) in {len(jobs)} segments")
+
+    raw_filename = output + '.f32.tmp'
+    peak = 0.0
+    n_written = 0
+    with open(raw_filename, 'wb') as raw, ProcessPoolExecutor(max_workers=workers) as executor:
+        # a few segments in flight per worker, so memory stays bounded for long timelines
+        pending = deque()
+        jobs = iter(jobs)
+        for job in jobs:
+            pending.append(executor.submit(render_segment, job))
+            if len(pending) >= 2 * (workers or os.cpu_count()):
+                break
+        while pending:
+            out = pending.popleft().result()
+            job = next(jobs, None)
+            if job is not None:
+                pending.append(executor.submit(render_segment, job))
+            if len(out):
+                peak = max(peak, float(np.abs(out).max()))
+            raw.write(out.tobytes())
+            n_written += len(out)
+
+    scale = gain * (0.9 / peak if normalize and peak > 0 else 1.0)
+    try:
+        write_output(raw_filename, output, output_rate, scale)
+    finally:
+        os.remove(raw_filename)
+    print(f"Wrote {output}: {n_written / output_rate / 60:.1f} min at {output_rate} Hz")
+    return output
+
+
+def write_output(raw_filename, output, output_rate, scale, block_frames=BLOCK_FRAMES):
+    """
+    Scale the rendered float32 samples to 16 bit PCM and write them as WAV, or encode them with ffmpeg (.flac, .mp3, ...)
+    """
+    samples = np.memmap(raw_filename, dtype=np.float32, mode='r') if os.path.getsize(raw_filename) > 0 else np.zeros(0, dtype=np.float32)
+
+    def pcm_blocks():
+        for i in range(0, len(samples), block_frames):
+            yield np.clip(np.rint(samples[i:i + block_frames] * scale * 32767), -32768, 32767).astype('<i2').tobytes()
+
+    tmp_filename = output + '.tmp' + os.path.splitext(output)[1]
+    if output.endswith('.wav'):
+        with wave.open(tmp_filename, 'wb') as w:
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.setframerate(output_rate)
+            for block in pcm_blocks():
+                w.writeframes(block)
+    else:
+        import subprocess
+
+        codec = ['-c:a', 'libmp3lame', '-b:a', '320k'] if output.endswith('.mp3') else []
+        process = subprocess.Popen(['ffmpeg', '-v', 'error', '-y', '-f', 's16le', '-ar', str(output_rate), '-ac', '1', '-i', '-'] + codec + [tmp_filename],
+                                   stdin=subprocess.PIPE)
+        for block in pcm_blocks():
+            process.stdin.write(block)
+        process.stdin.close()
+        if process.wait() != 0:
+            raise RuntimeError(f"ffmpeg could not encode {output}")
+    os.replace(tmp_filename, output)
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+spectral.py
+
+ Welch PSDs, long-term spectral averages (LTSA) and third-octave band levels, computed during ingest while the samples are in memory.
+
+ The hydrophones are not calibrated here, so PSDs are in dB re 1 count^2/Hz and band levels in dB re 1 count^2.
+
+ Each station-day folder gets one ltsa.npz holding:
+    time        (n_rows,)            POSIX start time of each averaging period
+    duration    (n_rows,)            seconds of audio in each row (the last row of a file can be short)
+    frequency   (n_freqs,)           Hz
+    psd_db      (n_rows, n_freqs)    float16, ~0.05 dB resolution is plenty for an LTSA
+    band_center (n_bands,)           Hz, base-10 third octaves
+    band_db     (n_rows, n_bands)
+    sample_rate ()
+"""
+
+import os
+import numpy as np
+
+
+LTSA_FILENAME = 'ltsa.npz'
+
+
+def welch_psd(samples, sample_rate, nfft=2048, overlap=0.5, batch_size=256):
+    """
+    One-sided Welch PSD of a 1-D array with a periodic Hann window and mean removal per segment (same as scipy.signal.welch defaults).
+    Segments are transformed batch_size at a time to bound memory.
+    """
+    x = np.asarray(samples, dtype=np.float32)
+    if len(x) < nfft:
+        raise ValueError(f"need at least nfft={nfft} samples, got {len(x)}")
+
+    hop = max(1, int(nfft * (1 - overlap)))
+    frames = np.lib.stride_tricks.sliding_window_view(x, nfft)[::hop]
+    window = np.hanning(nfft + 1)[:-1].astype(np.float32)
+
+    power = np.zeros(nfft // 2 + 1, dtype=np.float64)
+    for i in range(0, len(frames), batch_size):
+        batch = frames[i:i + batch_size]
+        batch = (batch - batch.mean(axis=1, keepdims=True)) * window
+        spectrum = np.fft.rfft(batch, axis=1)
+        power += (spectrum.real ** 2 + spectrum.imag ** 2).sum(axis=0)
+
+    psd = power / (len(frames) * sample_rate * np.sum(window.astype(np.float64) ** 2))
+    # fold the negative frequencies, DC (and Nyquist for even nfft) only appear once
+    psd[1:-1 if nfft % 2 == 0 else None] *= 2
+    return np.fft.rfftfreq(nfft, 1 / sample_rate), psd
+
+
+def third_octave_bands(freqs):
+    """
+    Base-10 third-octave centre frequencies (IEC 61260) whose band holds at least one PSD bin and lies below Nyquist.
+    Returns (centers, membership) where membership is a (n_bands, n_freqs) 0/1 matrix.
+    """
+    df = freqs[1] - freqs[0]
+    nyquist = freqs[-1]
+    n = np.arange(np.floor(10 * np.log10(max(df, 1.0) / 1000)), np.floor(10 * np.log10(nyquist / 1000)) + 1)
+    centers = 1000 * 10 ** (n / 10)
+    lower, upper = centers * 10 ** (-1 / 20), centers * 10 ** (1 / 20)
+    membership = (freqs[None, :] >= lower[:, None]) & (freqs[None, :] < upper[:, None])
+    keep = (membership.sum(axis=1) > 0) & (upper <= nyquist)
+    return centers[keep], membership[keep].astype(np.float64)
+
+
+def band_levels(freqs, psd, membership):
+    """
+    Integrate PSD rows (..., n_freqs) into band powers (..., n_bands).
+    """
+    return (psd @ membership.T) * (freqs[1] - freqs[0])
+
+
+def to_db(power):
+    return 10 * np.log10(np.maximum(power, 1e-20))
+
+
+class LTSAAccumulator:
+    """
+    Feed samples in blocks of any size, get one Welch PSD and third-octave band levels per averaging period.
+
+    acc = LTSAAccumulator(sample_rate, start_time)
+    for block in blocks:
+        acc.update(block)
+    result = acc.finalize()
+    """
+    def __init__(self, sample_rate, start_time, average_seconds=60, nfft=2048):
+        self.sample_rate = float(sample_rate)
+        self.start_time = float(start_time)
+        self.nfft = nfft
+        self.period = int(round(average_seconds * self.sample_rate))
+        self._buffer = []
+        self._buffered = 0
+        self._consumed = 0
+        self.times, self.durations, self.rows = [], [], []
+        self.freqs = None
+
+    def update(self, samples):
+        samples = np.asarray(samples)
+        if samples.ndim > 1:
+            # hydrophones are mono, keep the first channel
+            samples = samples[:, 0]
+        self._buffer.append(samples)
+        self._buffered += len(samples)
+        while self._buffered >= self.period:
+            buffered = np.concatenate(self._buffer)
+            self._add_row(buffered[:self.period])
+            rest = buffered[self.period:]
+            self._buffer = [rest]
+            self._buffered = len(rest)
+
+    def _add_row(self, samples):
+        self.freqs, psd = welch_psd(samples, self.sample_rate, nfft=self.nfft)
+        self.times.append(self.start_time + self._consumed / self.sample_rate)
+        self.durations.append(len(samples) / self.sample_rate)
+        self.rows.append(psd)
+        self._consumed += len(samples)
+
+    def finalize(self):
+        """
+        Flush the remaining samples (if there are at least nfft of them) and return the LTSA arrays, or None if there was not enough audio.
+        """
+        if self._buffered >= self.nfft:
+            self._add_row(np.concatenate(self._buffer))
+        self._buffer, self._buffered = [], 0
+        if len(self.rows) == 0:
+            return None
+
+        psd = np.vstack(self.rows)
+        centers, membership = third_octave_bands(self.freqs)
+        return {
+            'time': np.array(self.times, dtype=np.float64),
+            'duration': np.array(self.durations, dtype=np.float32),
+            'frequency': self.freqs.astype(np.float32),
+            'psd_db': to_db(psd).astype(np.float16),
+            'band_center': centers.astype(np.float32),
+            'band_db': to_db(band_levels(self.freqs, psd, membership)).astype(np.float32),
+            'sample_rate': np.float64(self.sample_rate),
+        }
+
+
+def compute_ltsa(samples, sample_rate, start_time, average_seconds=60, nfft=2048):
+    """
+    LTSA arrays for samples that are already in memory.
+    """
+    acc = LTSAAccumulator(sample_rate, start_time, average_seconds=average_seconds, nfft=nfft)
+    acc.update(samples)
+    return acc.finalize()
+
+
+def load_ltsa(filename):
+    with np.load(filename) as f:
+        return {k: f[k] for k in f.files}
+
+
+def ltsa_rows(result, start, end):
+    """
+    The rows of an LTSA starting in [start, end) (POSIX seconds), None if there are none
+    """
+    keep = (result['time'] >= start) & (result['time'] < end)
+    if not keep.any():
+        return None
+    return {k: v[keep] if k in ('time', 'duration', 'psd_db', 'band_db') else v for k, v in result.items()}
+
+
+def write_ltsa(directory, result):
+    """
+    Merge result into <directory>/ltsa.npz, rows are kept sorted by time and a re-processed period replaces the old row.
+    """
+    if result is None:
+        return
+    filename = os.path.join(directory, LTSA_FILENAME)
+
+    if os.path.exists(filename):
+        existing = load_ltsa(filename)
+        if existing['frequency'].shape == result['frequency'].shape and existing['sample_rate'] == result['sample_rate']:
+            keep = ~np.isin(existing['time'], result['time'])
+            result = dict(result)
+            for key in ('time', 'duration', 'psd_db', 'band_db'):
+                result[key] = np.concatenate([existing[key][keep], result[key]])
+            order = np.argsort(result['time'], kind='stable')
+            for key in ('time', 'duration', 'psd_db', 'band_db'):
+                result[key] = result[key][order]
+        else:
+            print(f"LTSA in {filename} has a different sample rate or nfft, replacing it")
+
+    tmp_filename = filename + '.tmp.npz'
+    np.savez_compressed(tmp_filename, **result)
+    os.replace(tmp_filename, filename)
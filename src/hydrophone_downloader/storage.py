@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+storage.py
+
+ disk budget for downloads. Before a deployment is downloaded its expected size is reserved. The size comes from Content-Length,
+ the ONC file listing, or what similar downloads took before. When the volume (or the configured budget) is short, new downloads
+ wait until conversion, cleanup or other workers free space, instead of failing halfway through writing a file.
+
+ Reservations are kept in <save_dir>/.storage.sqlite, so worker processes sharing a save_dir see each other's reservations.
+ A download reports the bytes it has written as they land, and only the rest of its reservation is held on top of what is on
+ disk, so nothing is counted twice.
+"""
+
+import os
+import time
+import socket
+import shutil
+import sqlite3
+from contextlib import closing, contextmanager
+
+
+STORAGE_FILENAME = '.storage.sqlite'
+GB = 1024 ** 3
+
+
+class InsufficientSpace(RuntimeError):
+    pass
+
+
+def directory_size(path):
+    """
+    Bytes of the files under path, a file hard-linked several times (e.g. from the blob store) is counted once
+    """
+    total = 0
+    seen = set()
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                st = os.stat(os.path.join(root, name))
+            except OSError:
+                # removed while we were walking
+                continue
+            if st.st_nlink > 1:
+                if (st.st_dev, st.st_ino) in seen:
+                    continue
+                seen.add((st.st_dev, st.st_ino))
+            total += st.st_size
+    return total
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class Reservation:
+    """
+    Handle of a reservation, see StorageBudget.reserve
+    """
+    def __init__(self, budget, rid):
+        self.budget = budget
+        self.rid = rid
+
+    def landed(self, nbytes):
+        """
+        nbytes of the reservation are now on disk (negative when e.g. a conversion shrank the files)
+        """
+        nbytes = int(nbytes)
+        with closing(self.budget._connect()) as conn:
+            conn.execute("UPDATE reservations SET written=written+? WHERE id=?", (nbytes, self.rid))
+        if self.budget._used_bytes is not None:
+            self.budget._used_bytes += nbytes
+
+
+class StorageBudget:
+    """
+    budget_bytes: the most save_dir may hold, None only keeps min_free_bytes free on the volume
+    wait_timeout: seconds to wait for space before giving up with InsufficientSpace, None waits forever
+    """
+    def __init__(self, save_dir, budget_bytes=None, min_free_bytes=GB, wait_timeout=3600, poll_interval=30, stale_seconds=6 * 3600):
+        self.save_dir = save_dir
+        self.budget_bytes = budget_bytes
+        self.min_free_bytes = min_free_bytes
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self.stale_seconds = stale_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._used_bytes = None
+        self._used_checked = 0
+
+        os.makedirs(save_dir, exist_ok=True)
+        self.path = os.path.join(save_dir, STORAGE_FILENAME)
+        with closing(self._connect()) as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS reservations (id INTEGER PRIMARY KEY AUTOINCREMENT, owner TEXT, label TEXT, bytes INTEGER, created REAL, "
+                         "written INTEGER NOT NULL DEFAULT 0)")
+            conn.execute("CREATE TABLE IF NOT EXISTS estimates (key TEXT PRIMARY KEY, value REAL, n INTEGER)")
+            # databases written before the landed bytes were tracked
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(reservations)")}
+            if 'written' not in columns:
+                conn.execute("ALTER TABLE reservations ADD COLUMN written INTEGER NOT NULL DEFAULT 0")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _drop_stale(self, conn):
+        """
+        Forget reservations of processes that died on this host, or that are older than stale_seconds (other hosts).
+        """
+        hostname = socket.gethostname()
+        for rid, owner, created in conn.execute("SELECT id, owner, created FROM reservations").fetchall():
+            host, pid = owner.rsplit(':', 1)
+            if (host == hostname and not pid_alive(int(pid))) or created < time.time() - self.stale_seconds:
+                conn.execute("DELETE FROM reservations WHERE id=?", (rid,))
+
+    def used_bytes(self, max_age=60):
+        # walking a big save_dir is slow, so the size is cached for max_age seconds
+        if self._used_bytes is None or time.time() - self._used_checked > max_age:
+            self._used_bytes = directory_size(self.save_dir)
+            self._used_checked = time.time()
+        return self._used_bytes
+
+    def available(self, conn, used_bytes=None):
+        """
+        used_bytes: used_bytes() measured before conn took the write lock, so other processes do not wait on the walk
+        """
+        # what has landed is already in the free/used space, only the rest of each reservation is held
+        reserved = conn.execute("SELECT COALESCE(SUM(MAX(bytes - written, 0)), 0) FROM reservations").fetchone()[0]
+        available = shutil.disk_usage(self.save_dir).free - self.min_free_bytes - reserved
+        if self.budget_bytes is not None:
+            used_bytes = self.used_bytes() if used_bytes is None else used_bytes
+            available = min(available, self.budget_bytes - used_bytes - reserved)
+        return available
+
+    def capacity(self):
+        capacity = shutil.disk_usage(self.save_dir).total - self.min_free_bytes
+        if self.budget_bytes is not None:
+            capacity = min(capacity, self.budget_bytes)
+        return capacity
+
+    @contextmanager
+    def reserve(self, nbytes, label=''):
+        """
+        Hold nbytes of the budget for the duration of the with block, waiting until they are available. Yields a Reservation,
+        report what is written with its landed() so those bytes are not held twice.
+        """
+        nbytes = int(nbytes)
+        if nbytes > self.capacity():
+            raise InsufficientSpace(f"{label} needs {nbytes/GB:.2f} GB, more than the {self.capacity()/GB:.2f} GB the volume/budget can ever hold")
+
+        start = time.time()
+        waiting = False
+        while True:
+            # the walk of save_dir happens outside the transaction, only the sum of the reservations is read under the lock
+            used_bytes = self.used_bytes() if self.budget_bytes is not None else None
+            with closing(self._connect()) as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                self._drop_stale(conn)
+                available = self.available(conn, used_bytes)
+                if nbytes <= available:
+                    rid = conn.execute("INSERT INTO reservations (owner, label, bytes, created) VALUES (?, ?, ?, ?)",
+                                       (self.owner, label, nbytes, time.time())).lastrowid
+                    conn.execute("COMMIT")
+                    break
+                conn.execute("COMMIT")
+
+            if self.wait_timeout is not None and time.time() - start > self.wait_timeout:
+                raise InsufficientSpace(f"Gave up waiting {self.wait_timeout}s for {nbytes/GB:.2f} GB of disk space for {label}")
+            if not waiting:
+                print(f"Waiting for disk space: {label} needs {nbytes/GB:.2f} GB, {max(available, 0)/GB:.2f} GB available. "
+                      f"Pausing new downloads until conversion/cleanup frees space.")
+                waiting = True
+            time.sleep(self.poll_interval)
+            # what is on disk changes while we wait
+            self._used_bytes = None
+
+        if waiting:
+            print(f"Resuming {label} after waiting {time.time()-start:.0f}s for disk space")
+        try:
+            yield Reservation(self, rid)
+        finally:
+            # the landed bytes are in the cached size already, the rest of the disk is walked again when the cache expires
+            with closing(self._connect()) as conn:
+                conn.execute("DELETE FROM reservations WHERE id=?", (rid,))
+
+    def estimate(self, key, default):
+        """
+        Running mean of what was observed for key (e.g. the bytes of an ONC data-product day), default until something was observed.
+        """
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT value FROM estimates WHERE key=?", (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def observe(self, key, value):
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT value, n FROM estimates WHERE key=?", (key,)).fetchone()
+            if row is None:
+                conn.execute("INSERT INTO estimates (key, value, n) VALUES (?, ?, 1)", (key, value))
+            else:
+                mean, n = row
+                # cap n so the estimate keeps following changes (new instruments, sample rates, ...)
+                n = min(n, 50)
+                conn.execute("UPDATE estimates SET value=?, n=? WHERE key=?", ((mean * n + value) / (n + 1), n + 1, key))
+            conn.execute("COMMIT")
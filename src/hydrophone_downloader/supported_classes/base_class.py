@@ -8,19 +8,111 @@ download_class.py
 """
 
 import os
+import time
+import hashlib
 
 from datetime import datetime
-import git
+
+
+# the open bounds of a query (see filter_deployments), for the daemon and batch queries that only set some of them
+DEFAULT_QUERY = {'min_lat': -90, 'max_lat': 90, 'min_lon': -180, 'max_lon': 180, 'min_depth': 0, 'max_depth': 12000, 'license': None}
+
+
+def deployment_key(deployment):
+    """
+    (source, station, date) identifying a deployment, the station is the ONC location code or the OOI reference designator.
+    """
+    station = deployment.get('locationCode') or deployment.get('reference_designator')
+    date = deployment['date']
+    if not isinstance(date, str):
+        date = date.strftime('%Y-%m-%d')
+    return (deployment['source'], station, date)
+
+
+def shard_deployments(deployments, shard_index=0, shard_count=1):
+    """
+    Keep the deployments that belong to shard_index out of shard_count. The split hashes (source, station, date), so it does not
+    depend on the order or the host, and N machines running the same query with shard_index 0..N-1 cover every deployment exactly once.
+    """
+    assert shard_count >= 1, "shard_count must be at least 1"
+    assert 0 <= shard_index < shard_count, "shard_index must be in [0, shard_count)"
+    if shard_count == 1:
+        return deployments
+
+    def shard(deployment):
+        digest = hashlib.sha1('|'.join(deployment_key(deployment)).encode('utf-8')).hexdigest()
+        return int(digest, 16) % shard_count
+
+    return [d for d in deployments if shard(d) == shard_index]
 
 
 
 
 class BaseDownloadClass:
-    def __init__(self, ):
-        pass
+    # whether one instance can download several deployments at once from different threads (see server.py)
+    concurrent_downloads = True
+
+    def __init__(self, ltsa=False, target_sample_rate=None, disk_budget_gb=None, min_free_gb=1.0, disk_wait_timeout=3600, http_pool_size=10,
+                 recompress_wav=True, recompress_workers=None, in_memory_ingest=False, spool_max_mb=512, blob_store=None,
+                 cache_cap_gb=None):
+        """
+        ltsa: compute per-minute Welch PSDs and third-octave band levels into ltsa.npz while ingesting each file
+        target_sample_rate: store audio at (at most) this rate in Hz, None keeps the native rate
+        disk_budget_gb, min_free_gb, disk_wait_timeout: see storage.StorageBudget, downloads wait for space instead of filling the disk
+        http_pool_size: connections kept alive per host by the shared HTTP session
+        recompress_wav: losslessly recompress downloaded WAV files to FLAC with recompress_workers ffmpeg processes (default: one per CPU)
+        in_memory_ingest: download OOI mseed into memory (spilling to disk above spool_max_mb) and write only the converted file
+        blob_store: directory of a blobstore.BlobStore shared by several save_dirs, files another query already has are linked from it
+        cache_cap_gb: after each deployment, evict the least recently used raw files of save_dir beyond this size (see cache.py)
+        """
+        self._deployments = None
+        self.ltsa = ltsa
+        self.target_sample_rate = target_sample_rate
+        self.disk_budget_gb = disk_budget_gb
+        self.min_free_gb = min_free_gb
+        self.disk_wait_timeout = disk_wait_timeout
+        self._storage = {}
+        self._manifest = {}
+        self._catalog = {}
+        self.http_pool_size = http_pool_size
+        self.recompress_wav = recompress_wav
+        self.recompress_workers = recompress_workers
+        self.in_memory_ingest = in_memory_ingest
+        self.spool_max_mb = spool_max_mb
+        self.blob_store = blob_store
+        self._blobs = None
+        self.cache_cap_gb = cache_cap_gb
+
+    @property
+    def session(self):
+        """
+        The pooled requests.Session shared by every source in this process
+        """
+        from ..http_session import get_session
+
+        return get_session(self.http_pool_size)
 
     def __post_init__(self):
-        self.deployments = self.get_deployments()
+        # discovery is deferred until the deployments are first needed, see discover()
+        pass
+
+    @property
+    def deployments(self):
+        if self._deployments is None:
+            self.discover()
+        return self._deployments
+
+    @deployments.setter
+    def deployments(self, deployments):
+        self._deployments = deployments
+
+    def discover(self):
+        """
+        Query the source for its deployments, this is the slow part of constructing a download class so it is only done once.
+        """
+        if self._deployments is None:
+            self._deployments = self.get_deployments()
+        return self._deployments
 
     def get_deployments(self,):
         """
@@ -38,8 +130,75 @@ class BaseDownloadClass:
         raise NotImplementedError("Subclasses must implement this method")
     
 
-    def download_data(self, min_lat, max_lat, min_lon, max_lon, min_depth, max_depth, license, start_time, end_time, save_dir):
+    def download_deployment(self, deployment, save_dir):
+        raise NotImplementedError("Derived classes must implement this method.")
+
+    def plan_deployment(self, deployment, save_dir):
+        """
+        The remote files of a deployment, without downloading them:
+        {'files': [{..., 'bytes': int or None}, ...], 'bytes': expected download size, 'disk_bytes': expected size in save_dir}
+        download_deployment uses deployment['planned_files'] (the 'files' of a saved plan) instead of listing the files again.
+        """
+        raise NotImplementedError("Derived classes must implement this method.")
+
+    def stream_deployment(self, deployment):
+        """
+        Yield (station, start_time, sample_rate, samples) for each file of the deployment, decoded from memory without writing to
+        save_dir. start_time is a UTC datetime, samples has shape (n_frames, n_channels) at the native rate.
+        """
         raise NotImplementedError("Derived classes must implement this method.")
+
+    def download_data(self, min_lat, max_lat, min_lon, max_lon, min_depth, max_depth, license, start_time, end_time, save_dir, shard_index=0, shard_count=1):
+        """
+        Download every deployment matching the query that falls in this shard, returns a result dict per deployment (see download_deployments)
+        """
+        deployments = self.select_deployments(min_lat, max_lat, min_lon, max_lon, min_depth, max_depth, license, start_time, end_time, shard_index, shard_count)
+        if len(deployments)==0:
+            print(f"No data from {self.source} is available for the specified parameters.")
+            return []
+
+        print(f"Downloading {len(deployments)} deployments from {self.source}")
+        return self.download_deployments(deployments, save_dir)
+
+    def select_deployments(self, min_lat, max_lat, min_lon, max_lon, min_depth, max_depth, license, start_time, end_time, shard_index=0, shard_count=1):
+        """
+        The deployments matching the query that fall in this shard
+        """
+        deployments = self.filter_deployments(min_lat, max_lat, min_lon, max_lon, min_depth, max_depth, license, start_time, end_time)
+        return shard_deployments(deployments, shard_index, shard_count)
+
+    def download_deployments(self, deployments, save_dir):
+        """
+        Download each deployment (from discovery or a saved plan), a failing deployment is recorded and the rest still run.
+        Returns [{'source', 'station', 'date', 'status': 'done' | 'failed', 'seconds', 'error'}, ...]
+        """
+        results = []
+        for deployment in deployments:
+            source, station, date = deployment_key(deployment)
+            start = time.time()
+            try:
+                self.download_deployment(deployment, save_dir)
+                status, error = 'done', None
+            except Exception as e:
+                print(f"Failed to download {source} {station} {date}: {e}")
+                status, error = 'failed', str(e)
+            results.append({'source': source, 'station': station, 'date': date, 'status': status, 'seconds': round(time.time()-start, 3), 'error': error})
+            self.enforce_cache_cap(save_dir)
+        return results
+
+    def enforce_cache_cap(self, save_dir):
+        """
+        Evict the least recently used raw files beyond cache_cap_gb, merged and derived files are pinned
+        """
+        if self.cache_cap_gb is None:
+            return
+        from ..cache import evict_lru
+        from ..storage import GB
+
+        try:
+            evict_lru(save_dir, self.cache_cap_gb * GB, manifest=self.manifest(save_dir))
+        except Exception as e:
+            print(f"Could not enforce the cache cap on {save_dir}: {e}")
     
     def filter_deployments(self, min_lat, max_lat, min_lon, max_lon, min_depth, max_depth, license, start_time, end_time):
         """
@@ -81,9 +240,140 @@ class BaseDownloadClass:
         
         return deployments_out
     
+    def storage(self, save_dir):
+        """
+        The StorageBudget of save_dir, every download reserves its expected size here first
+        """
+        from ..storage import StorageBudget, GB
+
+        if save_dir not in self._storage:
+            self._storage[save_dir] = StorageBudget(
+                save_dir,
+                budget_bytes=None if self.disk_budget_gb is None else self.disk_budget_gb * GB,
+                min_free_bytes=self.min_free_gb * GB,
+                wait_timeout=self.disk_wait_timeout,
+            )
+        return self._storage[save_dir]
+
+    def manifest(self, save_dir):
+        """
+        The Manifest of save_dir, the SHA-256 of every file kept there is recorded in it
+        """
+        from ..manifest import Manifest
+
+        if save_dir not in self._manifest:
+            self._manifest[save_dir] = Manifest(save_dir)
+        return self._manifest[save_dir]
+
+    def catalog(self, save_dir):
+        """
+        The Catalog of save_dir, each downloaded day is recorded in it with its provenance, citation and files
+        """
+        from ..catalog import Catalog
+
+        if save_dir not in self._catalog:
+            self._catalog[save_dir] = Catalog(save_dir)
+        return self._catalog[save_dir]
+
+    def blobs(self):
+        """
+        The shared BlobStore, None unless blob_store is set
+        """
+        from ..blobstore import BlobStore
+
+        if self.blob_store is not None and self._blobs is None:
+            self._blobs = BlobStore(self.blob_store)
+        return self._blobs
+
+    def blob_variant(self):
+        """
+        The local processing that changes the stored files, part of the blob key so e.g. 16 kHz and native rate copies, or the
+        WAV and FLAC copies of a file, differ
+        """
+        return f"sr={self.target_sample_rate};recompress_wav={self.recompress_wav};in_memory_ingest={self.in_memory_ingest}"
+
+    def file_start_time(self, filename):
+        """
+        POSIX timestamp of the first sample of a file of this source from its name, None if the name does not carry one
+        """
+        return None
+
+    def link_blobs(self, files, save_dir):
+        """
+        files: [(blob key, url, local path without extension), ...]. Links the ones already in the blob store into save_dir and
+        records them in the manifest, returns the keys of the others.
+        """
+        blobs = self.blobs()
+        if blobs is None:
+            return [key for key, _, _ in files]
+        manifest = self.manifest(save_dir)
+        missing = []
+        linked_bytes = 0
+        for key, url, destination in files:
+            blob = blobs.lookup(key)
+            if blob is None:
+                missing.append(key)
+                continue
+            path = blobs.link(blob, destination)
+            manifest.record(path, blob['sha256'], source=self.source, url=url)
+            linked_bytes += blob['size']
+            if self.ltsa:
+                self.link_ltsa(key, path)
+        if len(missing) < len(files):
+            print(f"Linked {len(files)-len(missing)} files ({linked_bytes/1e6:.1f} MB) from the blob store {self.blob_store}")
+        return missing
+
+    def link_ltsa(self, key, path):
+        """
+        Add the LTSA of a file linked from the blob store to ltsa.npz in its folder: the rows kept with the blob, or computed from
+        the file if it was stored without them at the native rate
+        """
+        from ..spectral import compute_ltsa, write_ltsa
+
+        rows = self.blobs().lookup_ltsa(key)
+        if rows is not None:
+            write_ltsa(os.path.dirname(path), rows)
+            return
+        start_time = self.file_start_time(path)
+        if self.target_sample_rate is not None or start_time is None:
+            print(f"No LTSA is stored for {path} and it cannot be computed from the linked file")
+            return
+        from ..audio_io import read_audio
+
+        try:
+            samples, sample_rate = read_audio(path)
+            write_ltsa(os.path.dirname(path), compute_ltsa(samples, sample_rate, start_time))
+        except Exception as e:
+            print(f"Failed to compute the LTSA of {path}: {e}")
+
+    def share_ltsa(self, directory, files, day_files):
+        """
+        Keep the rows of <directory>/ltsa.npz of each file added to the blob store with it, so the save_dirs linking it get its LTSA.
+        files: [(blob key, filename), ...] added, day_files: every file of the day, the rows of a file run up to the next one's start
+        """
+        from ..spectral import LTSA_FILENAME, load_ltsa, ltsa_rows
+
+        blobs = self.blobs()
+        filename = os.path.join(directory, LTSA_FILENAME)
+        if blobs is None or not self.ltsa or not os.path.exists(filename):
+            return
+        ltsa = load_ltsa(filename)
+        starts = sorted({t for t in map(self.file_start_time, day_files) if t is not None})
+        for key, path in files:
+            start = self.file_start_time(path)
+            if start is None:
+                continue
+            end = next((t for t in starts if t > start), float('inf'))
+            # the first sample can be stamped a little before the time in the file name
+            rows = ltsa_rows(ltsa, start - 1, end - 1)
+            if rows is not None:
+                blobs.add_ltsa(key, rows)
+
     def get_git_hash(self):
-        this_file_path = os.path.abspath(__file__)
-        return git.Repo(this_file_path, search_parent_directories=True).head.object.hexsha
+        from ..catalog import git_version
+
+        # resolved once per process, not per deployment
+        return git_version()
     
     
     def log(self, message):
@@ -4,34 +4,33 @@
 
 from .base_class import BaseDownloadClass
 
-# import pandas as pd
-import polars as pl
-import obspy
 import glob
-from urllib.parse import urljoin
 
 import random
-import requests
 import os
+import time
 import shutil
 import json
 from copy import deepcopy
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 
+# polars, requests and the onc client are imported where they are used to keep the CLI startup fast
 
-from onc.onc import ONC
 
+def get_token():
+    """
+    Read the ONC token from the environment, loading the .env file written by hydrophone-downloader-set-token on first use.
+    """
+    try:
+        from dotenv import load_dotenv
+        load_dotenv()
+    except:
+        # assume everything is loaded using export $(cat .env | xargs)
+        pass
 
-try:
-    from dotenv import load_dotenv
-    load_dotenv()
-except:
-    # assume everything is loaded using export $(cat .env | xargs)
-    pass
-
-token = os.getenv('ONC_TOKEN')
+    return os.getenv('ONC_TOKEN')
 
-def check_token_is_set():
+def check_token_is_set(token):
     """
     """
     error_message = """You do not have an Ocean Networks Canada token registered in the repository. To add your token, run
@@ -50,12 +49,18 @@ def str_gen():
 
 
 class ONCDownloadClass(BaseDownloadClass):
-    def __init__(self):
-        super().__init__()
-        check_token_is_set()
-        self.onc = ONC(token=token, )
+    # the ONC client downloads into its outPath, which is set per deployment
+    concurrent_downloads = False
+
+    def __init__(self, **options):
+        super().__init__(**options)
+        token = get_token()
+        check_token_is_set(token)
+        self.onc = None # created on first use, see get_onc
         self.token = token
         self.license = 'CC-BY 4.0'
+        self.source = 'ONC'
+        self._downsample_rates = None
         self.__post_init__()
 
     def get_deployments(self,):
@@ -71,7 +76,9 @@ class ONCDownloadClass(BaseDownloadClass):
             # any other information that is useful to save
         }
         """
+        import polars as pl
 
+        session = self.session
         deployments_out = []
 
         # get all of the locations
@@ -80,7 +87,7 @@ class ONCDownloadClass(BaseDownloadClass):
                     'token':self.token, # replace YOUR_TOKEN_HERE with your personal token obtained from the 'Web Services API' tab at https://data.oceannetworks.can/Profile when logged in.
                     'deviceCategoryCode':'HYDROPHONE'}
         
-        response = requests.get(url,params=parameters)
+        response = session.get(url,params=parameters)
         
         if (response.ok):
             locations = json.loads(str(response.content,'utf-8')) # convert the json response to an object
@@ -103,11 +110,11 @@ class ONCDownloadClass(BaseDownloadClass):
     
             url = 'https://data.oceannetworks.ca/api/deployments'
             parameters = {'method':'get',
-                        'token':token, # replace YOUR_TOKEN_HERE with your personal token obtained from the 'Web Services API' tab at https://data.oceannetworks.ca/Profile when logged in.
+                        'token':self.token, # replace YOUR_TOKEN_HERE with your personal token obtained from the 'Web Services API' tab at https://data.oceannetworks.ca/Profile when logged in.
                         'locationCode':locationCode,
                         'deviceCategoryCode':'HYDROPHONE'}
             
-            response = requests.get(url,params=parameters)
+            response = session.get(url,params=parameters)
             
             if (response.ok):
                 deployments = json.loads(str(response.content,'utf-8')) # convert the json response to an object
@@ -160,7 +167,7 @@ class ONCDownloadClass(BaseDownloadClass):
                     
 
 
-                    # todo download wav if pre April 9, 2021, then convert to flac using ffmpeg
+                    # ONC only archives WAV before April 9, 2021, these are recompressed to FLAC after download (recompress_wav)
 
                     extension='flac'
                     # if date <= pd.Timestamp('2021-04-09'):
@@ -194,58 +201,70 @@ class ONCDownloadClass(BaseDownloadClass):
 
     
 
-    def download_data(self, min_lat, max_lat, min_lon, max_lon, min_depth, max_depth, license, start_time, end_time, save_dir):
+    def download_deployment(self, deployment, save_dir):
         """
-        Download data from ONC, saving to a temp folder and then moving to the final destination.
+        Download a single deployment (a day of data from one device), saving to a temp folder and then moving to the final destination.
         """
+        filters = deployment['filters']
+        locationCode = deployment['locationCode']
+        date = deployment['date']
+        fname = os.path.join(save_dir, deployment['fname'])
+        os.makedirs(fname, exist_ok=True)
+
+        # Create a unique temp folder for each deployment
+        device_code = filters['deviceCode']
+        date_str = date.strftime("%Y%m%d")
+        timestamp = datetime.now().strftime("%H%M%S")
+        outPath = os.path.join(save_dir, f"tmp_{device_code}_{locationCode}_{date_str}_{timestamp}")
+        self.get_onc(outPath)
+
+        # the filters that fetched the day, kept in the catalog with the citation
+        used_filters = None
+
+        filters_archived = filters.copy()
+        filters_archived['rowLimit'] = 80000
+        archived_files = deployment.get('planned_files')
+        if archived_files is None:
+            archived_files = self.list_archived_files(deployment)
+
+        # archived files another save_dir already has are linked from the blob store, the others are downloaded one by one
+        from ..blobstore import blob_key
+        to_download = archived_files
+        if len(archived_files)>0 and self.blobs() is not None:
+            # the archive URL carries the token, the file name identifies the file
+            keyed = {blob_key(f"onc:{f['filename']}", f['bytes'], self.blob_variant()): f for f in archived_files}
+            missing = set(self.link_blobs([(key, None, os.path.join(fname, os.path.splitext(f['filename'])[0])) for key, f in keyed.items()], save_dir))
+            to_download = [f for key, f in keyed.items() if key in missing]
+
+        storage = self.storage(save_dir)
+        if len(archived_files)>0:
+            expected_bytes = sum(f['bytes'] or 0 for f in to_download)
+        else:
+            # data products are generated on request, so use what such days took before
+            expected_bytes = storage.estimate('ONC_data_product_day_bytes', 2e9)
 
-        from datetime import datetime
-
-        # First, get deployments (must be before using deployments)
-        deployments = self.filter_deployments(
-            min_lat, max_lat, min_lon, max_lon, min_depth, max_depth, license, start_time, end_time
-        )
-
-        for deployment in deployments:
-            filters = deployment['filters']
-            locationCode = deployment['locationCode']
-            date = deployment['date']
-            fname = os.path.join(save_dir, deployment['fname'])
-            os.makedirs(fname, exist_ok=True)
-
-            # Create a unique temp folder for each deployment
-            device_code = filters['deviceCode']
-            date_str = date.strftime("%Y%m%d")
-            timestamp = datetime.now().strftime("%H%M%S")
-            outPath = os.path.join(save_dir, f"tmp_{device_code}_{locationCode}_{date_str}_{timestamp}")
-            self.onc = ONC(token=self.token, outPath=outPath)
-
-            citation = deployment['citation']
-            if citation is not None:
-                author, year, title, journal, doi = citation.split('. ')
-                citation = "@misc{"+fname.split('/')[-1]+", author={"+author+"}, year={"+year+"}, title={"+title+"}, journal={"+journal+"}, doi={"+doi+"},}"
-                with open(os.path.join(fname, 'reference.bib'), 'w') as f:
-                    f.write(citation)
-
-            filters_archived = filters.copy()
-            filters_archived['rowLimit'] = 80000
-            results = self.onc.getListByDevice(filters_archived)
-            if len(results['files'])>0:
+        with storage.reserve(expected_bytes, deployment['fname']) as reservation:
+            start = time.time()
+            if len(archived_files)>0 and len(to_download)<len(archived_files):
+                for f in to_download:
+                    try:
+                        self.onc.downloadArchivefile(f['filename'])
+                    except Exception as e:
+                        print(f"Failed to download {f['filename']}: {e}")
+                used_filters = filters_archived
+            elif len(archived_files)>0:
                 # download the files
                 try:
                     result = self.onc.getDirectFiles(filters_archived)
-                    # save the filters to json in fname
-                    with open(os.path.join(fname, 'filters.json'), 'w') as f:
-                        json.dump(filters_archived, f)
+                    used_filters = filters_archived
 
                     print("*"*40)
-                except:
-                    print("FAIL"*40)
-                    # we will still want to clean up and transfer the files
-                    pass
+                except Exception as e:
+                    # we will still want to clean up and transfer the files that arrived
+                    print(f"Failed to download the archived files of {locationCode} {date:%Y-%m-%d}: {e}")
             else:
                 # optional parameters to loop through and try:
-                filters_orig = {'locationCode': locationCode,'deviceCategoryCode':'HYDROPHONE','dataProductCode':'AD','extension':'flac','dateFrom':date.strftime('%Y-%m-%d'),'dateTo':(date+timedelta(days=1)).strftime('%Y-%m-%d'),'dpo_audioDownsample':-1} #, 'dpo_audioFormatConversion':0}
+                filters_orig = {'locationCode': locationCode,'deviceCategoryCode':'HYDROPHONE','dataProductCode':'AD','extension':'flac','dateFrom':date.strftime('%Y-%m-%d'),'dateTo':(date+timedelta(days=1)).strftime('%Y-%m-%d'),'dpo_audioDownsample':self.audio_downsample_option()} #, 'dpo_audioFormatConversion':0}
                 is_done = False
 
                 for d in [{'dpo_hydrophoneDataDiversionMode':'OD'}, {'dpo_hydrophoneDataDiversionMode':'OD', 'dpo_hydrophoneChannel':'All'},{'dpo_hydrophoneChannel':'All'},{'dpo_audioFormatConversion':0,'dpo_hydrophoneDataDiversionMode':'OD','dpo_hydrophoneChannel':'All'},{'dpo_audioFormatConversion':0,'dpo_hydrophoneDataDiversionMode':'OD'},{'dpo_audioFormatConversion':1,'dpo_hydrophoneDataDiversionMode':'OD','dpo_hydrophoneChannel':'All'}]:
@@ -254,23 +273,191 @@ class ONCDownloadClass(BaseDownloadClass):
                     try:
                         print(filters)
                         result  = self.onc.orderDataProduct(filters, includeMetadataFile=False)
-                        # save the filters to json in fname
-                        with open(os.path.join(fname, 'filters.json'), 'w') as f:
-                            json.dump(filters, f)
+                        used_filters = filters
                         is_done=True
                         break
                     except:
                         continue
 
-            if filters['extension'] == 'wav':
-                print("WAV files downloaded, no conversion to FLAC performed. Keeping WAV and deleting no files here.")
-                # WAV files are kept as is.
             # os.system(f'rsync -aavt --remove-source_files tmp/* {fname}')
+            moved = []
             for s in glob.glob(outPath+'/*', recursive=True):
-                if not os.path.exists(fname):
-                    shutil.move(s, fname)
+                destination = os.path.join(fname, os.path.basename(s))
+                if not os.path.exists(destination):
+                    shutil.move(s, destination)
+                    moved.append(destination)
+
+            moved_bytes = sum(os.path.getsize(f) for f in moved if os.path.isfile(f))
+            reservation.landed(moved_bytes)
+            if moved_bytes > 0:
+                # for the duration estimates of plan_only, data products include the time ONC takes to generate them
+                storage.observe('ONC_bytes_per_second', moved_bytes / max(time.time() - start, 1e-3))
+            if len(archived_files)==0 and len(moved)>0:
+                storage.observe('ONC_data_product_day_bytes', moved_bytes)
+
+            if self.ltsa or self.target_sample_rate is not None:
+                self.postprocess_files(moved, fname)
+
+            digests = {}
+            if self.recompress_wav and any(f.endswith('.wav') for f in moved):
+                from ..recompress import recompress_files
+
+                for result in recompress_files(moved, workers=self.recompress_workers):
+                    if result['status'] == 'done':
+                        moved[moved.index(result['wav'])] = result['flac']
+                        digests[result['flac']] = result['sha256']
+
+            # the onc client writes the files itself, so they are hashed once here, after any resampling
+            manifest = self.manifest(save_dir)
+            for filename in moved:
+                if os.path.isfile(filename):
+                    manifest.record(filename, digests.get(filename), source=self.source)
+
+            # share the processed archive files with the other save_dirs
+            blobs = self.blobs()
+            if blobs is not None:
+                by_name = {os.path.splitext(f['filename'])[0]: f for f in to_download}
+                added = []
+                for filename in moved:
+                    f = by_name.get(os.path.splitext(os.path.basename(filename))[0])
+                    if f is not None and os.path.isfile(filename):
+                        key = blob_key(f"onc:{f['filename']}", f['bytes'], self.blob_variant())
+                        sha256 = blobs.add(key, filename, (manifest.get(filename) or {}).get('sha256'), source=self.source)
+                        manifest.record(filename, sha256, source=self.source)
+                        added.append((key, filename))
+                self.share_ltsa(fname, added, [f['filename'] for f in archived_files])
+
+            # the day is complete when every listed archived file is in fname (a WAV file may be FLAC by now), or when a data
+            # product was delivered. The files that arrived are kept and the day fails, so the rest is retried
+            present = {os.path.splitext(name)[0] for name in os.listdir(fname) if not name.startswith('.')}
+            error = None
+            if len(archived_files)>0:
+                missing = [f['filename'] for f in archived_files if os.path.splitext(f['filename'])[0] not in present]
+                if missing:
+                    error = f"{len(missing)} of {len(archived_files)} archived files are missing: {', '.join(missing)}"
+            elif used_filters is None:
+                error = "no data product could be ordered"
+            elif len(present)==0:
+                error = "the data product delivered no files"
+
+            self.catalog(save_dir).record(self.source, locationCode, date, fname, citation=deployment['citation'], filters=used_filters,
+                                          deployment=deployment, status='done' if error is None else 'failed', error=error)
+
+        # Clean up temp folder after moving files
+        shutil.rmtree(outPath, ignore_errors=True)
+        if error is not None:
+            raise RuntimeError(error)
+
+    def stream_deployment(self, deployment):
+        """
+        Decode each archived file of the day from the HTTP response. Days that only exist as data products are skipped, ONC
+        generates those as files to download.
+        """
+        from ..audio_io import decode_audio, onc_start_time
+
+        archived_files = deployment.get('planned_files')
+        if archived_files is None:
+            archived_files = self.list_archived_files(deployment)
+        if len(archived_files) == 0:
+            print(f"{deployment['locationCode']} {deployment['date']} is only available as a data product, it cannot be streamed")
+            return
+
+        for archived_file in archived_files:
+            filename = archived_file['filename']
+            try:
+                response = self.session.get(self.get_onc().getArchivefileUrl(filename), timeout=60)
+                response.raise_for_status()
+                samples, sample_rate = decode_audio(response.content, os.path.splitext(filename)[1][1:])
+            except Exception as e:
+                print(f"Failed to stream {filename}: {e}")
+                continue
+            start_time = onc_start_time(filename)
+            start_time = None if start_time is None else datetime.fromtimestamp(start_time, timezone.utc)
+            yield deployment['locationCode'], start_time, sample_rate, samples
+
+    def get_onc(self, outPath=None):
+        """
+        The ONC client of this run, created once and pointed at the output folder of the current deployment
+        """
+        from onc.onc import ONC
 
-            # Clean up temp folder after moving files
-            shutil.rmtree(outPath, ignore_errors=True)
+        if self.onc is None:
+            self.onc = ONC(token=self.token)
+        if outPath is not None:
+            self.onc.outPath = outPath
+        return self.onc
 
+    def file_start_time(self, filename):
+        from ..audio_io import onc_start_time
+
+        return onc_start_time(filename)
+
+    def list_archived_files(self, deployment):
+        """
+        The archived files of the deployment as [{'filename', 'bytes'}, ...], empty if the day has to be ordered as a data product.
+        returnOptions=all lists the file sizes, so the space can be reserved before downloading.
+        """
+        filters = dict(deployment['filters'], rowLimit=80000, returnOptions='all')
+        results = self.get_onc().getListByDevice(filters)
+        return [{'filename': f['filename'], 'bytes': f.get('fileSize')} for f in results['files']]
+
+    def plan_deployment(self, deployment, save_dir):
+        """
+        The archived files of the day, or for days only available as a data product what such days took before.
+        """
+        files = self.list_archived_files(deployment)
+        if len(files)>0:
+            nbytes = sum(f['bytes'] or 0 for f in files)
+        else:
+            nbytes = self.storage(save_dir).estimate('ONC_data_product_day_bytes', 2e9)
+        return {'files': files, 'bytes': nbytes, 'disk_bytes': nbytes}
+
+    def audio_downsample_option(self):
+        """
+        dpo_audioDownsample for the AD data product: the smallest rate ONC offers that is >= target_sample_rate, so fewer bytes are
+        transferred and the rest is resampled locally. -1 (full rate) if there is no target or the options cannot be listed.
+        """
+        if self.target_sample_rate is None:
+            return -1
+
+        if self._downsample_rates is None:
+            self._downsample_rates = []
+            try:
+                for product in self.onc.getDataProducts({'dataProductCode': 'AD'}):
+                    for option in product.get('dataProductOptions', []):
+                        if option.get('option') == 'dpo_audioDownsample':
+                            self._downsample_rates += [int(v) for v in option.get('allowableValues') or [] if str(v).lstrip('-').isdigit() and int(v) > 0]
+            except Exception as e:
+                print(f"Could not list the ONC audio downsample options, requesting full rate: {e}")
+            self._downsample_rates = sorted(set(self._downsample_rates))
+
+        rates = [r for r in self._downsample_rates if r >= self.target_sample_rate]
+        return rates[0] if len(rates) > 0 else -1
+
+    def postprocess_files(self, filenames, directory):
+        """
+        Decode each downloaded audio file once to add its LTSA to ltsa.npz in directory (from the native rate samples) and,
+        if it is above target_sample_rate, resample it in place.
+        """
+        from ..audio_io import read_audio, write_audio, onc_start_time
+        from ..spectral import compute_ltsa, write_ltsa
+        from ..resample import resample_channels
+
+        for filename in sorted(filenames):
+            if not filename.endswith(('.flac', '.wav')):
+                continue
+            try:
+                samples, sample_rate = read_audio(filename)
+
+                if self.ltsa:
+                    start_time = onc_start_time(filename)
+                    if start_time is None:
+                        print(f"No timestamp in {filename}, skipping LTSA")
+                    else:
+                        write_ltsa(directory, compute_ltsa(samples, sample_rate, start_time))
 
+                if self.target_sample_rate is not None and self.target_sample_rate < sample_rate:
+                    write_audio(filename, resample_channels(samples, sample_rate, self.target_sample_rate), self.target_sample_rate)
+                    print(f"Resampled {filename} from {sample_rate} Hz to {self.target_sample_rate} Hz")
+            except Exception as e:
+                print(f"Failed to post-process {filename}: {e}")
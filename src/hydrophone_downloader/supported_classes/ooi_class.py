@@ -2,22 +2,19 @@
 # -*- coding: utf-8 -*-
 from .base_class import BaseDownloadClass
 
-import requests
 import os
-import obspy
 import glob
+import time
 from urllib.parse import urljoin
 
-from bs4 import BeautifulSoup
-import json
 
-# import pandas as pd
-import polars as pl
-from datetime import datetime, timedelta
+from datetime import datetime, timezone
+
+# requests, obspy, BeautifulSoup and polars are imported where they are used to keep the CLI startup fast
 
 class OOIDownloadClass(BaseDownloadClass):
-    def __init__(self, ):
-        super().__init__()
+    def __init__(self, **options):
+        super().__init__(**options)
 
         self.url_to_raw_data = "https://rawdata-west.oceanobservatories.org/files/"
 
@@ -61,7 +58,7 @@ ooi.download_data(min_lat=40, max_lat=50, min_lon=-129, max_lon=-124, min_depth=
         
         
         """
-
+        import polars as pl
 
         deployments = []
         # now = pd.Timestamp.now()
@@ -91,44 +88,14 @@ ooi.download_data(min_lat=40, max_lat=50, min_lon=-129, max_lon=-124, min_depth=
 
 
     
-    def download_data(self, min_lat, max_lat, min_lon, max_lon, min_depth, max_depth, license, start_time, end_time, save_dir):
-        """
-        Download data from OOI
-        """
-
-        print(self.deployments[:10])
-
-        # check for overlap in deployments
-        deployments = self.filter_deployments(min_lat, max_lat, min_lon, max_lon, min_depth, max_depth, license, start_time, end_time)
-        if len(deployments)==0:
-            print("No data from OOI is available for the specified parameters.")
-            return
-        
-        # otherwise, iterate through and download each deployment
-        print(f"Downloading {len(deployments)} deployments from OOI")
-        for deployment in deployments:
-            # first, make sure that the data are not already downloaded
-            self.download_deployment(deployment, save_dir)
-
-
-    def download_deployment(self, deployment, save_dir):
+    def list_files(self, url, base_dir):
         """
-        Download data for a single deployment
+        The .mseed files of a day listed at url, as [(absolute_url, local_path, size_in_bytes or None), ...]. Files under 1 MB are skipped.
         """
+        from bs4 import BeautifulSoup
 
-        # get the deployment URL
-        url = deployment['link']
-        print(f"Downloading data from {url}")
-
-        # get the directory name
-        directory = url.split('files/')[-1]
-        # print(directory)
-        # get the base directory
-        base_dir = os.path.join(save_dir, directory)
-        if not os.path.exists(base_dir):
-            os.makedirs(base_dir)
-
-        response = requests.get(url)
+        files = []
+        response = self.session.get(url)
 
         if response.status_code == 200:
             soup = BeautifulSoup(response.text, 'html.parser')
@@ -141,64 +108,224 @@ ooi.download_data(min_lat=40, max_lat=50, min_lon=-129, max_lon=-124, min_depth=
                     # we want to save the file to os.path.join(base_dir, 'CE02SHBP/LJ01D/11-HYDBBA106/2018/01/01/OO-HYEA2--YDH-2018-01-01T00:00:00.000000.mseed')
                     absolute_url = urljoin(url, href)
 
-                    d = requests.get(absolute_url)
-                    if int(d.headers['Content-Length'])<1000000:
+                    # HEAD, a GET would transfer the whole file just to read its size
+                    d = self.session.head(absolute_url, allow_redirects=True)
+                    size = d.headers.get('Content-Length')
+                    size = None if size is None else int(size)
+                    if size is not None and size<1000000:
                         continue
                     print('absolute_url:',absolute_url)
-                    # relative_path = os.path.relpath(absolute_url, "https://rawdata-west.oceanobservatories.org/files/")
-                    # # relative_path = os.path.relpath(absolute_url, searched[0])
-                    # print('relative_path:',relative_path)
-
-                    local_path = os.path.join(base_dir, os.path.basename(absolute_url)).replace(':','')
-                    # print('local_path:',local_path)
-
-                    
-                    
-                    
-
-                    # Ensure the directory structure exists
-                    os.makedirs(os.path.dirname(local_path), exist_ok=True)
-
-                    # Download the file
-                    if not(os.path.exists(local_path) or os.path.exists(local_path.replace('.mseed','.flac'))):
-                        # use wget silently and non blocking
-                        # print(f'wget -q  {absolute_url} -O '+ local_path.replace(" ", "\ "))
-                        os.system(f'wget -q  {absolute_url} -O '+local_path.replace(" ", "\ "))
-
-        # also save a metadata file
-        hash = self.get_git_hash()
-        deployment.update({'git_version': hash})
-        # get current date
-        deployment.update({'download_date': datetime.now().strftime('%Y-%m-%d')})
-        deployment.update({'date': deployment['date'].strftime('%Y-%m-%d')})
-
-        # save to the base directory
-        with open(os.path.join(base_dir, 'metadata.json'), 'w') as f:
-            json.dump(deployment, f)
-
-
-        # bibtex
-        # NSF Ocean Observatories Initiative. (date or year published). Instrument and/or data product(s) (reference designator, if applicable) data (from Platform, optional if providing reference designator) (at Array, optional if providing reference designator) from (start date) to (end date). (Repository). (URL). Accessed on (date accessed).
-        bibtex=f"""@misc{{{deployment['reference_designator']}_{deployment['date']},
-    'title': 'NSF Ocean Observatories Initiative',
-    'year': {datetime.now().strftime('%Y')},
-    'howpublished': 'Instrument and/or data product(s) {deployment['reference_designator']} data from {deployment["date"]} to {(datetime.strptime(deployment["date"], '%Y-%m-%d')+timedelta(days=1) ).strftime("%Y-%m-%d")}',
-    'publisher': 'Raw Data Archive',
-    'url': {url},
-    'accessed': {datetime.now().strftime("%Y-%m-%d")},}}"""
-        
-        with open(os.path.join(base_dir, 'bibtex.txt'), 'w') as f:
-            f.write(bibtex)
-        
 
-        all_mseed_files = glob.glob(os.path.join(base_dir, '*.mseed'))
-        mseed2flac(all_mseed_files)
+                    files.append((absolute_url, self.local_path(absolute_url, base_dir), size))
+
+        return files
+
+    def local_path(self, absolute_url, base_dir):
+        return os.path.join(base_dir, os.path.basename(absolute_url)).replace(':','')
+
+    def plan_deployment(self, deployment, save_dir):
+        """
+        List the .mseed files of the day with their Content-Length, the converted WAV files take about
+        OOI_converted_bytes_per_mseed_byte times as much space.
+        """
+        base_dir = os.path.join(save_dir, deployment['link'].split('files/')[-1])
+        storage = self.storage(save_dir)
+        files = [{'url': absolute_url, 'bytes': size} for absolute_url, _, size in self.list_files(deployment['link'], base_dir)]
+        nbytes = sum(f['bytes'] if f['bytes'] is not None else storage.estimate('OOI_mseed_bytes', 50e6) for f in files)
+        return {'files': files, 'bytes': nbytes, 'disk_bytes': nbytes * max(1.0, storage.estimate('OOI_converted_bytes_per_mseed_byte', 3.0))}
 
+    def stream_deployment(self, deployment):
+        """
+        Decode each .mseed file of the day straight from the HTTP response
+        """
+        import io
+        import obspy
+
+        if deployment.get('planned_files') is not None:
+            urls = [f['url'] for f in deployment['planned_files']]
+        else:
+            urls = [absolute_url for absolute_url, _, _ in self.list_files(deployment['link'], '')]
+
+        for absolute_url in urls:
+            try:
+                response = self.session.get(absolute_url, timeout=60)
+                response.raise_for_status()
+                st = obspy.read(io.BytesIO(response.content), format='MSEED')
+                st.merge(fill_value=0)
+            except Exception as e:
+                print(f"Failed to stream {absolute_url}: {e}")
+                continue
+            trace = st[0]
+            yield deployment['reference_designator'], trace.stats.starttime.datetime.replace(tzinfo=timezone.utc), trace.stats.sampling_rate, trace.data[:, None]
+
+    def file_start_time(self, filename):
+        from ..audio_io import ooi_start_time
+
+        return ooi_start_time(filename)
+
+    def ingest_file(self, absolute_url, local_path, size, manifest, storage):
+        """
+        Download an mseed file into memory (spilling to a temp file in its folder above spool_max_mb) and convert it from there,
+        so the only write is the final FLAC (WAV without ffmpeg, or for samples beyond 24 bits). Returns the mseed size.
+        """
+        import tempfile
+        from ..http_session import download_to
+        from ..mseed_stream import convert_mseed, FlacWriter, WavWriter
+        from ..recompress import ffmpeg_available
+
+        directory = os.path.dirname(local_path)
+        with tempfile.SpooledTemporaryFile(max_size=int(self.spool_max_mb * 1e6), dir=directory) as buffer:
+            nbytes, _ = download_to(absolute_url, buffer, session=self.session, expected_bytes=size)
+
+            outputs = [('.flac', FlacWriter), ('.wav', WavWriter)] if ffmpeg_available() else [('.wav', WavWriter)]
+            for extension, writer in outputs:
+                output_filename = local_path.replace('.mseed', extension)
+                buffer.seek(0)
+                try:
+                    sample_rate, _, sha256 = convert_mseed(buffer, output_filename, target_sample_rate=self.target_sample_rate,
+                                                           ltsa_directory=directory if self.ltsa else None, writer=writer)
+                    break
+                except ValueError as e:
+                    print(f"Cannot write {output_filename} ({e}), trying the next format")
+            else:
+                raise ValueError(f"Could not convert {absolute_url}")
+
+        print(f"Ingested {absolute_url} to {output_filename} at {sample_rate} Hz")
+        manifest.record(output_filename, sha256, source=self.source, url=absolute_url)
+        storage.observe('OOI_converted_bytes_per_mseed_byte', os.path.getsize(output_filename) / max(nbytes, 1))
+        return nbytes
 
+    def download_deployment(self, deployment, save_dir):
+        """
+        Download data for a single deployment
+        """
+        # get the deployment URL
+        url = deployment['link']
+        print(f"Downloading data from {url}")
 
+        # get the directory name
+        directory = url.split('files/')[-1]
+        # print(directory)
+        # get the base directory
+        base_dir = os.path.join(save_dir, directory)
+        if not os.path.exists(base_dir):
+            os.makedirs(base_dir)
 
+        if deployment.get('planned_files') is not None:
+            # listed when the plan was made
+            listed = [(f['url'], self.local_path(f['url'], base_dir), f['bytes']) for f in deployment['planned_files']]
+        else:
+            listed = self.list_files(url, base_dir)
+
+        # skip files we already have, either still as mseed or converted
+        files = [(absolute_url, local_path, size) for absolute_url, local_path, size in listed
+                 if not(os.path.exists(local_path) or os.path.exists(local_path.replace('.mseed','.flac')) or os.path.exists(local_path.replace('.mseed','.wav')))]
+
+        from ..http_session import download_file
+        from ..blobstore import blob_key
+
+        # files another save_dir already has are linked from the blob store instead of downloaded
+        if self.blobs() is not None:
+            keyed = {blob_key(absolute_url, size, self.blob_variant()): (absolute_url, local_path, size) for absolute_url, local_path, size in files}
+            missing = set(self.link_blobs([(key, f[0], os.path.splitext(f[1])[0]) for key, f in keyed.items()], save_dir))
+            files = [f for key, f in keyed.items() if key in missing]
+
+        # reserve the space for the downloads and their conversion, the mseed files are replaced by (usually bigger) WAV files
+        storage = self.storage(save_dir)
+        expected_mseed_bytes = sum(size if size is not None else storage.estimate('OOI_mseed_bytes', 50e6) for _, _, size in files)
+        expected_bytes = expected_mseed_bytes * max(1.0, storage.estimate('OOI_converted_bytes_per_mseed_byte', 3.0))
+
+        manifest = self.manifest(save_dir)
+
+        failed = []
+        with storage.reserve(expected_bytes, directory) as reservation:
+            for absolute_url, local_path, size in files:
+                # Ensure the directory structure exists
+                os.makedirs(os.path.dirname(local_path), exist_ok=True)
+
+                # stream through the pooled session, the connection to the archive is kept alive between files
+                try:
+                    start = time.time()
+                    if self.in_memory_ingest:
+                        nbytes = self.ingest_file(absolute_url, local_path, size, manifest, storage)
+                    else:
+                        nbytes, sha256 = download_file(absolute_url, local_path, session=self.session, expected_bytes=size)
+                        manifest.record(local_path, sha256, source=self.source, url=absolute_url)
+                    storage.observe('OOI_mseed_bytes', nbytes)
+                    reservation.landed(sum(os.path.getsize(path) for path in {local_path, local_path.replace('.mseed', '.flac'),
+                                                                               local_path.replace('.mseed', '.wav')} if os.path.exists(path)))
+                    # for the duration estimates of plan_only
+                    storage.observe('OOI_bytes_per_second', nbytes / max(time.time() - start, 1e-3))
+                except Exception as e:
+                    print(f"Failed to download {absolute_url}: {e}")
+                    failed.append(absolute_url)
+
+            all_mseed_files = glob.glob(os.path.join(base_dir, '*.mseed'))
+            # only the files downloaded by this call are in the reservation, mseed files left by an earlier run are converted too
+            # but not counted
+            downloaded = {local_path: os.path.getsize(local_path) for _, local_path, _ in files if os.path.exists(local_path)}
+            digests = mseed2flac(all_mseed_files, ltsa=self.ltsa, target_sample_rate=self.target_sample_rate)
+
+            # the converted files replace the mseed files in the manifest, with the digests computed as they were written
+            for mseed_file in all_mseed_files:
+                wav_file = mseed_file.replace('mseed', 'wav')
+                if not os.path.exists(mseed_file) and os.path.exists(wav_file):
+                    file_url = (manifest.get(mseed_file) or {}).get('url')
+                    manifest.forget(mseed_file)
+                    manifest.record(wav_file, digests.get(wav_file), source=self.source, url=file_url)
+
+            # learn how much the conversion grows the data, for the next reservations
+            converted = [f for f in downloaded if not os.path.exists(f) and os.path.exists(f.replace('mseed', 'wav'))]
+            mseed_bytes = sum(downloaded[f] for f in converted)
+            converted_bytes = sum(os.path.getsize(f.replace('mseed', 'wav')) for f in converted)
+            if mseed_bytes > 0 and converted_bytes > 0:
+                storage.observe('OOI_converted_bytes_per_mseed_byte', converted_bytes / mseed_bytes)
+                reservation.landed(converted_bytes - mseed_bytes)
+
+            # share the converted files with the other save_dirs
+            blobs = self.blobs()
+            if blobs is not None:
+                added = []
+                for absolute_url, local_path, size in files:
+                    for extension in ('.flac', '.wav'):
+                        path = local_path.replace('.mseed', extension)
+                        if os.path.exists(path):
+                            key = blob_key(absolute_url, size, self.blob_variant())
+                            sha256 = blobs.add(key, path, (manifest.get(path) or {}).get('sha256'), source=self.source)
+                            manifest.record(path, sha256, source=self.source, url=absolute_url)
+                            added.append((key, path))
+                            break
+                self.share_ltsa(base_dir, added, [local_path for _, local_path, _ in listed])
+
+            # the day is complete when every listed file is on disk converted, the files that arrived are kept and the day fails
+            # so the rest is retried (a sync does not move its mark past it)
+            missing = [absolute_url for absolute_url, local_path, _ in listed
+                       if not any(os.path.exists(local_path.replace('.mseed', extension)) for extension in ('.flac', '.wav'))]
+            error = None
+            if len(listed) == 0:
+                error = f"no files are listed at {url}"
+            elif missing:
+                error = f"{len(missing)} of {len(listed)} files of {url} are missing ({len(failed)} downloads failed): {', '.join(missing)}"
+
+            # provenance and citation of the day, the BibTeX is exported from the catalog (hydrophone-downloader-citations)
+            self.catalog(save_dir).record(self.source, deployment['reference_designator'], deployment['date'], base_dir, url=deployment['link'],
+                                          deployment=deployment, status='done' if error is None else 'failed', error=error)
+            if error is not None:
+                raise RuntimeError(error)
+
+
+
+
+
+def mseed2flac(filenames, ltsa=False, target_sample_rate=None):
+    """
+    ltsa: also add the LTSA of each file to ltsa.npz in its folder, computed from the samples decoded for the conversion
+    target_sample_rate: resample to this rate (Hz) before writing, if it is below the native rate
+    Each file is converted a group of records at a time (see mseed_stream), so memory does not grow with the file length or its gaps.
+    Returns {wav filename: sha256} of the converted files (None where the writer could not hash it).
+    """
+    from ..mseed_stream import convert_mseed
 
-def mseed2flac(filenames):
     # resolve wildcard characters
     print(filenames)
     if type(filenames) == str:
@@ -211,22 +338,23 @@ def mseed2flac(filenames):
 
     print(filenames)
     print('here')
+    digests = {}
     for filename in filenames:
         print(filename)
         if not filename.endswith('mseed'):
             continue
         print(filename)
         try:
-            st = obspy.read(filename, format='mseed')
-            st.merge(fill_value=0)
-            sample_rate = st[0].stats['sampling_rate']
             wav_filename = filename.replace('mseed', 'wav')
-            st.write(wav_filename, format='WAV', framerate=sample_rate)
-            print(f"Converted {filename} to {wav_filename}")
+            # the LTSA is computed from the native rate samples
+            sample_rate, _, digests[wav_filename] = convert_mseed(filename, wav_filename, target_sample_rate=target_sample_rate,
+                                                                  ltsa_directory=os.path.dirname(filename) if ltsa else None)
+            print(f"Converted {filename} to {wav_filename} at {sample_rate} Hz")
             os.remove(filename)  # Delete the original .mseed file
         except Exception as e:
             print(f'Failed to convert {filename}: {e}')
             continue
+    return digests
 
 
 
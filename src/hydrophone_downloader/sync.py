@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+sync.py
+
+ incremental mirroring: hydrophone-downloader-sync fetches, for each station and device matching the query, only the days since
+ the last run. The high-water mark of each (source, station, device) is the newest day up to which every day was downloaded and
+ converted, kept in <save_dir>/.sync.sqlite. A run fetches from the mark minus sync_lookback_days (for files that arrive late)
+ up to today, the mark day itself is always fetched again since it may have been a partial day. Files already in save_dir are
+ skipped by the download classes, so running it again (from cron, say) is cheap and repeats nothing.
+
+ Days are the unit because each deployment is one station-day. A failed day stops its station's mark from moving past it, so the
+ next run retries it. The download classes fail a day when any file listed for it is missing afterwards.
+"""
+
+import os
+import time
+import sqlite3
+from contextlib import closing
+from datetime import date, datetime, timedelta, timezone
+
+from .supported_classes.base_class import deployment_key
+
+
+SYNC_FILENAME = '.sync.sqlite'
+
+
+def deployment_device(deployment):
+    """
+    The hydrophone of a deployment: the ONC device code, or the OOI instrument folder of the raw data link
+    """
+    if 'filters' in deployment:
+        return deployment['filters'].get('deviceCode') or ''
+    if 'link' in deployment:
+        # .../<site>/<node>/<port>-<instrument>/YYYY/MM/DD/
+        return deployment['link'].rstrip('/').split('/')[-4]
+    return ''
+
+
+def sync_key(deployment):
+    source, station, _ = deployment_key(deployment)
+    return (source, station, deployment_device(deployment))
+
+
+class SyncState:
+    """
+    The high-water mark of each (source, station, device)
+    """
+    def __init__(self, save_dir):
+        os.makedirs(save_dir, exist_ok=True)
+        self.path = os.path.join(save_dir, SYNC_FILENAME)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS marks (
+                source TEXT NOT NULL,
+                station TEXT NOT NULL,
+                device TEXT NOT NULL,
+                synced_through TEXT NOT NULL,
+                updated REAL,
+                PRIMARY KEY (source, station, device)
+            )""")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def marks(self):
+        with closing(self._connect()) as conn:
+            return {(row['source'], row['station'], row['device']): date.fromisoformat(row['synced_through'])
+                    for row in conn.execute("SELECT * FROM marks")}
+
+    def advance(self, key, day):
+        """
+        Move the mark of key to day, a mark never moves back
+        """
+        with closing(self._connect()) as conn, conn:
+            conn.execute("INSERT INTO marks (source, station, device, synced_through, updated) VALUES (?, ?, ?, ?, ?) "
+                         "ON CONFLICT (source, station, device) DO UPDATE SET "
+                         "synced_through=max(synced_through, excluded.synced_through), updated=excluded.updated",
+                         (*key, day.isoformat(), time.time()))
+
+
+def sync_window(deployments, marks, lookback_days, today, since):
+    """
+    The deployments to fetch: from mark - lookback_days (since for a station without a mark) to today, oldest first
+    """
+    lookback = timedelta(days=lookback_days)
+    selected = []
+    for deployment in deployments:
+        mark = marks.get(sync_key(deployment))
+        start = since if mark is None else mark - lookback
+        if start <= deployment['date'] <= today:
+            selected.append(deployment)
+    return sorted(selected, key=lambda d: (d['date'], deployment_key(d)))
+
+
+def sync(save_dir, min_lat=-90, max_lat=90, min_lon=-180, max_lon=180, min_depth=0, max_depth=12000, license=None,
+         lookback_days=1, since=None, options=None, profiler=None):
+    """
+    Download what is new at the stations matching the bounds since their marks, and advance the marks.
+    since: first day (date or 'YYYY-MM-DD') of a station that was never synced, default today - lookback_days
+    options: keyword arguments of the download classes (see cli.source_options)
+    Returns a result dict per deployment (see BaseDownloadClass.download_deployments).
+    """
+    from .downloader import source_classes
+    from .profiling import StageProfiler
+
+    assert lookback_days >= 0, "lookback_days must not be negative"
+    if profiler is None:
+        profiler = StageProfiler()
+    today = datetime.now(timezone.utc).date()
+    if since is None:
+        since = today - timedelta(days=lookback_days)
+    elif isinstance(since, str):
+        since = datetime.strptime(since[:10], '%Y-%m-%d').date()
+
+    state = SyncState(save_dir)
+    marks = state.marks()
+    results = []
+    for source, download_class in source_classes().items():
+        with profiler.stage(f"discover_{source}"):
+            download_class = download_class(**(options or {}))
+            download_class.discover()
+        source_marks = [mark for key, mark in marks.items() if key[0] == source]
+        earliest = min([since] + [mark - timedelta(days=lookback_days) for mark in source_marks])
+        deployments = download_class.filter_deployments(min_lat, max_lat, min_lon, max_lon, min_depth, max_depth, license,
+                                                        earliest.strftime('%Y-%m-%d'), today.strftime('%Y-%m-%d'))
+        deployments = sync_window(deployments, marks, lookback_days, today, since)
+        print(f"Syncing {len(deployments)} {source} station-days")
+
+        # oldest first, so an interrupted run keeps the marks it reached
+        stopped = set()
+        with profiler.stage(f"sync_{source}"):
+            for deployment in deployments:
+                key = sync_key(deployment)
+                day = deployment['date']
+                result = download_class.download_deployments([deployment], save_dir)[0]
+                results.append(result)
+                if result['status'] == 'done' and key not in stopped:
+                    state.advance(key, day)
+                else:
+                    stopped.add(key)
+
+    new_marks = state.marks()
+    for key in sorted(new_marks):
+        if new_marks[key] != marks.get(key):
+            print(f"{' '.join(k for k in key if k)}: synced through {new_marks[key]} (was {marks.get(key)})")
+    failed = [r for r in results if r['status'] != 'done']
+    print(f"Synced {len(results)-len(failed)} of {len(results)} station-days into {save_dir}, {len(failed)} failed")
+    return results
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+work_queue.py
+
+ a durable local queue of deployment tasks in SQLite.
+
+ hydrophone-downloader enqueue_only=true ... plans the deployments into <save_dir>/.queue.sqlite, and any number of
+ hydrophone-downloader-worker processes on the same host claim tasks with a lease, download them and mark them done. A task whose
+ worker dies (preempted machine, OOM kill, ...) is handed out again once its lease expires, so a crash never loses the position in
+ a backfill. The queue is in WAL mode, whose shared memory index only works on a local disk: keep it off NFS and do not share it
+ between machines.
+"""
+
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+from contextlib import closing
+from datetime import date, datetime
+
+
+QUEUE_FILENAME = '.queue.sqlite'
+# the visible name the queue had before it was hidden like the other SQLite files of save_dir
+LEGACY_QUEUE_FILENAME = 'queue.sqlite'
+
+
+def default_queue_path(save_dir):
+    """
+    <save_dir>/.queue.sqlite, or the queue.sqlite of an older version while it is the only queue there, so a backfill that was
+    enqueued before the rename is resumed instead of starting an empty queue
+    """
+    path = os.path.join(save_dir, QUEUE_FILENAME)
+    legacy_path = os.path.join(save_dir, LEGACY_QUEUE_FILENAME)
+    if not os.path.exists(path) and os.path.exists(legacy_path):
+        print(f"Using the queue of an older version, {legacy_path}")
+        return legacy_path
+    return path
+
+
+def json_default(obj):
+    """
+    json.dump default that tags dates, so json_object_hook can restore them
+    """
+    if isinstance(obj, datetime):
+        return {'__datetime__': obj.isoformat()}
+    if isinstance(obj, date):
+        return {'__date__': obj.isoformat()}
+    raise TypeError(f"Cannot serialize {type(obj)}")
+
+
+def json_object_hook(obj):
+    if '__datetime__' in obj:
+        return datetime.fromisoformat(obj['__datetime__'])
+    if '__date__' in obj:
+        return date.fromisoformat(obj['__date__'])
+    return obj
+
+
+def encode_deployment(deployment):
+    return json.dumps(deployment, default=json_default)
+
+
+def decode_deployment(payload):
+    return json.loads(payload, object_hook=json_object_hook)
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkQueue:
+    """
+    Tasks move pending -> running (leased to a worker) -> done | failed. A task is retried until it has been attempted max_attempts times.
+    """
+    def __init__(self, path, lease_seconds=900, max_attempts=3):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS tasks (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                key TEXT UNIQUE NOT NULL,
+                source TEXT NOT NULL,
+                save_dir TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                worker TEXT,
+                lease_expires REAL,
+                error TEXT,
+                updated REAL
+            )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, id)")
+
+    def _connect(self):
+        # a connection per operation, so the lease renewal thread and the worker never share one
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def enqueue(self, source, deployments, save_dir):
+        """
+        Add a task per deployment, tasks already in the queue (same source, station, date and save_dir) are left as they are.
+        Returns the number of new tasks.
+        """
+        from .supported_classes.base_class import deployment_key
+
+        now = time.time()
+        rows = [('|'.join(deployment_key(d)) + '|' + os.path.abspath(save_dir), source, save_dir, encode_deployment(d), now) for d in deployments]
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            before = conn.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+            conn.executemany("INSERT OR IGNORE INTO tasks (key, source, save_dir, payload, updated) VALUES (?, ?, ?, ?, ?)", rows)
+            after = conn.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+            conn.execute("COMMIT")
+        return after - before
+
+    def _requeue_expired(self, conn, now):
+        conn.execute("UPDATE tasks SET status='failed', worker=NULL, error='lease expired too many times', updated=? "
+                     "WHERE status='running' AND lease_expires < ? AND attempts >= ?", (now, now, self.max_attempts))
+        conn.execute("UPDATE tasks SET status='pending', worker=NULL, updated=? WHERE status='running' AND lease_expires < ?", (now, now))
+
+    def claim(self, worker):
+        """
+        Lease the oldest pending task to worker, returns (task_id, source, save_dir, deployment) or None if nothing is pending.
+        """
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self._requeue_expired(conn, now)
+            row = conn.execute("SELECT id, source, save_dir, payload FROM tasks WHERE status='pending' ORDER BY id LIMIT 1").fetchone()
+            if row is not None:
+                conn.execute("UPDATE tasks SET status='running', worker=?, lease_expires=?, attempts=attempts+1, updated=? WHERE id=?",
+                             (worker, now + self.lease_seconds, now, row['id']))
+            conn.execute("COMMIT")
+        if row is None:
+            return None
+        return row['id'], row['source'], row['save_dir'], decode_deployment(row['payload'])
+
+    def renew(self, task_id, worker):
+        """
+        Extend the lease, returns False if the task is no longer leased to this worker.
+        """
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            cursor = conn.execute("UPDATE tasks SET lease_expires=?, updated=? WHERE id=? AND worker=? AND status='running'",
+                                  (now + self.lease_seconds, now, task_id, worker))
+        return cursor.rowcount == 1
+
+    def complete(self, task_id, worker, success, error=None):
+        """
+        Mark a task done, or put it back in the queue for another attempt (failed once it has been attempted max_attempts times).
+        """
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            if success:
+                conn.execute("UPDATE tasks SET status='done', worker=NULL, error=NULL, updated=? WHERE id=? AND worker=?", (now, task_id, worker))
+            else:
+                conn.execute("UPDATE tasks SET status=CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, worker=NULL, error=?, updated=? "
+                             "WHERE id=? AND worker=?", (self.max_attempts, error, now, task_id, worker))
+
+    def counts(self):
+        with closing(self._connect()) as conn:
+            return {row['status']: row['n'] for row in conn.execute("SELECT status, COUNT(*) AS n FROM tasks GROUP BY status")}
+
+
+class LeaseKeeper:
+    """
+    Renew a task's lease from a background thread while the worker downloads it.
+    """
+    def __init__(self, queue, task_id, worker):
+        self.queue, self.task_id, self.worker = queue, task_id, worker
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.queue.lease_seconds / 3):
+            try:
+                if not self.queue.renew(self.task_id, self.worker):
+                    print(f"Lost the lease on task {self.task_id}")
+                    return
+            except sqlite3.Error as e:
+                print(f"Could not renew the lease on task {self.task_id}: {e}")
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_worker(queue_path, options=None, lease_seconds=900, max_attempts=3, poll_interval=30, worker=None):
+    """
+    Claim and download tasks until the queue has nothing pending or running. While other workers still hold leases, keep polling,
+    their tasks come back to the queue if they die.
+
+    options: keyword arguments for the download classes (ltsa, target_sample_rate, ...)
+    """
+    from .downloader import source_classes
+
+    queue = WorkQueue(queue_path, lease_seconds=lease_seconds, max_attempts=max_attempts)
+    worker = worker or default_worker_id()
+    classes = source_classes()
+    download_classes = {}
+    n_done = 0
+
+    print(f"Worker {worker} started on {queue_path}")
+    while True:
+        task = queue.claim(worker)
+        if task is None:
+            counts = queue.counts()
+            if counts.get('running', 0) == 0:
+                break
+            time.sleep(poll_interval)
+            continue
+
+        task_id, source, save_dir, deployment = task
+        if source not in download_classes:
+            # deployments come from the queue, so the slow discovery never runs in a worker
+            download_classes[source] = classes[source](**(options or {}))
+
+        with LeaseKeeper(queue, task_id, worker):
+            result = download_classes[source].download_deployments([deployment], save_dir)[0]
+        queue.complete(task_id, worker, result['status'] == 'done', result['error'])
+        n_done += 1
+        print(f"Worker {worker}: {result['source']} {result['station']} {result['date']} {result['status']}")
+
+    print(f"Worker {worker} finished after {n_done} tasks, queue: {queue.counts()}")
+    return n_done
+
+
+def run_workers(queue_path, workers=1, **kwargs):
+    """
+    Run run_worker in `workers` processes and wait for all of them.
+    """
+    import multiprocessing
+
+    if workers <= 1:
+        return run_worker(queue_path, **kwargs)
+
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=run_worker, args=(queue_path,), kwargs=kwargs) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
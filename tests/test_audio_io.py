@@ -0,0 +1,37 @@
+from datetime import datetime, timezone
+
+from hydrophone_downloader.audio_io import onc_start_time, ooi_start_time
+from hydrophone_downloader.supported_classes.ooi_class import OOIDownloadClass
+
+
+OOI_URL = "https://rawdata-west.oceanobservatories.org/files/CE02SHBP/LJ01D/11-HYDBBA106/2018/01/01/OO-HYEA2--YDH-2018-01-01T01:02:03.250000.mseed"
+EXPECTED = datetime(2018, 1, 1, 1, 2, 3, tzinfo=timezone.utc).timestamp() + 0.25
+
+
+def test_ooi_start_time_of_saved_files():
+    local_path = OOIDownloadClass().local_path(OOI_URL, "/data/CE02SHBP/LJ01D/11-HYDBBA106/2018/01/01")
+    assert ':' not in local_path
+    assert ooi_start_time(local_path) == EXPECTED
+    for extension in ('.flac', '.wav'):
+        assert ooi_start_time(local_path.replace('.mseed', extension)) == EXPECTED
+
+
+def test_ooi_start_time_of_archive_names():
+    assert ooi_start_time(OOI_URL) == EXPECTED
+    assert ooi_start_time("OO-HYEA2--YDH-2018-01-01T01:02:03.mseed") == EXPECTED - 0.25
+    assert ooi_start_time("ICLISTENHF1234_20250101T000000.000Z.flac") is None
+
+
+def test_onc_start_time():
+    assert onc_start_time("ICLISTENHF1234_20250101T010203.500Z-HPF.flac") == datetime(2025, 1, 1, 1, 2, 3, 500000, tzinfo=timezone.utc).timestamp()
+    assert onc_start_time("OO-HYEA2--YDH-2018-01-01T010203.250000.flac") is None
+
+
+def test_dataset_and_envelope_read_saved_ooi_names():
+    from hydrophone_downloader.dataset import file_start_time
+    from hydrophone_downloader.envelope import file_station
+
+    local_path = OOIDownloadClass().local_path(OOI_URL, "/data").replace('.mseed', '.flac')
+    assert file_station(local_path) == "OO-HYEA2--YDH"
+    assert file_start_time(local_path).timestamp() == EXPECTED
+    assert file_station("ICLISTENHF1234_20250101T000000.000Z.flac") == "ICLISTENHF1234"
@@ -0,0 +1,41 @@
+import random
+from datetime import date, timedelta
+
+import pytest
+
+from hydrophone_downloader.supported_classes.base_class import deployment_key, shard_deployments
+
+
+def deployments():
+    onc = [{'source': 'ONC', 'locationCode': location, 'date': date(2024, 1, 1) + timedelta(days=day)}
+           for location in ('BACAX', 'CBYIP', 'KEMF') for day in range(30)]
+    ooi = [{'source': 'OOI', 'reference_designator': 'CE02SHBP-LJ01D-11-HYDBBA106', 'date': f"2024-01-{day:02d}"} for day in range(1, 31)]
+    return onc + ooi
+
+
+@pytest.mark.parametrize("shard_count", [1, 2, 3, 7])
+def test_shards_cover_every_deployment_once(shard_count):
+    shards = [shard_deployments(deployments(), index, shard_count) for index in range(shard_count)]
+    keys = [deployment_key(d) for shard in shards for d in shard]
+    assert len(keys) == len(set(keys))
+    assert set(keys) == {deployment_key(d) for d in deployments()}
+
+
+def test_shards_do_not_depend_on_the_order():
+    shuffled = deployments()
+    random.Random(0).shuffle(shuffled)
+    for index in range(3):
+        assert ({deployment_key(d) for d in shard_deployments(shuffled, index, 3)}
+                == {deployment_key(d) for d in shard_deployments(deployments(), index, 3)})
+
+
+def test_shard_of_a_date_or_its_string():
+    as_date = {'source': 'ONC', 'locationCode': 'BACAX', 'date': date(2024, 1, 5)}
+    as_string = dict(as_date, date='2024-01-05')
+    assert all(len(shard_deployments([as_date], index, 5)) == len(shard_deployments([as_string], index, 5)) for index in range(5))
+
+
+@pytest.mark.parametrize("shard_index,shard_count", [(2, 2), (-1, 2), (0, 0)])
+def test_bad_shard(shard_index, shard_count):
+    with pytest.raises(AssertionError):
+        shard_deployments(deployments(), shard_index, shard_count)
@@ -0,0 +1,57 @@
+import os
+from datetime import date
+
+import pytest
+
+from hydrophone_downloader.catalog import Catalog
+
+
+@pytest.fixture
+def day_folder(tmp_path):
+    directory = tmp_path / "CE02SHBP" / "LJ01D" / "11-HYDBBA106" / "2018" / "01" / "01"
+    directory.mkdir(parents=True)
+    (directory / "OO-HYEA2--YDH-2018-01-01T000000.000000.flac").write_bytes(b'0' * 100)
+    (directory / "OO-HYEA2--YDH-2018-01-01T000500.000000.flac").write_bytes(b'0' * 50)
+    (directory / "metadata.json").write_text("{}")
+    (directory / ".hidden").write_text("")
+    return str(directory)
+
+
+def test_record_lists_the_folder(tmp_path, day_folder):
+    catalog = Catalog(str(tmp_path))
+    catalog.record('OOI', 'CE02SHBP-LJ01D-11-HYDBBA106', date(2018, 1, 1), day_folder, url="https://example.org/",
+                   deployment={'date': date(2018, 1, 1), 'planned_files': [1, 2]}, version='')
+    [row] = catalog.days()
+    assert row['date'] == '2018-01-01'
+    assert row['directory'] == os.path.join("CE02SHBP", "LJ01D", "11-HYDBBA106", "2018", "01", "01")
+    assert row['files'] == ["OO-HYEA2--YDH-2018-01-01T000000.000000.flac", "OO-HYEA2--YDH-2018-01-01T000500.000000.flac"]
+    assert (row['n_files'], row['bytes']) == (2, 150)
+    assert row['deployment'] == {'date': {'__date__': '2018-01-01'}}
+    assert row['git_version'] is None
+
+
+def test_latest_row_and_status_filtering(tmp_path, day_folder):
+    catalog = Catalog(str(tmp_path))
+    station = 'CE02SHBP-LJ01D-11-HYDBBA106'
+    catalog.record('OOI', station, '2018-01-01', day_folder, status='failed', error="1 of 2 files are missing")
+    catalog.record('OOI', station, '2018-01-02', day_folder)
+    assert [row['date'] for row in catalog.days()] == ['2018-01-02']
+    assert [row['error'] for row in catalog.days(status='failed')] == ["1 of 2 files are missing"]
+    assert len(catalog.days(status=None)) == 2
+
+    # the day arrived on the next try, and a later failure of the other day replaces its done row
+    catalog.record('OOI', station, '2018-01-01', day_folder)
+    catalog.record('OOI', station, '2018-01-02', day_folder, status='failed', error="no files are listed")
+    assert [row['date'] for row in catalog.days()] == ['2018-01-01']
+    assert [row['date'] for row in catalog.days(status='failed')] == ['2018-01-02']
+    assert catalog.days(source='ONC') == []
+
+
+def test_inventory_counts_done_days(tmp_path, day_folder):
+    catalog = Catalog(str(tmp_path))
+    station = 'CE02SHBP-LJ01D-11-HYDBBA106'
+    for day in ('2018-01-01', '2018-01-02', '2018-01-03'):
+        catalog.record('OOI', station, day, day_folder)
+    catalog.record('OOI', station, '2018-01-03', day_folder, status='failed', error="no files are listed")
+    assert catalog.inventory() == [{'source': 'OOI', 'station': station, 'days': 2, 'first': '2018-01-01', 'last': '2018-01-02',
+                                    'files': 4, 'bytes': 300}]
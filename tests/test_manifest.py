@@ -0,0 +1,61 @@
+import os
+
+import pytest
+
+from hydrophone_downloader import manifest as manifest_module
+from hydrophone_downloader.manifest import Manifest, hash_file
+
+
+@pytest.fixture
+def hashed(monkeypatch):
+    """
+    The files hash_file reads
+    """
+    hashed = []
+
+    def counting_hash_file(path, *args, **kwargs):
+        hashed.append(os.path.basename(path))
+        return hash_file(path, *args, **kwargs)
+
+    monkeypatch.setattr(manifest_module, 'hash_file', counting_hash_file)
+    return hashed
+
+
+@pytest.fixture
+def archive(tmp_path):
+    manifest = Manifest(str(tmp_path))
+    for name in ('a.flac', 'b.flac', 'c.flac', 'd.flac'):
+        path = tmp_path / name
+        path.write_bytes(name.encode() * 1000)
+        manifest.record(str(path), hash_file(str(path)), source='OOI')
+    return manifest
+
+
+def test_verify_only_rehashes_changed_files(tmp_path, archive, hashed):
+    # b touched, c corrupted in place with the same size, d removed
+    stat = os.stat(tmp_path / 'b.flac')
+    os.utime(tmp_path / 'b.flac', (stat.st_atime, stat.st_mtime + 10))
+    (tmp_path / 'c.flac').write_bytes(b'x' * 6000)
+    os.utime(tmp_path / 'c.flac', (stat.st_atime, stat.st_mtime + 20))
+    os.remove(tmp_path / 'd.flac')
+
+    assert archive.verify() == {'ok': 1, 'rehashed': 1, 'missing': ['d.flac'], 'corrupt': ['c.flac']}
+    assert sorted(hashed) == ['b.flac', 'c.flac']
+
+    # the touched file was recorded with its new mtime, so it is trusted the next time
+    hashed.clear()
+    assert archive.verify()['ok'] == 2
+    assert hashed == ['c.flac']
+
+
+def test_full_verify_rehashes_everything(archive, hashed):
+    assert archive.verify(full=True) == {'ok': 4, 'rehashed': 0, 'missing': [], 'corrupt': []}
+    assert sorted(hashed) == ['a.flac', 'b.flac', 'c.flac', 'd.flac']
+
+
+def test_record_uses_the_given_digest(tmp_path, hashed):
+    path = tmp_path / 'a.wav'
+    path.write_bytes(b'RIFF')
+    Manifest(str(tmp_path)).record(str(path), 'digest computed while writing')
+    assert hashed == []
+    assert Manifest(str(tmp_path)).get(str(path))['sha256'] == 'digest computed while writing'
@@ -0,0 +1,48 @@
+import wave
+
+import numpy as np
+import pytest
+
+from hydrophone_downloader.manifest import hash_file
+from hydrophone_downloader.mseed_stream import WavWriter, convert_mseed, expected_frames
+
+
+@pytest.fixture
+def mseed_file(tmp_path):
+    """
+    Two traces with a gap between them, like a day file of a hydrophone that dropped out
+    """
+    obspy = pytest.importorskip('obspy')
+    rng = np.random.default_rng(0)
+    first = obspy.Trace(rng.integers(-1000, 1000, 64000 * 3 + 17).astype(np.int32))
+    first.stats.sampling_rate = 64000
+    second = first.copy()
+    second.stats.starttime += 3.5
+    filename = str(tmp_path / "OO-HYEA2--YDH-2018-01-01T000000.000000.mseed")
+    obspy.Stream([first, second]).write(filename, format='MSEED', encoding='STEIM2', reclen=512)
+    return filename
+
+
+@pytest.mark.parametrize("target_sample_rate", [None, 8000, 44100])
+def test_convert_mseed_hashes_the_wav_as_written(mseed_file, target_sample_rate):
+    output = mseed_file.replace('.mseed', '.wav')
+    _, n_written, sha256 = convert_mseed(mseed_file, output, target_sample_rate=target_sample_rate)
+    assert n_written == expected_frames(mseed_file, target_sample_rate)
+    assert sha256 == hash_file(output)
+
+    # from a file object, as the in-memory ingest does
+    with open(mseed_file, 'rb') as f:
+        assert convert_mseed(f, output, target_sample_rate=target_sample_rate)[2] == sha256
+
+
+@pytest.mark.parametrize("n_frames", [None, 999, 1001])
+def test_wav_writer_with_the_length_wrong_or_unknown(tmp_path, n_frames):
+    filename = str(tmp_path / "out.wav")
+    writer = WavWriter(filename, 8000, n_frames=n_frames)
+    writer.write(np.arange(500))
+    writer.write(np.arange(500))
+    writer.close()
+    # the header is patched on close, so the file is still valid but was not hashed as written
+    assert writer.sha256 is None
+    with wave.open(filename) as f:
+        assert f.getnframes() == 1000
@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+from scipy.signal import resample_poly
+
+from hydrophone_downloader.resample import StreamingResampler, resample
+
+
+RATES = [(64000, 16000), (48000, 44100), (16000, 48000), (96000, 22050), (1000, 999)]
+BLOCK_SIZES = [1, 7, 1000, 4096, 100000]
+
+
+@pytest.mark.parametrize("orig_rate,target_rate", RATES)
+@pytest.mark.parametrize("block_size", BLOCK_SIZES)
+def test_blocks_match_resample_poly(orig_rate, target_rate, block_size):
+    x = np.random.default_rng(0).standard_normal(5011)
+    resampler = StreamingResampler(orig_rate, target_rate)
+    out = np.concatenate([resampler.process(x[i:i + block_size]) for i in range(0, len(x), block_size)] + [resampler.flush()])
+
+    expected = resample_poly(x, resampler.up, resampler.down)
+    assert len(out) == len(expected)
+    np.testing.assert_allclose(out, expected, rtol=0, atol=1e-12)
+
+
+def test_passthrough():
+    x = np.arange(100, dtype=float)
+    resampler = StreamingResampler(16000, 16000)
+    assert resampler.passthrough
+    np.testing.assert_array_equal(np.concatenate([resampler.process(x[:30]), resampler.process(x[30:]), resampler.flush()]), x)
+
+
+def test_resample_matches_resample_poly():
+    x = np.random.default_rng(1).standard_normal(30000)
+    np.testing.assert_allclose(resample(x, 64000, 16000, block_size=4096), resample_poly(x, 1, 4), rtol=0, atol=1e-12)
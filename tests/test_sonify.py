@@ -0,0 +1,58 @@
+import os
+import wave
+from datetime import datetime, timezone
+
+import numpy as np
+import pytest
+
+from hydrophone_downloader.sonify import rate_ratio, station_files
+from hydrophone_downloader.supported_classes.ooi_class import OOIDownloadClass
+
+
+def write_wav(filename, n_frames, sample_rate=8000):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with wave.open(filename, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(np.zeros(n_frames, dtype='<i2').tobytes())
+
+
+@pytest.fixture
+def ooi_day(tmp_path):
+    """
+    Two files of an OOI day folder, saved the way OOIDownloadClass names them
+    """
+    url = "https://rawdata-west.oceanobservatories.org/files/CE02SHBP/LJ01D/11-HYDBBA106/2018/01/01/"
+    base_dir = os.path.join(tmp_path, url.split('files/')[-1])
+    ooi = OOIDownloadClass()
+    for time in ('00:05:00', '00:00:00'):
+        local_path = ooi.local_path(url + f"OO-HYEA2--YDH-2018-01-01T{time}.000000.mseed", base_dir)
+        write_wav(local_path.replace('.mseed', '.wav'), 8000 * 300)
+    return str(tmp_path)
+
+
+@pytest.mark.parametrize("station", ["OO-HYEA2--YDH", "CE02SHBP-LJ01D-06-CTDBPN106"])
+def test_station_files_finds_ooi_files(ooi_day, station):
+    files, sample_rate = station_files(ooi_day, station)
+    assert sample_rate == 8000
+    assert [f['start_time'] for f in files] == [datetime(2018, 1, 1, 0, m, tzinfo=timezone.utc).timestamp() for m in (0, 5)]
+
+
+def test_station_files_other_station(ooi_day):
+    with pytest.raises(FileNotFoundError):
+        station_files(ooi_day, "RS01SBPS-PC01A-4C-FLORDD103")
+
+
+def test_station_files_onc(tmp_path):
+    write_wav(os.path.join(tmp_path, "ICLISTENHF1234_20250101T000000.000Z.wav"), 8000)
+    write_wav(os.path.join(tmp_path, "ICLISTENHF5678_20250101T000000.000Z.wav"), 8000)
+    files, _ = station_files(str(tmp_path), "ICLISTENHF1234")
+    assert [os.path.basename(f['path']) for f in files] == ["ICLISTENHF1234_20250101T000000.000Z.wav"]
+
+
+@pytest.mark.parametrize("playback_rate,output_rate", [(64000 * 60, 48000), (64000 * 93.355, 48000), (16000 * 86400 / 1234.5, 44100)])
+def test_rate_ratio_stays_small(playback_rate, output_rate):
+    ratio = rate_ratio(playback_rate, output_rate)
+    assert max(ratio.numerator / max(float(ratio), 1), ratio.denominator) <= 2000
+    assert abs(float(ratio) / (playback_rate / output_rate) - 1) < 1e-4
@@ -0,0 +1,85 @@
+from datetime import date, datetime, timedelta, timezone
+
+import pytest
+
+from hydrophone_downloader import downloader
+from hydrophone_downloader.sync import SyncState, sync, sync_key, sync_window
+
+
+TODAY = datetime.now(timezone.utc).date()
+BACAX = ('ONC', 'BACAX', 'ICLISTENHF1234')
+KEMF = ('ONC', 'KEMF', 'ICLISTENHF1234')
+
+
+def onc_day(location, day, device='ICLISTENHF1234'):
+    return {'source': 'ONC', 'locationCode': location, 'date': day, 'filters': {'deviceCode': device}}
+
+
+class FakeONC:
+    """
+    Stands in for ONCDownloadClass: the days of failing_days fail to download
+    """
+    failing_days = set()
+    fetched = []
+
+    def __init__(self, **options):
+        pass
+
+    def discover(self):
+        self.deployments = [onc_day(location, TODAY - timedelta(days=n)) for location in ('BACAX', 'KEMF') for n in range(5)]
+
+    def filter_deployments(self, min_lat, max_lat, min_lon, max_lon, min_depth, max_depth, license, start_time, end_time):
+        return [d for d in self.deployments if start_time <= d['date'].strftime('%Y-%m-%d') <= end_time]
+
+    def download_deployments(self, deployments, save_dir):
+        results = []
+        for deployment in deployments:
+            failed = (deployment['locationCode'], deployment['date']) in self.failing_days
+            FakeONC.fetched.append((deployment['locationCode'], deployment['date']))
+            results.append({'source': 'ONC', 'station': deployment['locationCode'], 'date': str(deployment['date']),
+                            'status': 'failed' if failed else 'done', 'seconds': 0, 'error': 'missing files' if failed else None})
+        return results
+
+
+@pytest.fixture
+def fake_onc(monkeypatch):
+    monkeypatch.setattr(downloader, 'source_classes', lambda: {'ONC': FakeONC})
+    FakeONC.failing_days = set()
+    FakeONC.fetched = []
+    return FakeONC
+
+
+def test_mark_never_moves_back(tmp_path):
+    state = SyncState(str(tmp_path))
+    state.advance(BACAX, date(2024, 1, 5))
+    state.advance(BACAX, date(2024, 1, 3))
+    assert state.marks() == {BACAX: date(2024, 1, 5)}
+
+
+def test_sync_key():
+    assert sync_key(onc_day('BACAX', date(2024, 1, 1))) == BACAX
+
+
+def test_sync_window():
+    deployments = [onc_day(location, date(2024, 1, day)) for location in ('BACAX', 'KEMF') for day in range(10, 0, -1)]
+    marks = {BACAX: date(2024, 1, 6)}
+    window = sync_window(deployments, marks, lookback_days=2, today=date(2024, 1, 8), since=date(2024, 1, 7))
+    assert [(d['locationCode'], d['date'].day) for d in window] == [('BACAX', 4), ('BACAX', 5), ('BACAX', 6), ('BACAX', 7),
+                                                                    ('KEMF', 7), ('BACAX', 8), ('KEMF', 8)]
+
+
+def test_failed_day_stops_the_mark(tmp_path, fake_onc):
+    fake_onc.failing_days = {('BACAX', TODAY - timedelta(days=2))}
+    sync(str(tmp_path), since=TODAY - timedelta(days=4), lookback_days=0)
+    marks = SyncState(str(tmp_path)).marks()
+    # the days after the failed one were fetched, but the mark stays before it
+    assert marks[BACAX] == TODAY - timedelta(days=3)
+    assert marks[KEMF] == TODAY
+
+    # the next run starts again from the mark, and moves it once the day arrives
+    fake_onc.failing_days = set()
+    fake_onc.fetched = []
+    sync(str(tmp_path), since=TODAY - timedelta(days=4), lookback_days=0)
+    assert ('BACAX', TODAY - timedelta(days=3)) in fake_onc.fetched
+    assert ('BACAX', TODAY - timedelta(days=4)) not in fake_onc.fetched
+    assert SyncState(str(tmp_path)).marks()[BACAX] == TODAY
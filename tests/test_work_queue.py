@@ -0,0 +1,87 @@
+from datetime import date
+from types import SimpleNamespace
+
+import pytest
+
+from hydrophone_downloader import work_queue
+from hydrophone_downloader.work_queue import WorkQueue, default_queue_path
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    The time the queue sees, moved forward by the tests
+    """
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(work_queue, 'time', SimpleNamespace(time=lambda: clock.now))
+    return clock
+
+
+@pytest.fixture
+def queue(tmp_path, clock):
+    queue = WorkQueue(str(tmp_path / work_queue.QUEUE_FILENAME), lease_seconds=60, max_attempts=2)
+    deployments = [{'source': 'ONC', 'locationCode': 'BACAX', 'date': date(2024, 1, day)} for day in (1, 2)]
+    assert queue.enqueue('ONC', deployments, str(tmp_path)) == 2
+    return queue
+
+
+def test_enqueue_again_adds_nothing(queue, tmp_path):
+    assert queue.enqueue('ONC', [{'source': 'ONC', 'locationCode': 'BACAX', 'date': date(2024, 1, 1)}], str(tmp_path)) == 0
+    assert queue.counts() == {'pending': 2}
+
+
+def test_claim_in_order_and_restore_dates(queue):
+    _, source, _, deployment = queue.claim('a')
+    assert (source, deployment['date']) == ('ONC', date(2024, 1, 1))
+    assert queue.claim('b')[3]['date'] == date(2024, 1, 2)
+    assert queue.claim('c') is None
+
+
+def test_expired_lease_is_requeued(queue, clock):
+    task_id = queue.claim('a')[0]
+    queue.claim('b')
+    clock.now += 30
+    assert queue.renew(task_id, 'a')
+    clock.now += 40
+    # b's lease ran out, a renewed its own
+    assert queue.claim('c')[3]['date'] == date(2024, 1, 2)
+    assert queue.counts() == {'running': 2}
+    clock.now += 61
+    assert queue.claim('d')[0] == task_id
+    assert not queue.renew(task_id, 'a')
+    # a lost the task, its late result is ignored
+    queue.complete(task_id, 'a', True)
+    assert queue.counts() == {'running': 1, 'failed': 1}
+
+
+def test_failed_task_is_retried_up_to_max_attempts(queue):
+    task_id = queue.claim('a')[0]
+    queue.complete(task_id, 'a', False, 'timeout')
+    assert queue.claim('b')[0] == task_id
+    queue.complete(task_id, 'b', False, 'timeout')
+    assert queue.counts() == {'failed': 1, 'pending': 1}
+    assert queue.claim('c')[0] != task_id
+
+
+def test_lease_expiring_max_attempts_times_fails_the_task(queue, clock):
+    task_id = queue.claim('a')[0]
+    clock.now += 61
+    assert queue.claim('b')[0] == task_id
+    clock.now += 61
+    # attempted twice, the second task is handed out instead
+    assert queue.claim('c')[0] != task_id
+    assert queue.counts() == {'failed': 1, 'running': 1}
+
+
+def test_complete(queue):
+    task_id = queue.claim('a')[0]
+    queue.complete(task_id, 'a', True)
+    assert queue.counts() == {'done': 1, 'pending': 1}
+
+
+def test_default_queue_path_keeps_an_older_queue(tmp_path):
+    assert default_queue_path(str(tmp_path)) == str(tmp_path / ".queue.sqlite")
+    WorkQueue(str(tmp_path / "queue.sqlite"))
+    assert default_queue_path(str(tmp_path)) == str(tmp_path / "queue.sqlite")
+    WorkQueue(str(tmp_path / ".queue.sqlite"))
+    assert default_queue_path(str(tmp_path)) == str(tmp_path / ".queue.sqlite")